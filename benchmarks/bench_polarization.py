@@ -0,0 +1,64 @@
+# coding: utf-8
+"""
+Benchmark of the polarized peak sampling matrix fill: the serial kernel
+(nthreads=1) versus the OpenMP kernel, parallelized over the detectors and
+using all the cores (nthreads=None).
+
+The benchmarks follow the asv conventions. They can also be run directly:
+    python -m benchmarks.bench_polarization
+
+"""
+from __future__ import division, print_function
+
+import timeit
+import numpy as np
+import qubic
+from pyoperators import Spherical2CartesianOperator
+from pysimulators.sparse import FSRRotation2dMatrix, FSRRotation3dMatrix
+from qubic.instrument import _fill_projection_matrix, _pack_vector
+from .common import get_dict
+
+NSIDE = 256
+
+
+class TimePolarizationKernel(object):
+    params = (['QU', 'IQU'], [1, None])
+    param_names = ['kind', 'nthreads']
+    timeout = 600
+
+    def setup(self, kind, nthreads):
+        d = get_dict(nside=NSIDE, kind=kind)
+        instrument = qubic.QubicInstrument(d)
+        sampling = qubic.get_pointing(d)
+        scene = qubic.QubicScene(d)
+        theta, phi, self.vals = instrument._peak_angles(
+            scene, instrument.filter.nu, instrument.detector.center,
+            instrument.synthbeam, instrument.horn, instrument.primary_beam)
+        self.direction = Spherical2CartesianOperator('zenith,azimuth')(
+            _pack_vector(theta, phi))
+        self.rotation = sampling.cartesian_galactic2instrument.data
+        cls = {'QU': FSRRotation2dMatrix, 'IQU': FSRRotation3dMatrix}[kind]
+        ndims = len(kind)
+        ndetectors, ncolmax = self.vals.shape
+        self.data = cls(
+            (ndetectors * len(sampling) * ndims, len(scene) * ndims),
+            ncolmax=ncolmax, dtype=instrument.synthbeam.dtype,
+            dtype_index=np.int32, verbose=False).data
+        self.nside = NSIDE
+
+    def time_fill(self, kind, nthreads):
+        _fill_projection_matrix(
+            self.data, self.rotation, self.direction, self.vals, self.nside,
+            kind, nthreads=nthreads)
+
+
+if __name__ == '__main__':
+    bench = TimePolarizationKernel()
+    for kind in TimePolarizationKernel.params[0]:
+        times = []
+        for nthreads in TimePolarizationKernel.params[1]:
+            bench.setup(kind, nthreads)
+            times.append(min(timeit.repeat(
+                lambda: bench.time_fill(kind, nthreads), number=1, repeat=3)))
+        print('{0:>3}: serial {1:.3f}s, parallel {2:.3f}s, speedup {3:.1f}'
+              .format(kind, times[0], times[1], times[0] / times[1]))
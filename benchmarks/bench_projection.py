@@ -0,0 +1,86 @@
+# coding: utf-8
+"""
+Benchmarks of the construction of the peak sampling operator, of the
+acquisition operator and of the map-making, for the TD and FI
+configurations, several scene resolutions and kinds and the random and
+sweeping pointing strategies. The wall time (time_*), the peak resident
+memory (peakmem_*) and the size of the pointing matrix (track_*) are
+reported.
+
+The benchmarks follow the asv conventions (see asv.conf.json):
+    asv run
+    asv continuous master HEAD
+
+"""
+from __future__ import division
+
+import numpy as np
+import qubic
+from qubic.mapmaking import tod2map_all
+from .common import get_dict
+
+PARAMS = (['TD', 'FI'], [64, 128, 256], ['I', 'QU', 'IQU'],
+          ['random', 'sweeping'])
+PARAM_NAMES = ['config', 'nside', 'kind', 'pointing']
+
+
+class _Acquisition(object):
+    params = PARAMS
+    param_names = PARAM_NAMES
+    timeout = 1800
+
+    def setup(self, config, nside, kind, pointing):
+        self.d = get_dict(config, nside, kind, pointing)
+        self.instrument = qubic.QubicInstrument(self.d)
+        self.sampling = qubic.get_pointing(self.d)
+        self.scene = qubic.QubicScene(self.d)
+        qubic.QubicInstrument.clear_peak_angles_cache()
+
+
+class Projection(_Acquisition):
+    def time_get_projection_operator(self, config, nside, kind, pointing):
+        self.instrument.get_projection_operator(
+            self.sampling, self.scene, verbose=False)
+
+    def peakmem_get_projection_operator(self, config, nside, kind, pointing):
+        self.instrument.get_projection_operator(
+            self.sampling, self.scene, verbose=False)
+
+    def track_projection_nbytes(self, config, nside, kind, pointing):
+        P = self.instrument.get_projection_operator(
+            self.sampling, self.scene, verbose=False)
+        return P.matrix.data.nbytes
+    track_projection_nbytes.unit = 'bytes'
+
+
+class AcquisitionOperator(_Acquisition):
+    def setup(self, config, nside, kind, pointing):
+        _Acquisition.setup(self, config, nside, kind, pointing)
+        self.acq = qubic.QubicAcquisition(
+            self.instrument, self.sampling, self.scene, self.d)
+
+    def time_get_operator(self, config, nside, kind, pointing):
+        self.acq.get_operator()
+
+    def peakmem_get_operator(self, config, nside, kind, pointing):
+        self.acq.get_operator()
+
+
+class MapMaking(_Acquisition):
+    maxiter = 10
+
+    def setup(self, config, nside, kind, pointing):
+        if kind == 'QU':
+            # the map-making does not handle QU scenes, asv skips the
+            # benchmarks whose setup raises NotImplementedError
+            raise NotImplementedError
+        _Acquisition.setup(self, config, nside, kind, pointing)
+        self.acq = qubic.QubicAcquisition(
+            self.instrument, self.sampling, self.scene, self.d)
+        self.tod = self.acq.get_operator()(np.ones(self.scene.shape))
+
+    def time_tod2map_all(self, config, nside, kind, pointing):
+        tod2map_all(self.acq, self.tod, disp=False, maxiter=self.maxiter)
+
+    def peakmem_tod2map_all(self, config, nside, kind, pointing):
+        tod2map_all(self.acq, self.tod, disp=False, maxiter=self.maxiter)
@@ -0,0 +1,41 @@
+# coding: utf-8
+from __future__ import division
+
+import qubic
+
+__all__ = ['get_dict']
+
+NPOINTINGS = 1000
+DURATION = NPOINTINGS / 3600  # hours, with a 1 s sampling period
+
+
+def get_dict(config='FI', nside=256, kind='IQU', pointing='random'):
+    """
+    Return the benchmark dictionary, based on pipeline_demo.dict, for a
+    given instrument configuration, scene and pointing strategy.
+
+    Parameters
+    ----------
+    config : {'TD', 'FI'}
+        The instrument configuration.
+    nside : int
+        The Healpix nside of the scene.
+    kind : {'I', 'QU', 'IQU'}
+        The scene kind.
+    pointing : {'random', 'sweeping'}
+        The pointing strategy, with about NPOINTINGS samples.
+
+    """
+    d = qubic.qubicdict.qubicDict()
+    d.read_from_file('pipeline_demo.dict')
+    d['config'] = config
+    if config == 'TD':
+        d['detector_nep'] = 2.05e-16
+    d['nside'] = nside
+    d['kind'] = kind
+    d['random_pointing'] = pointing == 'random'
+    d['sweeping_pointing'] = pointing == 'sweeping'
+    d['repeat_pointing'] = False
+    d['npointings'] = NPOINTINGS
+    d['duration'] = DURATION
+    return d
@@ -141,13 +141,13 @@ def get_cmdclass():
                 if self.debug:
                     flags += F77_COMPILE_DEBUG_GFORTRAN
                 if F77_OPENMP:
-                    flags += ['-openmp']
+                    flags += ['-fopenmp']
                 fcompiler.executables['compiler_f77'] += flags
                 flags = F90_COMPILE_ARGS_GFORTRAN + F90_COMPILE_OPT_GFORTRAN
                 if self.debug:
                     flags += F90_COMPILE_DEBUG_GFORTRAN
                 if F90_OPENMP:
-                    flags += ['-openmp']
+                    flags += ['-fopenmp']
                 fcompiler.executables['compiler_f90'] += flags
                 fcompiler.libraries += [LIBRARY_OPENMP_GFORTRAN]
             elif isinstance(fcompiler,
@@ -205,13 +205,13 @@ def get_cmdclass():
                     if self.debug:
                         flags += F77_COMPILE_DEBUG_GFORTRAN
                     if F77_OPENMP:
-                        flags += ['-openmp']
+                        flags += ['-fopenmp']
                     fc.executables['compiler_f77'] += flags
                     flags = F90_COMPILE_ARGS_GFORTRAN + F90_COMPILE_OPT_GFORTRAN
                     if self.debug:
                         flags += F90_COMPILE_DEBUG_GFORTRAN
                     if F90_OPENMP:
-                        flags += ['-openmp']
+                        flags += ['-fopenmp']
                     fc.executables['compiler_f90'] += flags
                     fc.libraries += [LIBRARY_OPENMP_GFORTRAN]
                 elif isinstance(fc,
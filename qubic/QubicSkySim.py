@@ -1,4 +1,5 @@
 from __future__ import division
+import hashlib
 import os
 import healpy as hp
 import random as rd
@@ -48,7 +49,7 @@ class sky(object):
     Define a sky object as seen by an instrument.
     """
 
-    def __init__(self, skyconfig, d, instrument, out_dir, out_prefix, lmax=None):
+    def __init__(self, skyconfig, d, instrument, out_dir, out_prefix, lmax=None, cache_dir=None):
         """
         Parameters:
         skyconfig  : a skyconfig dictionary to pass to (as expected by) `PySM`
@@ -56,6 +57,9 @@ class sky(object):
         instrument : a `PySM` instrument describing the instrument
         out_dir    : default path where the sky maps will be saved
         out_prefix : default word for the output files
+        cache_dir  : optional directory where the band-integrated foreground maps are
+                     stored, so that they are computed only once for a given
+                     foreground configuration, nside and set of sub-bands
 
         For more details about `PySM` see the `PySM` documentation at the floowing link: 
         https://pysm-public.readthedocs.io/en/latest/index.html
@@ -73,6 +77,8 @@ class sky(object):
         self.output_prefix = out_prefix
         self.input_cmb_maps = None
         self.input_cmb_spectra = None
+        self.cache_dir = cache_dir
+        self._foreground_maps = {}
         if lmax is None:
             self.lmax = 3 * d['nside']
         else:
@@ -131,6 +137,7 @@ class sky(object):
             else:
                 # we add the other predefined components
                 preset_strings.append(skyconfig[k])
+        self.preset_strings = preset_strings
         self.sky = pysm.Sky(nside=self.nside, preset_strings=preset_strings)
         if iscmb:
             self.sky.add_component(cmbmap)
@@ -177,17 +184,76 @@ class sky(object):
         #     # print('Ratio to initial: ',ratio)
 
         # #### Here is the new code from Edgar Jaber
-        for i in range(self.Nfin):
-            nfreqinteg = 5
-            freqs = np.linspace(nus_edge[i], nus_edge[i + 1], nfreqinteg)
-            weights = np.ones(nfreqinteg)
-            sky[i, :, :] = (
-                    self.sky.get_emission(freqs * u.GHz, weights) * utils.bandpass_unit_conversion(freqs * u.GHz,
-                                                                                                   weights,
-                                                                                                   u.uK_CMB)).T
+        # The bandpass integration of each sub-band is done on nfreqinteg frequencies
+        # with flat weights. The foregrounds are evaluated once per distinct frequency
+        # of all the sub-bands and accumulated in the sub-bands using the same trapezoidal
+        # rule as PySM, and the CMB components, which only require a rescaling, are
+        # integrated band by band.
+        nfreqinteg = 5
+        freqs = np.array([np.linspace(nus_edge[i], nus_edge[i + 1], nfreqinteg) for i in range(self.Nfin)])
+        weights = np.ones(nfreqinteg)
+        sky += self._get_foreground_maps(freqs)
+        for component in self.sky.components:
+            if not isinstance(component, pysm.CMBMap):
+                continue
+            for i in range(self.Nfin):
+                sky[i, :, :] += (component.get_emission(freqs[i] * u.GHz, weights).value *
+                                 _get_bandpass_conversion(freqs[i])).T
 
         return sky
 
+    def _get_foreground_maps(self, freqs):
+        """
+        Return the sum of the non-CMB components integrated in the sub-bands, as an
+        array of shape (number_of_input_subfrequencies, npix, 3) in uK_CMB. The maps
+        are kept in memory and, if the sky has a cache directory, on disk.
+        """
+        key = freqs.tobytes()
+        if key in self._foreground_maps:
+            return self._foreground_maps[key]
+
+        filename = None
+        if self.cache_dir is not None:
+            # the CMB is not part of the key, so that Monte-Carlo realizations of the
+            # CMB with the same foregrounds share the cached maps
+            h = hashlib.sha1(repr((sorted(self.preset_strings), self.nside)).encode())
+            h.update(key)
+            filename = os.path.join(self.cache_dir, 'foregrounds_{}.npy'.format(h.hexdigest()))
+            if os.path.exists(filename):
+                maps = np.load(filename)
+                self._foreground_maps[key] = maps
+                return maps
+
+        # PySM cannot evaluate a component at several frequencies in one call: given
+        # several frequencies, get_emission returns their bandpass integral, i.e. a
+        # single map. Each component is therefore evaluated once per distinct
+        # frequency, the edges shared by adjacent sub-bands being evaluated once,
+        # instead of once per frequency of each sub-band.
+        components = [c for c in self.sky.components if not isinstance(c, pysm.CMBMap)]
+        coefficients = _get_bandpass_coefficients(freqs)
+        nus, inverse = np.unique(freqs, return_inverse=True)
+        inverse = inverse.reshape(freqs.shape)
+        maps = np.zeros((len(freqs), self.npix, 3))
+        for inu, nu in enumerate(nus):
+            if len(components) == 0:
+                break
+            emission = np.zeros((3, self.npix))
+            for component in components:
+                emission += component.get_emission(nu * u.GHz).value
+            for iband, ifreq in zip(*np.nonzero(inverse == inu)):
+                maps[iband] += coefficients[iband, ifreq] * emission.T
+
+        if filename is not None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # write then rename, so that concurrent jobs never read a partial file
+            tmpname = filename + '.' + random_string(10)
+            with open(tmpname, 'wb') as f:
+                np.save(f, maps)
+            os.rename(tmpname, filename)
+        self._foreground_maps[key] = maps
+        return maps
+
     # ### This is not supported yet....
     # def read_sky_map(self):
     #     """
@@ -291,7 +357,7 @@ class Qubic_sky(sky):
     Define a sky object as seen by Qubic
     """
 
-    def __init__(self, skyconfig, d, output_directory="./", output_prefix="qubic_sky"):
+    def __init__(self, skyconfig, d, output_directory="./", output_prefix="qubic_sky", cache_dir=None):
         self.Nfin = int(d['nf_sub'])
         self.Nfout = int(d['nf_recon'])
         self.filter_relative_bandwidth = d['filter_relative_bandwidth']
@@ -324,7 +390,7 @@ class Qubic_sky(sky):
                       'output_directory': output_directory, 'output_prefix': output_prefix,
                       'pixel_indices': None}
 
-        sky.__init__(self, skyconfig, d, instrument, output_directory, output_prefix)
+        sky.__init__(self, skyconfig, d, instrument, output_directory, output_prefix, cache_dir=cache_dir)
 
     def get_fullsky_convolved_maps(self, FWHMdeg=None, verbose=None):
         """
@@ -711,6 +777,49 @@ class Qubic_sky(sky):
         return Sigpix
 
 
+_BANDPASS_CONVERSIONS = {}
+_BANDPASS_COEFFICIENTS = {}
+
+
+def _get_bandpass_conversion(freqs):
+    """
+    Return the conversion factor from uK_RJ to uK_CMB of a flat bandpass sampled
+    at the frequencies freqs [GHz]. The factors are cached.
+    """
+    key = freqs.tobytes()
+    try:
+        return _BANDPASS_CONVERSIONS[key]
+    except KeyError:
+        pass
+    factor = utils.bandpass_unit_conversion(freqs * u.GHz, np.ones(len(freqs)), u.uK_CMB).value
+    _BANDPASS_CONVERSIONS[key] = factor
+    return factor
+
+
+def _get_bandpass_coefficients(freqs):
+    """
+    Return the coefficients of shape (nbands, nfreqs) such that the emission in uK_RJ
+    evaluated at the frequencies freqs[i] of the band i, multiplied by the coefficients[i]
+    and summed, is the emission integrated in the band with flat weights, in uK_CMB.
+    It is the trapezoidal rule with the normalized weights used by PySM. The coefficients
+    are cached.
+    """
+    key = freqs.tobytes() + repr(freqs.shape).encode()
+    try:
+        return _BANDPASS_COEFFICIENTS[key]
+    except KeyError:
+        pass
+    coefficients = np.zeros(freqs.shape)
+    for freqs_, coefficients_ in zip(freqs, coefficients):
+        delta = np.diff(freqs_)
+        coefficients_[:-1] += 0.5 * delta
+        coefficients_[1:] += 0.5 * delta
+        coefficients_ *= utils.normalize_weights(freqs_, np.ones(len(freqs_)))
+        coefficients_ *= _get_bandpass_conversion(freqs_)
+    _BANDPASS_COEFFICIENTS[key] = coefficients
+    return coefficients
+
+
 def random_string(nchars):
     lst = [rd.choice(string.ascii_letters + string.digits) for n in range(nchars)]
     str = "".join(lst)
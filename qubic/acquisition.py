@@ -3,23 +3,37 @@ from __future__ import division, print_function
 
 import healpy as hp
 import numpy as np
+import threading
+from collections import OrderedDict
 from pyoperators import (
     BlockColumnOperator, BlockDiagonalOperator, BlockRowOperator,
-    CompositionOperator, DiagonalOperator, I, IdentityOperator,
+    CompositionOperator, DenseBlockDiagonalOperator, DiagonalOperator, I,
+    IdentityOperator,
     MPIDistributionIdentityOperator, MPI, proxy_group, ReshapeOperator,
-    rule_manager, pcg)
+    rule_manager, pcg, SymmetricBandToeplitzOperator)
+try:
+    import pyfftw
+    from pyoperators.fft import FFTW_WISDOM_FILES
+except ImportError:
+    pyfftw = None
 from pyoperators.utils.mpi import as_mpi
 from pysimulators import Acquisition, FitsArray
+from pysimulators.noises import (
+    _fold_psd, _gaussian_psd_1f, _logloginterp_psd, _psd2invntt, _unfold_psd)
 from pysimulators.interfaces.healpy import (
     HealpixConvolutionGaussianOperator)
 from .data import PATH
 from .calibration import QubicCalibration
+from .mapmaking import _pcg_tod2map
 from .samplings import create_random_pointings
 
 __all__ = ['PlanckAcquisition',
            'QubicAcquisition',
            'QubicPlanckAcquisition']
 
+_INVNTT_CACHE = OrderedDict()
+_INVNTT_LOCK = threading.Lock()
+_FFTW_WISDOM = None
 
 
 class QubicAcquisition(Acquisition):
@@ -28,6 +42,8 @@ class QubicAcquisition(Acquisition):
     scene models.
 
     """
+    INVNTT_CACHE_SIZE = 8
+
     def __init__(self, instrument, sampling, scene, d):
         """
         acq = QubicAcquisition(instrument, sampling, scene, d)
@@ -102,13 +118,13 @@ class QubicAcquisition(Acquisition):
         """
         Return the acquisition scene coverage as given by H.T(1), normalized
         so that its integral over the sky is the number of detectors times
-        the duration of the acquisition.
+        the duration of the acquisition. The peak hits are accumulated
+        without computing the acquisition operator, see
+        QubicInstrument.get_coverage.
 
         """
-        H = self.get_operator()
-        out = H.T(np.ones((len(self.instrument), len(self.sampling))))
-        if self.scene.kind != 'I':
-            out = out[..., 0].copy()  # to avoid keeping QU in memory
+        out = self.instrument.get_coverage(self.sampling, self.scene)
+        self.comm.Allreduce(MPI.IN_PLACE, as_mpi(out), op=MPI.SUM)
         ndetectors = self.comm.allreduce(len(self.instrument))
         nsamplings = self.comm.allreduce(len(self.sampling))
         out *= ndetectors * nsamplings * self.sampling.period / np.sum(out)
@@ -124,21 +140,33 @@ class QubicAcquisition(Acquisition):
             nside = self.scene.nside
         ipixel = self.sampling.healpix(nside)
         npixel = 12 * nside ** 2
-        hit = np.histogram(ipixel, bins=npixel, range=(0, npixel))[0]
+        hit = np.bincount(ipixel, minlength=npixel)
         self.sampling.comm.Allreduce(MPI.IN_PLACE, as_mpi(hit), op=MPI.SUM)
         return hit
 
-    def get_noise(self, out=None):
+    def get_noise(self, out=None, seed=None):
+        """
+        Return the noise realization according the instrument's noise model.
+        The 1/f component is flat below 1 / (NoiseGenerator.NCORR_MAX *
+        period), see QubicInstrument.get_noise.
+
+        Parameters
+        ----------
+        out : ndarray, optional
+            Placeholder for the output noise.
+        seed : int, optional
+            The seed of the noise realization.
+
+        """
         out = self.instrument.get_noise(
-            self.sampling, self.scene, photon_noise=self.photon_noise, out=out)
+            self.sampling, self.scene, photon_noise=self.photon_noise, out=out,
+            seed=seed)
         if self.effective_duration is not None:
             nsamplings = self.comm.allreduce(len(self.sampling))
             out *= np.sqrt(nsamplings * self.sampling.period /
                            (self.effective_duration * 31557600))
         return out
 
-    get_noise.__doc__ = Acquisition.get_noise.__doc__
-
     def get_aperture_integration_operator(self):
         """
         Integrate flux density in the telescope aperture.
@@ -267,37 +295,50 @@ class QubicAcquisition(Acquisition):
             if self.photon_noise:
                 sigma_photon = self.instrument._get_noise_photon_nep(self.scene) / np.sqrt(2 * self.sampling.period)
                 self.sigma = np.sqrt(self.sigma ** 2 + sigma_photon ** 2)
-            else:
-                pass
-                # sigma_photon = 0
 
         if self.bandwidth is None and self.psd is None and self.sigma is None:
             raise ValueError('The noise model is not specified.')
 
-
-        print('In acquisition.py: self.forced_sigma={}'.format(self.forced_sigma))
-        print('and self.sigma is:{}'.format(self.sigma))
-        if self.forced_sigma is None:
-            print('Using theoretical TES noises')
-        else:
-            print('Using self.forced_sigma as TES noises')
+        if self.forced_sigma is not None:
             self.sigma = self.forced_sigma.copy()
 
         shapein = (len(self.instrument), len(self.sampling))
+        if self.effective_duration is not None:
+            nsamplings = self.comm.allreduce(len(self.sampling))
+            factor = nsamplings * self.sampling.period / \
+                     (self.effective_duration * 31557600)
+        else:
+            factor = 1
 
         if self.bandwidth is None and self.instrument.detector.fknee == 0:
-            print('diagonal case')
-
             out = DiagonalOperator(1 / self.sigma ** 2, broadcast='rightward',
-                                   shapein=(len(self.instrument), len(self.sampling)))
-            print(out.shape)
-            print(out)
-
-            if self.effective_duration is not None:
-                nsamplings = self.comm.allreduce(len(self.sampling))
-                out /= (nsamplings * self.sampling.period / (self.effective_duration * 31557600))
+                                   shapein=shapein)
+            if factor != 1:
+                out /= factor
             return out
 
+        # the band-Toeplitz kernel and its FFTW plans only depend on the
+        # noise model: acquisitions sharing it (e.g. the sub-bands of
+        # a polychromatic acquisition) share the same operator
+        key = (shapein, self.sampling.period, factor,
+               _array_key(self.sigma),
+               _array_key(self.instrument.detector.fknee),
+               _array_key(self.instrument.detector.fslope),
+               _array_key(self.instrument.detector.ncorr), self.bandwidth,
+               _array_key(self.psd), self.twosided, fftw_flag, nthreads)
+        with _INVNTT_LOCK:
+            try:
+                out = _INVNTT_CACHE.pop(key)
+            except KeyError:
+                out = self._get_invntt_operator_nocache(
+                    shapein, factor, fftw_flag, nthreads)
+            _INVNTT_CACHE[key] = out
+            while len(_INVNTT_CACHE) > self.INVNTT_CACHE_SIZE:
+                _INVNTT_CACHE.popitem(last=False)
+        return out
+
+    def _get_invntt_operator_nocache(self, shapein, factor, fftw_flag,
+                                     nthreads):
         sampling_frequency = 1 / self.sampling.period
 
         nsamples_max = len(self.sampling)
@@ -307,22 +348,35 @@ class QubicAcquisition(Acquisition):
 
         new_bandwidth = sampling_frequency / fftsize
         if self.bandwidth is not None and self.psd is not None:
-            if self.twosided:
-                self.psd = _fold_psd(self.psd)
+            psd = _fold_psd(self.psd) if self.twosided else self.psd
             f = np.arange(fftsize // 2 + 1, dtype=float) * new_bandwidth
-            p = _unfold_psd(_logloginterp_psd(f, self.bandwidth, self.psd))
+            p = _unfold_psd(_logloginterp_psd(f, self.bandwidth, psd))
         else:
             p = _gaussian_psd_1f(fftsize, sampling_frequency, self.sigma, self.instrument.detector.fknee,
                                  self.instrument.detector.fslope, twosided=True)
         p[..., 0] = p[..., 1]
+
+        if pyfftw is not None:
+            _load_fftw_wisdom()
         invntt = _psd2invntt(p, new_bandwidth, self.instrument.detector.ncorr, fftw_flag=fftw_flag)
+        if factor != 1:
+            invntt /= factor
+        out = SymmetricBandToeplitzOperator(shapein, invntt, fftw_flag=fftw_flag, nthreads=nthreads)
+        if pyfftw is not None:
+            _save_fftw_wisdom()
+        # the operator does not keep its first rows, from which the
+        # preconditioner takes the diagonal
+        out.firstrow = invntt
+        return out
 
-        print('non diagonal case')
-        if self.effective_duration is not None:
-            nsamplings = self.comm.allreduce(len(self.sampling))
-            invntt /= (nsamplings * self.sampling.period / (self.effective_duration * 31557600))
+    @staticmethod
+    def clear_invntt_cache():
+        """
+        Clear the cache of inverse noise covariance operators.
 
-        return SymmetricBandToeplitzOperator(shapein, invntt, fftw_flag=fftw_flag, nthreads=nthreads)
+        """
+        with _INVNTT_LOCK:
+            _INVNTT_CACHE.clear()
 
     get_invntt_operator.__doc__ = Acquisition.get_invntt_operator.__doc__
 
@@ -341,17 +395,24 @@ class QubicAcquisition(Acquisition):
         nu = self.instrument.filter.nu
         return self.scene.get_unit_conversion_operator(nu)
 
-    def get_operator(self):
+    def get_operator(self, projection=None):
         """
         Return the operator of the acquisition. Note that the operator is only
         linear if the scene temperature is differential (absolute=False).
 
+        Parameter
+        ---------
+        projection : Operator, optional
+            The peak sampling operator, if it has already been computed, for
+            instance as a subset of the projection of a larger acquisition.
+
         """
         distribution = self.get_distribution_operator()
         temp = self.get_unit_conversion_operator()
         aperture = self.get_aperture_integration_operator()
         filter = self.get_filter_operator()
-        projection = self.get_projection_operator()
+        if projection is None:
+            projection = self.get_projection_operator()
         hwp = self.get_hwp_operator()
         polarizer = self.get_polarizer_operator()
         integ = self.get_detector_integration_operator()
@@ -393,15 +454,16 @@ class QubicAcquisition(Acquisition):
                 [f(self.sampling[b], self.scene, verbose=verbose)
                  for b in self.block], axisout=1)
 
-        # XXX HACK
-        def callback(i):
-            p = f(self.sampling[self.block[i]], self.scene, verbose=False)
-            return p
-
-        shapeouts = [(len(self.instrument), s.stop - s.start) +
-                     self.scene.shape[1:] for s in self.block]
-        proxies = proxy_group(len(self.block), callback, shapeouts=shapeouts)
-        return BlockColumnOperator(proxies, axisout=1)
+        # the matrix is too large to be stored: the matrix of each block is
+        # computed on the fly, in a buffer shared by the blocks
+        operands = []
+        buffer = None
+        for b in self.block:
+            p = f(self.sampling[b], self.scene, verbose=verbose,
+                  nsamples_chunk=b.stop - b.start, buffer=buffer)
+            buffer = p.buffer
+            operands.append(p)
+        return BlockColumnOperator(operands, axisout=1)
 
     def get_add_grids_operator(self):
         """ Return operator to add signal from detector pairs. """
@@ -457,22 +519,151 @@ class QubicAcquisition(Acquisition):
 
         return tod
 
-    def tod2map(self, tod, d, cov=None):
+    def get_noise_generator(self, seed=None):
         """
-        Reconstruct map from tod
+        Return a NoiseGenerator drawing the acquisition noise by blocks of
+        time samples, with the detector 1/f noise and, if the photon_noise
+        attribute is set, the white photon noise.
+
+        Parameter
+        ---------
+        seed : int, optional
+            The seed of the noise realization.
+
         """
-        tol = d['tol']
-        maxiter = d['maxiter']
-        verbose = d['verbose']
+        noise = self.instrument.get_noise_generator(
+            self.sampling, self.scene, photon_noise=self.photon_noise,
+            seed=seed)
+        if self.effective_duration is not None:
+            nsamplings = self.comm.allreduce(len(self.sampling))
+            factor = np.sqrt(nsamplings * self.sampling.period /
+                             (self.effective_duration * 31557600))
+            noise.sigma *= factor
+            noise.sigma_white *= factor
+        return noise
+
+    def get_observation_chunks(self, map, nsamples_chunk, convolution=True,
+                               noiseless=False, seed=None):
+        """
+        Generator of the Time-Ordered-Data by blocks of time samples, to
+        simulate acquisitions whose TOD does not fit in memory.
 
-        H = self.get_operator()
-        invntt = self.get_invntt_operator()
+        for start, stop, tod in acq.get_observation_chunks(map, 100000):
+            out[:, start:stop] = tod
 
-        A = H.T * invntt * H
-        b = H.T * invntt * tod
+        Only the operator of the current block is computed. The noise is
+        drawn by a NoiseGenerator, so that the 1/f correlations are
+        continuous across the blocks, and the detector response is
+        evaluated with a margin of samples before each block.
 
-        preconditioner = self.get_preconditioner(cov)
-        solution = pcg(A, b, M=preconditioner, disp=verbose, tol=tol, maxiter=maxiter)
+        Parameters
+        ----------
+        map : I, QU or IQU maps
+            Temperature, QU or IQU maps of shapes npix, (npix, 2), (npix, 3)
+            with npix = 12 * nside**2
+        nsamples_chunk : int
+            The number of time samples of the blocks.
+        convolution : boolean, optional
+            Set to True to convolve the input map by a gaussian.
+        noiseless : boolean, optional
+            If True, no noise is added to the observation.
+        seed : int, optional
+            The seed of the noise realization.
+
+        Yields
+        ------
+        start, stop : int
+            The time samples of the block are start:stop.
+        tod : array
+            The Time-Ordered-Data of shape (ndetectors, stop - start).
+
+        """
+        if convolution:
+            map = self.get_convolution_peak_operator()(map)
+        nsamplings = len(self.sampling)
+        tau = np.max(self.instrument.detector.tau)
+        margin = int(np.ceil(20 * tau / self.sampling.period))
+        if not noiseless:
+            noise = self.get_noise_generator(seed=seed)
+
+        for start in range(0, nsamplings, nsamples_chunk):
+            stop = min(start + nsamples_chunk, nsamplings)
+            start_ = max(start - margin, 0)
+            acq = self[:, start_:stop]
+            acq.block = (slice(0, stop - start_),)
+            tod = acq.get_operator()(map)[:, start - start_:]
+            if not noiseless:
+                tod += noise(stop - start)
+            yield start, stop, tod
+
+    def write_observation(self, out, map, nsamples_chunk, convolution=True,
+                          noiseless=False, seed=None):
+        """
+        Write the Time-Ordered-Data into a sink, block by block, see
+        get_observation_chunks.
+
+        Parameters
+        ----------
+        out : str or array-like
+            The sink of shape (ndetectors, ntimes). It can be a numpy memory
+            map, an h5py dataset or any object supporting the assignment
+            out[:, start:stop] = tod. If a file name is given, a numpy .npy
+            memory map is created.
+        map : I, QU or IQU maps
+            Temperature, QU or IQU maps of shapes npix, (npix, 2), (npix, 3)
+            with npix = 12 * nside**2
+        nsamples_chunk : int
+            The number of time samples of the blocks.
+        convolution : boolean, optional
+            Set to True to convolve the input map by a gaussian.
+        noiseless : boolean, optional
+            If True, no noise is added to the observation.
+        seed : int, optional
+            The seed of the noise realization.
+
+        Returns
+        -------
+        out : array-like
+            The sink.
+
+        """
+        shape = (len(self.instrument), len(self.sampling))
+        if isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', shape=shape)
+        elif tuple(out.shape) != shape:
+            raise ValueError(
+                'Invalid sink shape {0}. Expected shape is {1}.'.format(
+                    tuple(out.shape), shape))
+        for start, stop, tod in self.get_observation_chunks(
+                map, nsamples_chunk, convolution=convolution,
+                noiseless=noiseless, seed=seed):
+            out[:, start:stop] = tod
+        if hasattr(out, 'flush'):
+            out.flush()
+        return out
+
+    def tod2map(self, tod, d, cov=None):
+        """
+        Reconstruct map from tod. If the dictionary has a 'checkpoint' file
+        name, the solver state is saved every 'checkpoint_interval'
+        iterations (default 10) and the solve is resumed from the checkpoint
+        file if it exists (see pcg_checkpoint).
+
+        The tod can also be a stack of TODs sharing the pointing, such as
+        Monte-Carlo noise realizations, of shape (nrealizations, ndetectors,
+        nsamples). The operators are then built once and reused for each
+        TOD (see pcg_multi), and the maps, the numbers of iterations and
+        the errors are stacked in the same order.
+        """
+        projection = self.get_projection_operator()
+        H = self.get_operator(projection=projection)
+        invntt = self.get_invntt_operator()
+
+        if cov is None:
+            preconditioner = self.get_block_preconditioner(invntt, projection)
+        else:
+            preconditioner = self.get_preconditioner(cov)
+        solution = _pcg_tod2map(H, invntt, tod, preconditioner, d)
         return solution['x'], solution['nit'], solution['error']
 
     def get_preconditioner(self, cov):
@@ -484,6 +675,124 @@ class QubicAcquisition(Acquisition):
             preconditioner = None
         return preconditioner
 
+    def get_block_preconditioner(self, invntt=None, projection=None):
+        """
+        Return the block-Jacobi preconditioner, i.e. the inverse of the
+        per-pixel diagonal blocks of H^T N^-1 H (see
+        get_preconditioner_blocks). Unlike the inverse coverage, it accounts
+        for the coupling between the I, Q and U components of each pixel.
+        The blocks which are too ill-conditioned to be inverted (degenerate
+        polarization angles) are replaced by their diagonal.
+
+        Parameters
+        ----------
+        invntt : Operator, optional
+            The inverse noise covariance operator. By default, the one
+            returned by get_invntt_operator is used.
+        projection : Operator, optional
+            The peak sampling operator, if it has already been computed.
+
+        """
+        blocks = _invert_blocks(
+            self.get_preconditioner_blocks(invntt, projection))
+        if blocks.shape[-1] == 1:
+            return DiagonalOperator(blocks[..., 0, 0], broadcast='rightward')
+        return DenseBlockDiagonalOperator(
+            blocks, shapein=(len(self.scene),) +
+            self.scene.shape[self.scene.ndim:])
+
+    def get_preconditioner_blocks(self, invntt=None, projection=None):
+        """
+        Return the per-pixel diagonal blocks of H^T N^-1 H, as an array of
+        shape (npixels, ncomponents, ncomponents). They are accumulated in
+        one pass over the sparse peak sampling matrix, by blocks of time
+        samples. The detector time response is not included and N^-1 is
+        approximated by its diagonal.
+
+        Parameters
+        ----------
+        invntt : Operator, optional
+            The inverse noise covariance operator. By default, the one
+            returned by get_invntt_operator is used.
+        projection : Operator, optional
+            The peak sampling operator, if it has already been computed.
+
+        """
+        from .instrument import (
+            _get_projection_chunks, _merge_projection_rows)
+        if invntt is None:
+            invntt = self.get_invntt_operator()
+        if projection is None:
+            projection = self.get_projection_operator(verbose=False)
+        ndetectors = len(self.instrument)
+        npixels = len(self.scene)
+        ncomps = len(self.scene.kind)
+        weights = _get_invntt_diagonal(invntt, ndetectors)
+
+        # the operators on the right of the projection are diagonal
+        sky = CompositionOperator([
+            self.get_filter_operator(),
+            self.get_aperture_integration_operator(),
+            self.scene.atmosphere.transmission,
+            self.get_unit_conversion_operator()])
+        scale = np.asarray(sky(np.ones(
+            (npixels,) + self.scene.shape[self.scene.ndim:]))).reshape(
+                (npixels, ncomps))
+
+        blocks = np.zeros((npixels, ncomps, ncomps))
+        for start, stop, p in _get_projection_chunks(projection):
+            ntimes = stop - start
+            data = p.matrix.data.reshape((ndetectors, ntimes, -1))
+            # process the samples by groups to bound the memory footprint
+            ngroup = max(1, 2**22 // (ndetectors * max(data.shape[-1],
+                                                       ncomps)))
+            for t in range(start, stop, ngroup):
+                t_ = slice(t - start, min(t + ngroup, stop) - start)
+                data_ = _merge_projection_rows(
+                    data[:, t_].reshape((-1, data.shape[-1])))
+                coefs = self._get_detector_coefficients(
+                    self.sampling[t:min(t + ngroup, stop)])
+                _accumulate_blocks(
+                    blocks, data_, self.scene.kind,
+                    coefs.reshape((-1, ncomps)),
+                    np.repeat(weights, t_.stop - t_.start), scale)
+
+        self.comm.Allreduce(MPI.IN_PLACE, as_mpi(blocks), op=MPI.SUM)
+        for i in range(ncomps):
+            for j in range(i):
+                blocks[:, i, j] = blocks[:, j, i]
+        return blocks
+
+    def _get_detector_coefficients(self, sampling):
+        """
+        Return the coefficients of the sample-wise operators on the left of
+        the projection, for each Stokes component, as an array of shape
+        (ndetectors, len(sampling), ncomponents). They are obtained by
+        applying the operators to each Stokes component.
+
+        """
+        operators = [
+            self.instrument.get_hwp_operator(sampling, self.scene),
+            self.instrument.get_polarizer_operator(sampling, self.scene),
+            self.instrument.get_detector_integration_operator(),
+            self.instrument.get_transmission_operator()]
+
+        def det(x):
+            for operator in operators:
+                x = operator(x)
+            return np.asarray(x)
+        shape = (len(self.instrument), len(sampling))
+        ncomps = len(self.scene.kind)
+        if ncomps == 1:
+            return det(np.ones(shape))[..., None]
+        out = np.empty(shape + (ncomps,))
+        e = np.zeros(shape + (ncomps,))
+        for icomp in range(ncomps):
+            e[...] = 0
+            e[..., icomp] = 1
+            out[..., icomp] = det(e)
+        return out
+
 
 class PlanckAcquisition(object):
     def __init__(self, band, scene, true_sky=None, factor=1, fwhm=0, mask=None, convolution_operator=None):
@@ -656,3 +965,135 @@ class QubicPlanckAcquisition(object):
         if convolution:
             return obs, obs_qubic_[1]
         return obs
+
+
+def _load_fftw_wisdom():
+    """
+    Import once the FFTW wisdom stored in the pyoperators wisdom files.
+
+    """
+    global _FFTW_WISDOM
+    if _FFTW_WISDOM is not None:
+        return
+    wisdom = []
+    for filename in FFTW_WISDOM_FILES:
+        try:
+            with open(filename, 'rb') as f:
+                wisdom.append(f.read())
+        except (IOError, OSError):
+            wisdom.append(b'')
+    pyfftw.import_wisdom(wisdom)
+    _FFTW_WISDOM = pyfftw.export_wisdom()
+
+
+def _save_fftw_wisdom():
+    """
+    Write the FFTW wisdom in the pyoperators wisdom files, if new plans have
+    been created since it was last imported or saved.
+
+    """
+    global _FFTW_WISDOM
+    wisdom = pyfftw.export_wisdom()
+    if wisdom == _FFTW_WISDOM:
+        return
+    for filename, w in zip(FFTW_WISDOM_FILES, wisdom):
+        if len(w) == 0:
+            continue
+        try:
+            with open(filename, 'wb') as f:
+                f.write(w)
+        except (IOError, OSError):
+            return
+    _FFTW_WISDOM = wisdom
+
+
+def _array_key(x):
+    """ Return a hashable representation of a scalar or an array. """
+    if x is None:
+        return None
+    x = np.asarray(x)
+    return x.dtype.str, x.shape, x.tobytes()
+
+
+def _get_invntt_diagonal(invntt, ndetectors):
+    """
+    Return the diagonal of an inverse noise covariance operator, assumed to
+    be stationary, as an array of shape (ndetectors,). For the band-Toeplitz
+    operators built by QubicAcquisition, it is the first element of their
+    first rows. Otherwise, it is the response of the operator to a unit
+    impulse, which requires a TOD-sized array.
+
+    """
+    if isinstance(invntt, BlockDiagonalOperator):
+        invntt = invntt.operands[0]
+    firstrow = getattr(invntt, 'firstrow', None)
+    if firstrow is not None:
+        diagonal = np.asarray(firstrow)[..., 0]
+    elif isinstance(invntt, DiagonalOperator):
+        diagonal = np.asarray(invntt.data)
+        if diagonal.ndim > 1:
+            diagonal = diagonal.reshape((ndetectors, -1)).mean(axis=-1)
+    elif isinstance(invntt, SymmetricBandToeplitzOperator):
+        impulse = np.zeros(invntt.shapein)
+        impulse[..., 0] = 1
+        diagonal = invntt(impulse)[..., 0]
+    else:
+        raise TypeError(
+            "The diagonal of the inverse noise covariance operator of type "
+            "'{0}' cannot be computed.".format(type(invntt).__name__))
+    return np.array(np.broadcast_to(diagonal, (ndetectors,)), float)
+
+
+def _accumulate_blocks(blocks, data, kind, coefs, weights, scale):
+    """
+    Add to the per-pixel blocks the contributions w w^T of the entries of
+    the peak sampling matrix data (one row per sample), where w is the
+    transpose of the entry rotation block applied to the sample Stokes
+    coefficients, scaled by the sky-side diagonal operators.
+
+    """
+    npixels, ncomps = scale.shape
+    index = data['index']
+    valid = index >= 0
+    index = index[valid]
+    c = [np.broadcast_to(coefs[:, i, None], valid.shape)[valid]
+         for i in range(ncomps)]
+    if kind == 'I':
+        w = [data['value'][valid] * c[0]]
+    elif kind == 'QU':
+        r11 = data['r11'][valid]
+        r21 = data['r21'][valid]
+        w = [r11 * c[0] + r21 * c[1], r11 * c[1] - r21 * c[0]]
+    else:
+        r22 = data['r22'][valid]
+        r32 = data['r32'][valid]
+        w = [data['r11'][valid] * c[0], r22 * c[1] + r32 * c[2],
+             r22 * c[2] - r32 * c[1]]
+    weights = np.broadcast_to(weights[:, None], valid.shape)[valid]
+    for i in range(ncomps):
+        w[i] *= scale[index, i]
+    for i in range(ncomps):
+        for j in range(i, ncomps):
+            blocks[:, i, j] += np.bincount(
+                index, weights=weights * w[i] * w[j], minlength=npixels)
+
+
+def _invert_blocks(blocks, rcond=1e-6):
+    """
+    Invert a stack of symmetric positive blocks. The blocks whose condition
+    number is greater than 1/rcond are replaced by the inverse of their
+    diagonal, and the null diagonal elements are left to zero.
+
+    """
+    n = blocks.shape[-1]
+    diag = np.diagonal(blocks, axis1=-2, axis2=-1)
+    out = np.zeros_like(blocks)
+    i = np.arange(n)
+    out[:, i, i] = np.divide(1, diag, out=np.zeros_like(diag),
+                             where=diag > 0)
+    if n == 1:
+        return out
+    eigvals = np.linalg.eigvalsh(blocks)
+    good = eigvals[:, 0] > rcond * eigvals[:, -1]
+    out[good] = np.linalg.inv(blocks[good])
+    return out
@@ -2,13 +2,22 @@
 from __future__ import division, print_function
 
 import healpy as hp
+import hashlib
 import numexpr as ne
 import numpy as np
 import copy
+import inspect
+import multiprocessing
+import operator
+import os
+import tempfile
+import threading
+from collections import OrderedDict
 from pyoperators import (
-    Cartesian2SphericalOperator, DenseBlockDiagonalOperator, DiagonalOperator,
-    IdentityOperator, HomothetyOperator, ReshapeOperator, Rotation2dOperator,
-    Rotation3dOperator, Spherical2CartesianOperator)
+    BlockColumnOperator, Cartesian2SphericalOperator,
+    DenseBlockDiagonalOperator, DiagonalOperator,
+    IdentityOperator, HomothetyOperator, Operator, ReshapeOperator,
+    Rotation2dOperator, Rotation3dOperator, Spherical2CartesianOperator)
 from pyoperators.utils import (
     operation_assignment, pool_threading, product, split)
 from pyoperators.utils.ufuncs import abs2
@@ -24,6 +33,8 @@ from scipy.constants import c, h, k, sigma
 from scipy.integrate import quad
 from . import _flib as flib
 from qubic.calibration import QubicCalibration
+from qubic.noise import NoiseGenerator
+from qubic.samplings import QubicRotation
 from qubic.utils import _compress_mask
 from qubic.ripples import ConvolutionRippledGaussianOperator, BeamGaussianRippled
 from qubic.beams import (BeamGaussian, BeamFitted, MultiFreqBeam)
@@ -58,6 +69,8 @@ class QubicInstrument(Instrument):
 
     """
 
+    PEAK_ANGLES_CACHE_SIZE = 32
+
     def __init__(self, d, FRBW=None):
         """
         d : Input dictionary, from which the following Parameters are read
@@ -105,6 +118,17 @@ class QubicInstrument(Instrument):
         beam_shape: dictionary entry, string
             the shape of the primary and secondary beams:
             'gaussian', 'fitted_beam' or 'multi_freq'
+        projection_cache : str, optional
+            Directory in which the peak projection matrices are stored, so
+            that they can be reopened (memory-mapped) instead of recomputed
+            when the same pointing matrix is requested again. The cache is
+            not pruned: each new pointing, scene or detector set adds a file
+            of the size of the matrix, so the directory grows without bound
+            and should be cleaned by the user. The files can be deleted at
+            any time, they are recomputed when needed.
+        nthreads : int, optional
+            Number of threads used to compute the projection matrices. By
+            default, all the cores are used.
 
         """
         self.debug = d['debug']  # if True allows debuging prints
@@ -178,6 +202,8 @@ class QubicInstrument(Instrument):
 
         self.ripples = ripples
         self.nripples = nripples
+        self.projection_cache = d.get('projection_cache')
+        self.nthreads = d.get('nthreads')
         self._init_beams(primary_shape, secondary_shape, filter_nu)
         self._init_filter(filter_nu, filter_relative_bandwidth)
         self._init_horns(filter_nu)
@@ -295,26 +321,87 @@ class QubicInstrument(Instrument):
     __repr__ = __str__
 
     def get_noise(self, sampling, scene, photon_noise=True, out=None,
-                  operation=operation_assignment):
+                  operation=operation_assignment, seed=None):
         """
-        Return a noisy timeline.
+        Return a noisy timeline (#det, #sampling), with the detector 1/f noise
+        and, optionally, the photon noise. See get_noise_generator.
+
+        Unlike the former generation of the whole timeline in Fourier space,
+        the 1/f noise is obtained with a filter kernel of at most
+        NoiseGenerator.NCORR_MAX samples (2**14, i.e. 819 s at 20 Hz), and
+        its power spectrum is flat below 1 / (ncorr * period). The cap is a
+        class attribute that can be raised, for instance to the number of
+        samples, to recover the 1/f power down to fknee / 1000, at the cost
+        of a memory footprint growing linearly with ncorr.
+
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The sampling.
+        scene : QubicScene
+            The scene, used to compute the photon noise.
+        photon_noise : boolean, optional
+            If true, the photon noise contribution is included.
+        out : ndarray, optional
+            Placeholder for the output noise.
+        operation : function, optional
+            The operation combining the noise and the output, such as
+            operation_assignment or operation_add.
+        seed : int, optional
+            The seed of the noise realization. For a given seed, the noise
+            does not depend on the MPI distribution of the acquisition.
 
         """
-        if out is None:
-            out = np.empty((len(self), len(sampling)))
-        self.get_noise_detector(sampling, out=out)
-        if photon_noise:
-            out += self.get_noise_photon(sampling, scene)
-        return out
+        noise = self.get_noise_generator(
+            sampling, scene, photon_noise=photon_noise, seed=seed)
+        return _fill_noise(noise, len(sampling), out, operation)
 
-    def get_noise_detector(self, sampling, out=None):
+    def get_noise_detector(self, sampling, out=None, seed=None):
         """
         Return the detector noise (#det, #sampling).
 
         """
-        return Instrument.get_noise(
-            self, sampling, nep=self.detector.nep, fknee=self.detector.fknee,
-            fslope=self.detector.fslope, out=out)
+        noise = self.get_noise_generator(sampling, None, photon_noise=False,
+                                         seed=seed)
+        return _fill_noise(noise, len(sampling), out, operation_assignment)
+
+    def get_noise_generator(self, sampling, scene, photon_noise=True,
+                            seed=None):
+        """
+        Return the NoiseGenerator of the detector 1/f noise and, optionally,
+        of the white photon noise, for all the detectors at once. The random
+        streams are those of the global detector indices, and the generator
+        is advanced to the global time offset of the sampling, so that the
+        realization does not depend on the MPI distribution. The 1/f
+        component is flat below 1 / (NoiseGenerator.NCORR_MAX * period),
+        see get_noise.
+
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The sampling.
+        scene : QubicScene
+            The scene, used to compute the photon noise.
+        photon_noise : boolean, optional
+            If true, the photon noise contribution is included.
+        seed : int, optional
+            The seed of the noise realization.
+
+        """
+        period = sampling.period
+        sigma_detector = self.detector.nep / np.sqrt(2 * period)
+        if photon_noise:
+            sigma_photon = self._get_noise_photon_nep(scene) / \
+                           np.sqrt(2 * period)
+        else:
+            sigma_photon = 0
+        noise = NoiseGenerator(
+            len(self), period, sigma_detector, fknee=self.detector.fknee,
+            fslope=self.detector.fslope, sigma_white=sigma_photon, seed=seed,
+            detectors=self.detector.index)
+        if len(sampling) > 0:
+            noise.skip(int(sampling.index[0]))
+        return noise
 
     def get_noise_photon(self, sampling, scene, out=None):
         """
@@ -414,10 +501,7 @@ class QubicInstrument(Instrument):
             nu_up = 168e9
             # back to back horns, as seen by the detectors through the combiner
             T = temperatures[ib2b]
-            b = h * nu_up / k / T
-            I1 = quad(funct, 0, b, (4, 1))[0]
-            I2 = quad(funct, 0, b, (4, 2))[0]
-            K1 = quad(funct, 0, b, (3, 1))[0]
+            I1, I2, K1 = _get_planck_integrals(h * nu_up / k / T)
             eta = (emissivities * tr_prod)[ib2b] * self.detector.efficiency
             # Here the physical horn area S_horns must be used
             NEP_phot2[ib2b] = 2 * gp[ib2b] * eta * (k * T) ** 5 / c ** 2 / h ** 3 * \
@@ -441,93 +525,36 @@ class QubicInstrument(Instrument):
                 print('Environment T =', temperatures[ib2b],
                       'K, P = {0:.2e} W'.format(P_phot_env.max()),
                       ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2_env).max()) + '  W/sqrt(Hz)')
-            # Combiner
+            # Combiner, cold stop low pass edge, dichroic (FI only), neutral
+            # density filter and the two before last low pass edges
             icomb = ib2b + 1  # the combiner is the component just after the horns
-            T = temperatures[icomb]
-            b = h * nu_up / k / T
-            J1 = quad(funct, 0, b, (4, 1))[0]
-            J2 = quad(funct, 0, b, (4, 2))[0]
-            L1 = quad(funct, 0, b, (3, 1))[0]
-            eta = (emissivities * tr_prod)[icomb] * self.detector.efficiency
-            NEP_phot2[icomb] = 2 * gp[icomb] * eta * (k * T) ** 5 / c ** 2 / h ** 3 * \
-                               (J1 + eta * J2) * S_det * omega_comb * sec_beam
-            P_phot[icomb] = gp[icomb] * eta * (k * T) ** 4 / c ** 2 / h ** 3 * L1 * \
-                            S_det * omega_comb * sec_beam
-            if self.debug:
-                print(names[icomb], ', T=', temperatures[icomb],
-                      'K, P = {0:.2e} W'.format(P_phot[icomb].max()),
-                      ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[icomb]).max()) + '  W/sqrt(Hz)')
-            # cold stop low pass edge
             ics = icomb + 1
-            T = temperatures[ics]
-            b = h * nu_up / k / T
-            J1 = quad(funct, 0, b, (4, 1))[0]
-            J2 = quad(funct, 0, b, (4, 2))[0]
-            L1 = quad(funct, 0, b, (3, 1))[0]
-            eta = (emissivities * tr_prod)[ics] * self.detector.efficiency
-            NEP_phot2[ics] = 2 * gp[ics] * eta * (k * T) ** 5 / c ** 2 / h ** 3 * \
-                             (J1 + eta * J2) * S_det * omega_coldstop * sec_beam
-            P_phot[ics] = gp[ics] * eta * (k * T) ** 4 / c ** 2 / h ** 3 * L1 * \
-                          S_det * omega_coldstop * sec_beam
-            if self.debug:
-                print(names[ics], ', T=', temperatures[ics],
-                      'K, P = {0:.2e} W'.format(P_phot[ics].max()),
-                      ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[ics]).max()) + '  W/sqrt(Hz)')
-            # Dicroic
             if self.config == 'FI':
                 idic = ics + 1
-                T = temperatures[idic]
-                b = h * nu_up / k / T
-                J1 = quad(funct, 0, b, (4, 1))[0]
-                J2 = quad(funct, 0, b, (4, 2))[0]
-                L1 = quad(funct, 0, b, (3, 1))[0]
-                eta = (emissivities * tr_prod)[idic] * self.detector.efficiency
-                NEP_phot2[idic] = 2 * gp[idic] * eta * (k * T) ** 5 / c ** 2 / h ** 3 * \
-                                  (J1 + eta * J2) * S_det * omega_dichro * sec_beam
-                P_phot[idic] = gp[idic] * eta * (k * T) ** 4 / c ** 2 / h ** 3 * L1 * \
-                               S_det * omega_dichro * sec_beam
-                if self.debug:
-                    print(names[idic], ', T=', temperatures[idic],
-                          'K, P = {0:.2e} W'.format(P_phot[idic].max()),
-                          ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[idic]).max()) + '  W/sqrt(Hz)')
-                # Neutral density filter
                 indf = idic + 1
+                omegas = [omega_comb, omega_coldstop, omega_dichro]
             else:
                 indf = ics + 1
-            if emissivities[indf] == 0.0:
-                P_phot[indf] = 0.0
-                NEP_phot2[indf] = 0.0
-            else:
-                T = temperatures[indf]
-                b = h * nu_up / k / T
-                J1 = quad(funct, 0, b, (4, 1))[0]
-                J2 = quad(funct, 0, b, (4, 2))[0]
-                L1 = quad(funct, 0, b, (3, 1))[0]
-                eta = (emissivities * tr_prod)[indf] * self.detector.efficiency
-                NEP_phot2[indf] = 2 * gp[indf] * eta * (k * T) ** 5 / c ** 2 / h ** 3 * \
-                                  (J1 + eta * J2) * S_det * np.pi * sec_beam
-                P_phot[indf] = gp[indf] * eta * (k * T) ** 4 / c ** 2 / h ** 3 * L1 * \
-                               S_det * np.pi * sec_beam
-                if self.debug:
-                    print(names[indf], ', T=', temperatures[indf],
-                          'K, P = {0:.2e} W'.format(P_phot[indf].max()),
-                          ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[indf]).max()) + '  W/sqrt(Hz)')
-            # The two before last low pass Edges
-            for i in range(indf + 1, indf + 3):
-                T = temperatures[i]
-                b = h * nu_up / k / T
-                J1 = quad(funct, 0, b, (4, 1))[0]
-                J2 = quad(funct, 0, b, (4, 2))[0]
-                L1 = quad(funct, 0, b, (3, 1))[0]
-                eta = (emissivities * tr_prod)[i] * self.detector.efficiency
-                NEP_phot2[i] = 2 * gp[i] * eta * (k * T) ** 5 / c ** 2 / h ** 3 * \
-                               (J1 + eta * J2) * S_det * np.pi * sec_beam
-                P_phot[i] = gp[i] * eta * (k * T) ** 4 / c ** 2 / h ** 3 * L1 * \
-                            S_det * np.pi * sec_beam
-                if self.debug:
-                    print(names[i], ', T=', temperatures[i],
-                          'K, P = {0:.2e} W'.format(P_phot[i].max()),
-                          ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[i]).max()) + '  W/sqrt(Hz)')
+                omegas = [omega_comb, omega_coldstop]
+            omegas = np.array(omegas + 3 * [np.pi])[:, None]
+            icomps = np.arange(icomb, indf + 3)
+            i = icomps[-1]
+            T = temperatures[icomps, None]
+            J1, J2, L1 = np.array(
+                [_get_planck_integrals(h * nu_up / k / T_) if em != 0 else
+                 (0, 0, 0) for T_, em in zip(T[:, 0], emissivities[icomps])]
+            ).T[..., None]
+            eta = (emissivities * tr_prod)[icomps, None] * \
+                  self.detector.efficiency
+            fac = gp[icomps, None] * eta * (k * T) ** 4 / c ** 2 / h ** 3 * \
+                  S_det * omegas * sec_beam
+            NEP_phot2[icomps] = 2 * fac * k * T * (J1 + eta * J2)
+            P_phot[icomps] = fac * L1
+            if self.debug:
+                for j in icomps:
+                    print(names[j], ', T=', temperatures[j],
+                          'K, P = {0:.2e} W'.format(P_phot[j].max()),
+                          ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[j]).max()) + '  W/sqrt(Hz)')
 
         else:  # 220 GHz
             # back to back horns, as seen by the detectors through the combiner   
@@ -564,68 +591,32 @@ class QubicInstrument(Instrument):
                 print('Environment, T =', temperatures[ib2b],
                       'K, P = {0:.2e} W'.format(P_phot_env.max()),
                       ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2_env).max()) + ' W/sqrt(Hz)')
-            # combiner
-            icomb = ib2b + 1
-            g[icomb] = gp[icomb] * S_det * omega_comb * (nu / c) ** 2 * dnu
+            # combiner, coldstop, dichroic and last three filters
             # The combiner emissivity includes the fact that there are 2
             # mirrors
-            P_phot[icomb] = emissivities[icomb] * tr_prod[icomb] * h * nu / \
-                            (np.exp(h * nu / k / temperatures[icomb]) - 1) * g[icomb] * \
-                            self.detector.efficiency
-            NEP_phot2_nobunch[icomb] = h * nu * P_phot[icomb] * 2
-            NEP_phot2[icomb] = NEP_phot2_nobunch[icomb] * (1 + P_phot[icomb] /
-                                                           (h * nu * g[icomb]))
-            if self.debug:
-                print(names[icomb],
-                      ', T=', temperatures[icomb],
-                      'K, P = {0:.2e} W'.format(P_phot[icomb].max()),
-                      ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[icomb]).max()) + ' W/sqrt(Hz)')
-            # coldstop
+            icomb = ib2b + 1
             ics = icomb + 1
-            g[ics] = gp[ics] * S_det * omega_coldstop * (nu / c) ** 2 * dnu
-            P_phot[ics] = emissivities[ics] * tr_prod[ics] * h * nu / \
-                          (np.exp(h * nu / k / temperatures[ics]) - 1) * g[ics] * \
-                          self.detector.efficiency
-            NEP_phot2_nobunch[ics] = h * nu * P_phot[ics] * 2
-            NEP_phot2[ics] = NEP_phot2_nobunch[ics] * (1 + P_phot[ics] /
-                                                       (h * nu * g[ics]))
-            if self.debug:
-                print(names[ics],
-                      ', T=', temperatures[ics],
-                      'K, P = {0:.2e} W'.format(P_phot[ics].max()),
-                      ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[ics]).max()) + ' W/sqrt(Hz)')
-            # dichroic
             idic = ics + 1
-            g[idic] = gp[idic] * S_det * omega_dichro * (nu / c) ** 2 * dnu
-            P_phot[idic] = emissivities[idic] * tr_prod[idic] * h * nu / \
-                           (np.exp(h * nu / k / temperatures[idic]) - 1) * g[idic] * \
-                           self.detector.efficiency
-            NEP_phot2_nobunch[idic] = h * nu * P_phot[idic] * 2
-            NEP_phot2[idic] = NEP_phot2_nobunch[idic] * (1 + P_phot[idic] /
-                                                         (h * nu * g[idic]))
+            icomps = np.arange(icomb, idic + 4)
+            i = icomps[-1]
+            omegas = np.array([omega_comb, omega_coldstop] +
+                              4 * [omega_dichro])[:, None]
+            seen = emissivities[icomps] != 0
+            icomps_ = icomps[seen]
+            g[icomps_] = gp[icomps_, None] * S_det * omegas[seen] * \
+                         (nu / c) ** 2 * dnu
+            P_phot[icomps_] = (emissivities * tr_prod * h * nu)[icomps_, None] / \
+                              (np.exp(h * nu / k / temperatures[icomps_, None]) - 1) * \
+                              g[icomps_] * self.detector.efficiency
+            NEP_phot2_nobunch[icomps_] = h * nu * P_phot[icomps_] * 2
+            NEP_phot2[icomps_] = NEP_phot2_nobunch[icomps_] * \
+                                 (1 + P_phot[icomps_] / (h * nu * g[icomps_]))
             if self.debug:
-                print(names[idic],
-                      ', T=', temperatures[idic],
-                      'K, P = {0:.2e} W'.format(P_phot[idic].max()),
-                      ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[idic]).max()) + ' W/sqrt(Hz)')
-            # Last three filters
-            for i in range(idic + 1, idic + 4):
-                if emissivities[i] == 0.0:
-                    P_phot[i] = 0.0
-                    NEP_phot2[i] = 0.0
-                else:
-                    g[i] = gp[i] * S_det * omega_dichro * (nu / c) ** 2 * dnu
-                    P_phot[i] = emissivities[i] * tr_prod[i] * h * nu / \
-                                (np.exp(h * nu / k / temperatures[i]) - 1) * g[i] * \
-                                self.detector.efficiency
-                    NEP_phot2_nobunch[i] = h * nu * P_phot[i] * 2
-                    NEP_phot2[i] = NEP_phot2_nobunch[i] * (1 + P_phot[i] /
-                                                           (h * nu * g[i]))
-                    if self.debug:
-                        print(names[i],
-                              ', T=', temperatures[i],
-                              'K, P = {0:.2e} W'.format(P_phot[i].max()),
-                              ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[i]).max()) + ' W/sqrt(Hz)')
+                for j in icomps_:
+                    print(names[j],
+                          ', T=', temperatures[j],
+                          'K, P = {0:.2e} W'.format(P_phot[j].max()),
+                          ', NEP = {0:.2e}'.format(np.sqrt(NEP_phot2[j]).max()) + ' W/sqrt(Hz)')
         # 5.6 cm EDGE (150 GHz) or Band Defining Filter (220 GHZ)
         ilast = i + 1
         T = temperatures[ilast]
@@ -669,6 +660,95 @@ class QubicInstrument(Instrument):
             del keywords['ripples']
         return HealpixConvolutionGaussianOperator(fwhm=fwhm, **keywords)
 
+    def get_coverage(self, sampling, scene, projection=None):
+        """
+        Return the coverage of the scene pixels, i.e. the sum over the time
+        samples of the intensity of the synthetic beam peaks hitting them,
+        weighted by the detector transmissions, solid angles and polarizer
+        transmissions. It is proportional to the I component of H.T(1),
+        regardless of the time response of the detectors, but the peak
+        hits are directly accumulated from the peak angles and the pointing
+        rotations, without computing the operator chain nor storing the
+        projection matrix.
+
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The pointing information.
+        scene : QubicScene
+            The observed scene.
+        projection : Operator, optional
+            The peak sampling operator, if it has already been computed. If
+            it is not specified but the projection matrix is in the on-disk
+            cache (see the 'projection_cache' parameter), the cached matrix
+            is used.
+
+        """
+        ndetectors = len(self)
+        ntimes = len(sampling)
+        weights = np.ones(ndetectors)
+        weights *= self.get_transmission_operator().data
+        weights *= self.get_detector_integration_operator().data
+        if scene.kind == 'I' and not self.optics.polarizer:
+            weights *= 1 - (self.detector.quadrant - 1) // 4
+        out = np.zeros(len(scene))
+
+        if projection is not None:
+            for start, stop, p in _get_projection_chunks(projection):
+                data = p.matrix.data
+                _accumulate_coverage(
+                    out, data['index'], np.repeat(weights, stop - start)[:, None] *
+                    data[data.dtype.names[1]])
+            return out
+
+        rotation = sampling.get_rotation(
+            'horizontal' if sampling.fix_az else 'galactic')
+        thetas, phis, vals = QubicInstrument._peak_angles(
+            scene, self.filter.nu, self.detector.center, self.synthbeam,
+            getattr(self, 'horn', None), getattr(self, 'primary_beam', None))
+        weights = weights[:, None] * vals
+        if scene.nside > 8192:
+            dtype_index = np.dtype(np.int64)
+        else:
+            dtype_index = np.dtype(np.int32)
+
+        cache = getattr(self, 'projection_cache', None)
+        if cache is not None:
+            filename = _get_projection_cache_filename(
+                cache, rotation.data, scene, thetas, phis, vals,
+                self.synthbeam.dtype, dtype_index)
+            if os.path.exists(filename):
+                index = np.load(filename, mmap_mode='r')['index'].reshape(
+                    (ndetectors, ntimes, -1))
+                for i in range(ndetectors):
+                    _accumulate_coverage(out, index[i], weights[i])
+                return out
+
+        nscene = len(scene)
+        nscenetot = product(scene.shape[:scene.ndim])
+        if nscene != nscenetot:
+            table = np.full(nscenetot, -1, dtype_index)
+            table[scene.index] = np.arange(nscene, dtype=dtype_index)
+        else:
+            table = None
+        thetaphi = _pack_vector(thetas, phis)
+        direction = Spherical2CartesianOperator('zenith,azimuth')(thetaphi)
+        ncolmax = vals.shape[1]
+
+        # the indices are computed by blocks of time samples, to bound the
+        # memory footprint
+        nsamples_chunk = max(1, 2**24 // (ndetectors * ncolmax))
+        index = np.empty((ndetectors, min(nsamples_chunk, ntimes), ncolmax),
+                         dtype_index)
+        for start in range(0, ntimes, nsamples_chunk):
+            stop = min(start + nsamples_chunk, ntimes)
+            index_ = index[:, :stop-start]
+            _fill_peak_indices(index_, rotation[start:stop], direction,
+                               scene.nside, table=table,
+                               nthreads=getattr(self, 'nthreads', None))
+            _accumulate_coverage(out, index_, weights[:, None, :])
+        return out
+
     def get_detector_integration_operator(self):
         """
         Integrate flux density in detector solid angles and take into account
@@ -769,7 +849,8 @@ class QubicInstrument(Instrument):
         return ReshapeOperator((nd, nt, 1), (nd, nt)) * \
                DenseBlockDiagonalOperator(data, shapein=(nd, nt, 3))
 
-    def get_projection_operator(self, sampling, scene, verbose=True):
+    def get_projection_operator(self, sampling, scene, verbose=True,
+                                nsamples_chunk=None, buffer=None):
         """
         Return the peak sampling operator.
         Convert units from W to W/sr.
@@ -782,26 +863,57 @@ class QubicInstrument(Instrument):
             The observed scene.
         verbose : bool, optional
             If true, display information about the memory allocation.
+        nsamples_chunk : int, optional
+            If specified, the projection matrix is not stored, but computed
+            on the fly by blocks of nsamples_chunk time samples (see
+            QubicStreamingProjectionOperator).
+        buffer : array, optional
+            The matrix block buffer of another streaming operator, to be
+            shared with the returned one (only used with nsamples_chunk).
 
         """
         horn = getattr(self, 'horn', None)
         primary_beam = getattr(self, 'primary_beam', None)
 
-        if sampling.fix_az:
-            rotation = sampling.cartesian_horizontal2instrument
-        else:
-            rotation = sampling.cartesian_galactic2instrument
+        rotation = sampling.get_rotation(
+            'horizontal' if sampling.fix_az else 'galactic')
+
+        nthreads = getattr(self, 'nthreads', None)
+        if nsamples_chunk is not None:
+            return QubicStreamingProjectionOperator(
+                rotation, scene, self.filter.nu, self.detector.center,
+                self.synthbeam, horn, primary_beam, nsamples_chunk,
+                verbose=verbose, nthreads=nthreads, buffer=buffer)
 
         return QubicInstrument._get_projection_operator(
             rotation, scene, self.filter.nu, self.detector.center,
-            self.synthbeam, horn, primary_beam, verbose=verbose)
+            self.synthbeam, horn, primary_beam, verbose=verbose,
+            cache=getattr(self, 'projection_cache', None), nthreads=nthreads)
 
     @staticmethod
     def _get_projection_operator(
             rotation, scene, nu, position, synthbeam, horn, primary_beam,
-            verbose=True):
+            verbose=True, cache=None, nthreads=None):
+        """
+        Return the peak sampling operator.
+
+        Parameters
+        ----------
+        cache : str, optional
+            Directory of the on-disk cache of the projection matrices. The
+            matrices are stored as .npy files whose names are a hash of the
+            rotations, the peak angles and values and the scene pixelisation.
+            If the file already exists, it is memory-mapped (copy-on-write)
+            instead of being recomputed. Files are never removed from the
+            cache, which grows by one matrix per new set of inputs.
+        nthreads : int, optional
+            The number of threads used to compute the matrix. By default, all
+            the cores are used.
+
+        """
+        rotation = rotation.data
         ndetectors = position.shape[0]
-        ntimes = rotation.data.shape[0]
+        ntimes = rotation.shape[0]
         nside = scene.nside
 
         thetas, phis, vals = QubicInstrument._peak_angles(
@@ -809,7 +921,6 @@ class QubicInstrument(Instrument):
         ncolmax = thetas.shape[-1]
         thetaphi = _pack_vector(thetas, phis)  # (ndetectors, ncolmax, 2)
         direction = Spherical2CartesianOperator('zenith,azimuth')(thetaphi)
-        e_nf = direction[:, None, :, :]
         if nside > 8192:
             dtype_index = np.dtype(np.int64)
         else:
@@ -821,48 +932,31 @@ class QubicInstrument(Instrument):
         ndims = len(scene.kind)
         nscene = len(scene)
         nscenetot = product(scene.shape[:scene.ndim])
-        s = cls((ndetectors * ntimes * ndims, nscene * ndims), ncolmax=ncolmax,
-                dtype=synthbeam.dtype, dtype_index=dtype_index,
-                verbose=verbose)
+        shape = (ndetectors * ntimes * ndims, nscene * ndims)
+        shapeout = (ndetectors, ntimes) + scene.shape[1:]
+
+        if cache is not None:
+            filename = _get_projection_cache_filename(
+                cache, rotation, scene, thetas, phis, vals,
+                synthbeam.dtype, dtype_index)
+            if os.path.exists(filename):
+                data = np.load(filename, mmap_mode='c')
+                return ProjectionOperator(cls(shape, data=data),
+                                          shapeout=shapeout)
+
+        s = cls(shape, ncolmax=ncolmax, dtype=synthbeam.dtype,
+                dtype_index=dtype_index, verbose=verbose)
 
-        index = s.data.index.reshape((ndetectors, ntimes, ncolmax))
-        c2h = Cartesian2HealpixOperator(nside)
         if nscene != nscenetot:
             table = np.full(nscenetot, -1, dtype_index)
             table[scene.index] = np.arange(len(scene), dtype=dtype_index)
-
-        def func_thread(i):
-            # e_nf[i] shape: (1, ncolmax, 3)
-            # e_ni shape: (ntimes, ncolmax, 3)
-            e_ni = rotation.T(e_nf[i].swapaxes(0, 1)).swapaxes(0, 1)
-            if nscene != nscenetot:
-                np.take(table, c2h(e_ni).astype(int), out=index[i])
-            else:
-                index[i] = c2h(e_ni)
-
-        with pool_threading() as pool:
-            pool.map(func_thread, range(ndetectors))
-
-        if scene.kind == 'I':
-            value = s.data.value.reshape(ndetectors, ntimes, ncolmax)
-            value[...] = vals[:, None, :]
-            shapeout = (ndetectors, ntimes)
         else:
-            if str(dtype_index) not in ('int32', 'int64') or \
-                    str(synthbeam.dtype) not in ('float32', 'float64'):
-                raise TypeError(
-                    'The projection matrix cannot be created with types: {0} a'
-                    'nd {1}.'.format(dtype_index, synthbeam.dtype))
-            func = 'matrix_rot{0}d_i{1}_r{2}'.format(
-                ndims, dtype_index.itemsize, synthbeam.dtype.itemsize)
-            getattr(flib.polarization, func)(
-                rotation.data.T, direction.T, s.data.ravel().view(np.int8),
-                vals.T)
-
-            if scene.kind == 'QU':
-                shapeout = (ndetectors, ntimes, 2)
-            else:
-                shapeout = (ndetectors, ntimes, 3)
+            table = None
+        _fill_projection_matrix(s.data, rotation, direction, vals, nside,
+                                scene.kind, table=table, nthreads=nthreads)
+
+        if cache is not None:
+            _save_projection_cache(filename, s.data)
         return ProjectionOperator(s, shapeout=shapeout)
 
     def get_transmission_operator(self):
@@ -880,6 +974,51 @@ class QubicInstrument(Instrument):
         Compute the angles and intensity of the synthetic beam peaks which
         accounts for a specified energy fraction.
 
+        The results are memoized in a LRU cache of PEAK_ANGLES_CACHE_SIZE
+        entries, keyed by the frequency, the synthetic beam parameters, the
+        horn layout, the detector positions and the primary beam, so that
+        the sub-bands and the acquisition blocks sharing these inputs do not
+        recompute them. The cache is emptied by clear_peak_angles_cache.
+
+        """
+        beam_arrays, beam_scalars = _get_beam_state(primary_beam)
+        key = _get_cache_key(
+            position, horn.center, horn.open, *beam_arrays, nu=nu,
+            kmax=synthbeam.kmax, fraction=synthbeam.fraction,
+            spacing=horn.spacing, angle=horn.angle, nhorns=len(horn),
+            beam=beam_scalars)
+        with _PEAK_ANGLES_LOCK:
+            cached = _PEAK_ANGLES_CACHE.pop(key, None)
+            if cached is not None:
+                _PEAK_ANGLES_CACHE[key] = cached
+        if cached is None:
+            cached = QubicInstrument._peak_angles_nocache(
+                nu, position, synthbeam, horn, primary_beam)
+            with _PEAK_ANGLES_LOCK:
+                _PEAK_ANGLES_CACHE[key] = cached
+                while len(_PEAK_ANGLES_CACHE) > \
+                        QubicInstrument.PEAK_ANGLES_CACHE_SIZE:
+                    _PEAK_ANGLES_CACHE.popitem(last=False)
+        theta, phi, val = cached
+        solid_angle = synthbeam.peak150.solid_angle * (150e9 / nu) ** 2
+        val = val * (solid_angle / scene.solid_angle * len(horn))
+        return theta.copy(), phi.copy(), val
+
+    @staticmethod
+    def clear_peak_angles_cache():
+        """
+        Empty the cache of the synthetic beam peak angles and values.
+
+        """
+        with _PEAK_ANGLES_LOCK:
+            _PEAK_ANGLES_CACHE.clear()
+
+    @staticmethod
+    def _peak_angles_nocache(nu, position, synthbeam, horn, primary_beam):
+        """
+        Compute the angles and the primary beam values of the synthetic beam
+        peaks which account for a specified energy fraction.
+
         """
         theta, phi = QubicInstrument._peak_angles_kmax(
             synthbeam.kmax, horn.spacing, horn.angle, nu, position)
@@ -905,8 +1044,6 @@ class QubicInstrument(Instrument):
             val[idet, imax_:] = 0
             theta[idet, imax_:] = np.pi / 2  # XXX 0 fails in polarization.f90.src (en2ephi and en2etheta_ephi)
             phi[idet, imax_:] = 0
-        solid_angle = synthbeam.peak150.solid_angle * (150e9 / nu) ** 2
-        val *= solid_angle / scene.solid_angle * len(horn)
         return theta, phi, val
 
     @staticmethod
@@ -1003,7 +1140,8 @@ class QubicInstrument(Instrument):
             return A
 
     @staticmethod
-    def _get_response_B(theta, phi, spectral_irradiance, nu, horn, primary_beam):
+    def _get_response_B(theta, phi, spectral_irradiance, nu, horn, primary_beam,
+                        out=None):
         """
         Return the complex electric amplitude and phase [W^(1/2)] from sources
         of specified spectral irradiance [W/m^2/Hz] going through each horn.
@@ -1022,6 +1160,9 @@ class QubicInstrument(Instrument):
             The horn layout.
         primary_beam : Beam
             The primary beam.
+        out : complex array of shape (#horns, #sources), optional
+            Placeholder for the output. Its dtype can be complex64, in which
+            case the result is computed in double precision and then cast.
 
         Returns
         -------
@@ -1036,7 +1177,11 @@ class QubicInstrument(Instrument):
                            primary_beam(theta, phi) * np.pi * horn.radeff ** 2)
         const = 2j * np.pi * nu / c
         product = np.dot(horn[horn.open].center, uvec.T)
-        out = ne.evaluate('source_E * exp(const * product)')
+        if out is None:
+            out = ne.evaluate('source_E * exp(const * product)')
+        else:
+            ne.evaluate('source_E * exp(const * product)', out=out,
+                        casting='same_kind')
         return out.reshape((-1,) + shape)
 
     @staticmethod
@@ -1098,7 +1243,9 @@ class QubicInstrument(Instrument):
     @staticmethod
     def _get_synthbeam(scene, position, area, nu, bandwidth, horn,
                        primary_beam, secondary_beam, synthbeam_dtype=np.float32,
-                       theta_max=45, external_A=None, hwp_position=0):
+                       theta_max=45, external_A=None, hwp_position=0,
+                       integrate=False, max_nbytes=None, complex_dtype=None,
+                       nthreads=None):
         """
         Return the monochromatic synthetic beam for a specified location
         on the focal plane, multiplied by a given area and bandwidth.
@@ -1139,27 +1286,77 @@ class QubicInstrument(Instrument):
             [5] : array, phase on Y with shape (n, nhorns) [rad]
         hwp_position : int
             HWP position from 0 to 7.
+        integrate : boolean, optional
+            If true, the synthetic beams are averaged over the before-last
+            dimension of position, i.e. position has shape (..., npos, 3)
+            and the output has shape (..., #pixels).
+        max_nbytes : float, optional
+            The memory budget in bytes of the complex fields, shared by the
+            threads processing the pixel chunks (default: 1e9).
+        complex_dtype : dtype, optional
+            The dtype of the complex fields (default: complex128). With
+            complex64, the memory footprint is halved and the matrix product
+            is faster, at the cost of single precision synthetic beams.
+        nthreads : int, optional
+            The number of threads processing the pixel chunks. By default,
+            all the cores are used.
 
         """
         MAX_MEMORY_B = 1e9
+        if max_nbytes is None:
+            max_nbytes = MAX_MEMORY_B
+        complex_dtype = np.dtype(complex_dtype or np.complex128)
         theta, phi = hp.pix2ang(scene.nside, scene.index)
         index = np.where(theta <= np.radians(theta_max))[0]
-        nhorn = int(np.sum(horn.open))
         npix = len(index)
-        nbytes_B = npix * nhorn * 24
-        ngroup = int(np.ceil(nbytes_B / MAX_MEMORY_B))
-        out = np.zeros(position.shape[:-1] + (len(scene),),
-                       dtype=synthbeam_dtype)
-        for s in split(npix, ngroup):
+        A = QubicInstrument._get_response_A(
+            position, area, nu, horn, secondary_beam, external_A=external_A,
+            hwp_position=hwp_position).astype(complex_dtype)
+        shape_A = A.shape[:-1]
+        nhorn = A.shape[-1]
+        npos = product(shape_A)
+        A = A.reshape((npos, nhorn))
+        shape = shape_A[:-1] if integrate else shape_A
+        out = np.zeros(shape + (len(scene),), dtype=synthbeam_dtype)
+        if npix == 0:
+            return out
+
+        # per pixel: B, the complex fields, their squared moduli and the
+        # horn-source scalar products
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        nbytes_pix = complex_dtype.itemsize * (nhorn + npos) + \
+            np.dtype(synthbeam_dtype).itemsize * npos + 8 * nhorn
+        npix_chunk = max(int(max_nbytes / nthreads / nbytes_pix), 1)
+        ngroup = min(max(int(np.ceil(npix / npix_chunk)), nthreads), npix)
+        npix_chunk = int(np.ceil(npix / ngroup))
+        local = threading.local()
+
+        def func_thread(s):
+            if not hasattr(local, 'B'):
+                local.B = np.empty(nhorn * npix_chunk, complex_dtype)
+                local.E = np.empty(npos * npix_chunk, complex_dtype)
             index_ = index[s]
-            sb = QubicInstrument._get_response(
-                theta[index_], phi[index_], bandwidth, position, area, nu,
-                horn, primary_beam, secondary_beam, external_A=external_A, hwp_position=hwp_position)
-            out[..., index_] = abs2(sb, dtype=synthbeam_dtype)
+            n = len(index_)
+            B = QubicInstrument._get_response_B(
+                theta[index_], phi[index_], bandwidth, nu, horn, primary_beam,
+                out=local.B[:nhorn * n].reshape((nhorn, n)))
+            E = np.dot(A, B, out=local.E[:npos * n].reshape((npos, n)))
+            E = E.reshape(shape_A + (n,))
+            # the squared moduli have the precision of the complex fields,
+            # they are cast to synthbeam_dtype in the output
+            if integrate:
+                out[..., index_] = np.mean(abs2(E), axis=-2)
+            else:
+                out[..., index_] = abs2(E)
+
+        with pool_threading(nthreads) as pool:
+            pool.map(func_thread, split(npix, ngroup))
         return out
 
     def get_synthbeam(self, scene, idet=None, theta_max=45, external_A=None, hwp_position=0,
-                      detector_integrate=None, detpos=None):
+                      detector_integrate=None, detpos=None, max_nbytes=None,
+                      complex_dtype=None, nthreads=None):
         """
         Return the detector synthetic beams, computed from the superposition
         of the electromagnetic fields.
@@ -1203,9 +1400,20 @@ class QubicInstrument(Instrument):
         detector_integrate: Optional, number of subpixels in x direction for integration over detectors
             default (None) is no integration => uses the center of the pixel
         detpos: Optional, position in the focal plane at which the Synthesized Beam is desired as np.array([x,y,z])
-        
+        max_nbytes : float, optional
+            The memory budget in bytes of the complex fields (default: 1e9).
+        complex_dtype : dtype, optional
+            The dtype of the complex fields, complex64 for a faster and
+            lighter single precision computation (default: complex128).
+        nthreads : int, optional
+            The number of threads computing the synthetic beams. By default,
+            the 'nthreads' parameter of the instrument is used and if it is
+            not set, all the cores.
+
 
         """
+        if nthreads is None:
+            nthreads = getattr(self, 'nthreads', None)
         if detpos is None:
             pos = self.detector.center
         else:
@@ -1213,37 +1421,81 @@ class QubicInstrument(Instrument):
 
         if (idet is not None) and (detpos is None):
             return self[idet].get_synthbeam(scene, theta_max=theta_max, external_A=external_A,
-                                            hwp_position=hwp_position, detector_integrate=detector_integrate)[0]
+                                            hwp_position=hwp_position, detector_integrate=detector_integrate,
+                                            max_nbytes=max_nbytes, complex_dtype=complex_dtype,
+                                            nthreads=nthreads)[0]
         if detector_integrate is None:
             return QubicInstrument._get_synthbeam(
                 scene, pos, self.detector.area, self.filter.nu,
                 self.filter.bandwidth, self.horn, self.primary_beam,
-                self.secondary_beam, self.synthbeam.dtype, theta_max, external_A=external_A, hwp_position=hwp_position)
+                self.secondary_beam, self.synthbeam.dtype, theta_max, external_A=external_A, hwp_position=hwp_position,
+                max_nbytes=max_nbytes, complex_dtype=complex_dtype,
+                nthreads=nthreads)
         else:
-            xmin = np.min(self.detector.vertex[..., 0:1])
-            xmax = np.max(self.detector.vertex[..., 0:1])
-            ymin = np.min(self.detector.vertex[..., 1:2])
-            ymax = np.max(self.detector.vertex[..., 1:2])
-            allx = np.linspace(xmin, xmax, detector_integrate)
-            ally = np.linspace(ymin, ymax, detector_integrate)
-            sb = 0
-            for i in range(len(allx)):
-                print(i, len(allx))
-                for j in range(len(ally)):
-                    pos = self.detector.center
-                    pos[0][0] = allx[i]
-                    pos[0][1] = ally[j]
-                    sb += QubicInstrument._get_synthbeam(
-                        scene, pos, self.detector.area, self.filter.nu,
-                        self.filter.bandwidth, self.horn, self.primary_beam,
-                        self.secondary_beam, self.synthbeam.dtype, theta_max,
-                        external_A=external_A, hwp_position=hwp_position) / detector_integrate ** 2
-            return sb
+            # grid of detector_integrate x detector_integrate positions
+            # spanning each detector, relative to the detector centre
+            vertex = self.detector.vertex[..., :2]
+            x = np.linspace(0, 1, detector_integrate)
+            xmin = np.min(vertex[..., 0], axis=-1)[..., None, None]
+            xmax = np.max(vertex[..., 0], axis=-1)[..., None, None]
+            ymin = np.min(vertex[..., 1], axis=-1)[..., None, None]
+            ymax = np.max(vertex[..., 1], axis=-1)[..., None, None]
+            offset = np.zeros(vertex.shape[:-2] + 2 * (detector_integrate,) +
+                              (3,))
+            offset[..., 0] = xmin + (xmax - xmin) * x[:, None] - \
+                self.detector.center[..., 0, None, None]
+            offset[..., 1] = ymin + (ymax - ymin) * x[None, :] - \
+                self.detector.center[..., 1, None, None]
+            offset = offset.reshape(vertex.shape[:-2] + (-1, 3))
+            pos = np.asarray(pos)[..., None, :] + offset
+            area = np.asarray(self.detector.area)[..., None]
+            return QubicInstrument._get_synthbeam(
+                scene, pos, area, self.filter.nu, self.filter.bandwidth,
+                self.horn, self.primary_beam, self.secondary_beam,
+                self.synthbeam.dtype, theta_max, external_A=external_A,
+                hwp_position=hwp_position, integrate=True,
+                max_nbytes=max_nbytes, complex_dtype=complex_dtype,
+                nthreads=nthreads)
 
     def detector_subset(self, dets):
-        subset_inst = copy.deepcopy(self)
-        subset_inst.detector = self.detector[dets]
-        return subset_inst
+        """
+        Return the instrument restricted to the specified detectors. Only the
+        detector layout is copied: the horns, beams, optics and synthetic
+        beam are shared with the original instrument, so they should not be
+        modified in place.
+
+        Parameter
+        ---------
+        dets : int, slice, array of int or boolean mask
+            The selected detectors.
+
+        """
+        return self[dets]
+
+
+_PEAK_ANGLES_CACHE = OrderedDict()
+_PEAK_ANGLES_LOCK = threading.Lock()
+
+
+def _get_planck_integrals(b):
+    """
+    Return the integrals from 0 to b of x^4/(e^x-1), x^4/(e^x-1)^2 and
+    x^3/(e^x-1), memoized by upper bound b = h nu_up / k T.
+
+    """
+    b = float(b)
+    try:
+        return _PLANCK_INTEGRALS[b]
+    except KeyError:
+        pass
+    out = (quad(funct, 0, b, (4, 1))[0],
+           quad(funct, 0, b, (4, 2))[0],
+           quad(funct, 0, b, (3, 1))[0])
+    _PLANCK_INTEGRALS[b] = out
+    return out
+
+
+_PLANCK_INTEGRALS = {}
 
 
 def _argsort_reverse(a, axis=-1):
@@ -1252,6 +1504,418 @@ def _argsort_reverse(a, axis=-1):
     return i
 
 
+def _get_beam_state(beam, maxdepth=4):
+    """
+    Return the arrays and the (name, value) scalars describing a beam, used
+    in the key of the peak angle cache. The attributes held in sequences,
+    dicts and nested objects, such as the spline of MultiFreqBeam, are
+    walked recursively. The values whose state cannot be inspected
+    (functions, objects nested too deeply) are identified by their id.
+
+    """
+    arrays = []
+    scalars = []
+
+    def walk(name, value, depth):
+        if value is None or isinstance(value, (bool, int, float, str,
+                                               np.number)):
+            scalars.append((name, value))
+            return
+        if isinstance(value, np.ndarray) and value.dtype.kind == 'O':
+            value = value.tolist()
+        if isinstance(value, (list, tuple)):
+            try:
+                array = np.asarray(value)
+            except ValueError:  # ragged sequence
+                array = None
+            if array is None or array.dtype.kind not in 'biufc':
+                scalars.append((name, type(value).__name__, len(value)))
+                for i, v in enumerate(value):
+                    walk('{0}[{1}]'.format(name, i), v, depth)
+                return
+            value = array
+        if isinstance(value, np.ndarray):
+            scalars.append((name, 'array'))
+            arrays.append(value)
+        elif isinstance(value, dict):
+            scalars.append((name, 'dict', len(value)))
+            for k in sorted(value, key=str):
+                walk('{0}[{1!r}]'.format(name, k), value[k], depth)
+        elif hasattr(value, '__dict__') and not inspect.isroutine(value) \
+                and depth < maxdepth:
+            scalars.append((name, type(value).__name__))
+            for k, v in sorted(vars(value).items()):
+                walk(name + '.' + k, v, depth + 1)
+        else:
+            scalars.append((name, type(value).__name__, id(value)))
+
+    walk('beam', beam, 0)
+    return arrays, scalars
+
+
+def _get_cache_key(*args, **keywords):
+    """
+    Return the SHA-1 hex digest of the input arrays and keywords, used as
+    the key of the peak angle cache and as the file name of the cached
+    projection matrices.
+
+    """
+    sha = hashlib.sha1()
+    for arg in args:
+        if arg is None:
+            sha.update(b'None')
+            continue
+        arg = np.ascontiguousarray(arg)
+        sha.update('{0}{1}'.format(arg.dtype.str, arg.shape).encode())
+        sha.update(arg.view(np.uint8).ravel())
+    for key in sorted(keywords):
+        sha.update('{0}={1};'.format(key, keywords[key]).encode())
+    return sha.hexdigest()
+
+
+def _save_projection_cache(filename, data):
+    """
+    Write the projection matrix structured array in the cache. The file is
+    first written under a temporary name and then renamed, so that
+    concurrent jobs never memory-map a partially written matrix.
+
+    """
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(data))
+        os.rename(tmpname, filename)
+    except Exception:
+        os.remove(tmpname)
+        raise
+
+
+def _fill_noise(noise, nsamples, out, operation, nsamples_chunk=2**16):
+    """
+    Draw the noise of a NoiseGenerator into the output, by blocks of time
+    samples.
+
+    """
+    if out is None:
+        out = np.empty((noise.ndetectors, nsamples))
+        operation = operation_assignment
+    for start in range(0, nsamples, nsamples_chunk):
+        stop = min(start + nsamples_chunk, nsamples)
+        operation(out[:, start:stop], noise(stop - start))
+    return out
+
+
+def _fill_peak_indices(index, rotation, direction, nside, table=None,
+                       nthreads=None):
+    """
+    Fill in place the Healpix indices of the peaks, of shape
+    (ndetectors, ntimes, ncolmax), the detectors being distributed among
+    nthreads threads. See _fill_projection_matrix for the other arguments.
+
+    """
+    c2h = Cartesian2HealpixOperator(nside)
+
+    def func_thread(i):
+        # e_ni shape: (ntimes, ncolmax, 3)
+        e_ni = np.einsum('tji,nj->tni', rotation, direction[i])
+        if table is not None:
+            np.take(table, c2h(e_ni).astype(int), out=index[i])
+        else:
+            index[i] = c2h(e_ni)
+
+    with pool_threading(nthreads) as pool:
+        pool.map(func_thread, range(index.shape[0]))
+
+
+def _accumulate_coverage(out, index, weights):
+    """
+    Add the weights of the valid (non-negative) pixel indices to out.
+
+    """
+    index, weights = np.broadcast_arrays(index, weights)
+    valid = index >= 0
+    out += np.bincount(index[valid], weights=weights[valid],
+                       minlength=len(out))
+
+
+def _get_projection_cache_filename(cache, rotation, scene, thetas, phis,
+                                   vals, dtype, dtype_index):
+    """
+    Return the name of the file storing the projection matrix data in the
+    on-disk cache.
+
+    """
+    nscenetot = product(scene.shape[:scene.ndim])
+    key = _get_cache_key(
+        rotation, thetas, phis, vals,
+        scene.index if len(scene) != nscenetot else None,
+        nside=scene.nside, kind=scene.kind, dtype=dtype,
+        dtype_index=dtype_index)
+    return os.path.join(cache, key + '.npy')
+
+
+def _fill_projection_matrix(data, rotation, direction, vals, nside, kind,
+                            table=None, nthreads=None):
+    """
+    Fill in place the structured array of a peak sampling matrix.
+
+    Parameters
+    ----------
+    data : structured array, shape (ndetectors * ntimes, ncolmax)
+        The data of the FSR matrix.
+    rotation : array, shape (ntimes, 3, 3)
+        The instrument-to-sky rotation matrices.
+    direction : array, shape (ndetectors, ncolmax, 3)
+        The cartesian directions of the peaks in the instrument frame.
+    vals : array, shape (ndetectors, ncolmax)
+        The peak values.
+    nside : int
+        The Healpix nside of the scene.
+    kind : {'I', 'QU', 'IQU'}
+        The scene kind.
+    table : array of int, optional
+        Renumbering of the Healpix pixels for restricted scenes, -1 for the
+        pixels outside the scene.
+    nthreads : int, optional
+        The number of threads computing the pixel indices and the number of
+        OpenMP threads of the polarization kernel, the detectors being
+        distributed among them. By default, all the cores are used.
+
+    """
+    ndetectors, ncolmax = vals.shape
+    ntimes = rotation.shape[0]
+    index = data['index'].reshape((ndetectors, ntimes, ncolmax))
+    _fill_peak_indices(index, rotation, direction, nside, table=table,
+                       nthreads=nthreads)
+
+    if kind == 'I':
+        value = data['value'].reshape((ndetectors, ntimes, ncolmax))
+        value[...] = vals[:, None, :]
+        return
+
+    dtype_index = data.dtype['index']
+    dtype = data.dtype[1]
+    if str(dtype_index) not in ('int32', 'int64') or \
+            str(dtype) not in ('float32', 'float64'):
+        raise TypeError(
+            'The projection matrix cannot be created with types: {0} and {1}.'
+            .format(dtype_index, dtype))
+    func = 'matrix_rot{0}d_i{1}_r{2}'.format(
+        len(kind), dtype_index.itemsize, dtype.itemsize)
+    getattr(flib.polarization, func)(
+        rotation.T, direction.T, data.ravel().view(np.int8), vals.T,
+        nthreads or 0)
+
+
+class QubicStreamingProjectionOperator(Operator):
+    """
+    Peak sampling operator whose sparse matrix is not stored, but computed
+    on the fly by blocks of nsamples_chunk time samples. The matrix block is
+    written in a buffer which is reused across blocks and across operator
+    applications, so that the memory footprint is that of a single block.
+    It is used instead of the ProjectionOperator when the acquisition is
+    split into several blocks because of the max_nbytes limit, one operator
+    per block, the blocks sharing the same buffer.
+
+    """
+    def __init__(self, rotation, scene, nu, position, synthbeam, horn,
+                 primary_beam, nsamples_chunk, verbose=True, nthreads=None,
+                 buffer=None, **keywords):
+        """
+        Parameters
+        ----------
+        rotation : CartesianRotation3dOperator, QubicRotation or array
+            The instrument-to-sky rotations, of shape (ntimes, 3, 3). A
+            QubicRotation is only evaluated block by block.
+        scene : QubicScene
+            The observed scene.
+        nsamples_chunk : int
+            The number of time samples of the projection matrix blocks.
+        verbose : bool, optional
+            If true, display information about the memory allocation of the
+            block buffer.
+        nthreads : int, optional
+            The number of threads used to compute the matrix blocks. By
+            default, all the cores are used.
+        buffer : array, optional
+            The buffer of the matrix blocks of another streaming operator
+            with the same detectors, which is used if it is large enough, so
+            that the operators of several sample blocks share their memory.
+
+        """
+        if not isinstance(rotation, (np.ndarray, QubicRotation)):
+            rotation = rotation.data
+        thetas, phis, vals = QubicInstrument._peak_angles(
+            scene, nu, position, synthbeam, horn, primary_beam)
+        thetaphi = _pack_vector(thetas, phis)
+        direction = Spherical2CartesianOperator('zenith,azimuth')(thetaphi)
+        if scene.nside > 8192:
+            dtype_index = np.dtype(np.int64)
+        else:
+            dtype_index = np.dtype(np.int32)
+        nscene = len(scene)
+        nscenetot = product(scene.shape[:scene.ndim])
+        if nscene != nscenetot:
+            table = np.full(nscenetot, -1, dtype_index)
+            table[scene.index] = np.arange(nscene, dtype=dtype_index)
+        else:
+            table = None
+
+        ndetectors, ncolmax = vals.shape
+        ntimes = rotation.shape[0]
+        nsamples_chunk = max(1, min(int(nsamples_chunk), ntimes))
+        self.cls = {'I': FSRMatrix,
+                    'QU': FSRRotation2dMatrix,
+                    'IQU': FSRRotation3dMatrix}[scene.kind]
+        ndims = len(scene.kind)
+        if buffer is None or \
+           buffer.size < ndetectors * nsamples_chunk * ncolmax:
+            matrix = self.cls(
+                (ndetectors * nsamples_chunk * ndims, nscene * ndims),
+                ncolmax=ncolmax, dtype=synthbeam.dtype,
+                dtype_index=dtype_index, verbose=verbose)
+            buffer = matrix.data.ravel()
+        self.buffer = buffer
+        self.rotation = rotation
+        self.scene = scene
+        self.nu = nu
+        self.position = position
+        self.synthbeam = synthbeam
+        self.horn = horn
+        self.primary_beam = primary_beam
+        self.nsamples_chunk = nsamples_chunk
+        self.nthreads = nthreads
+        self.direction = direction
+        self.vals = vals
+        self.table = table
+        Operator.__init__(
+            self, shapein=(nscene,) + scene.shape[scene.ndim:],
+            shapeout=(ndetectors, ntimes) + scene.shape[scene.ndim:],
+            dtype=synthbeam.dtype,
+            flags='linear,contiguous_input,contiguous_output', **keywords)
+
+    def direct(self, input, output):
+        for start, stop in self._get_chunks():
+            output[:, start:stop] = self.get_chunk(start, stop)(input)
+
+    def transpose(self, input, output):
+        output[...] = 0
+        for start, stop in self._get_chunks():
+            p = self.get_chunk(start, stop)
+            p.T(np.ascontiguousarray(input[:, start:stop]), out=output,
+                operation=operator.iadd)
+
+    def get_chunk(self, start, stop):
+        """
+        Return the ProjectionOperator of the time samples start:stop. Its
+        matrix is stored in the operator buffer, so it is only valid until
+        the next call to this method.
+
+        """
+        ndetectors, ncolmax = self.vals.shape
+        ntimes = stop - start
+        ndims = len(self.scene.kind)
+        data = self.buffer[:ndetectors * ntimes * ncolmax].reshape(
+            (ndetectors * ntimes, ncolmax))
+        _fill_projection_matrix(
+            data, self.rotation[start:stop], self.direction, self.vals,
+            self.scene.nside, self.scene.kind, table=self.table,
+            nthreads=self.nthreads)
+        matrix = self.cls(
+            (ndetectors * ntimes * ndims, len(self.scene) * ndims), data=data)
+        return ProjectionOperator(
+            matrix, shapeout=(ndetectors, ntimes) +
+            self.scene.shape[self.scene.ndim:])
+
+    def restrict(self, mask, inplace=False):
+        """
+        Restrict the operator to a subset of the scene pixels. Since no
+        matrix is stored, a new operator is returned in any case, and the
+        inplace keyword is only kept for compatibility with the
+        ProjectionOperator interface.
+
+        Parameter
+        ---------
+        mask : boolean array
+            Mask of the pixels to be kept, of shape (len(scene),).
+
+        """
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            raise TypeError('The mask is not boolean.')
+        return QubicStreamingProjectionOperator(
+            self.rotation, self.scene[mask], self.nu, self.position,
+            self.synthbeam, self.horn, self.primary_beam, self.nsamples_chunk,
+            verbose=False, nthreads=self.nthreads, buffer=self.buffer)
+
+    def _get_chunks(self):
+        ntimes = self.rotation.shape[0]
+        for start in range(0, ntimes, self.nsamples_chunk):
+            yield start, min(start + self.nsamples_chunk, ntimes)
+
+
+def _get_projection_chunks(projection):
+    """
+    Iterate over the sample blocks of a projection operator, as returned by
+    QubicAcquisition.get_projection_operator, yielding the first and last
+    samples and the ProjectionOperator of the block.
+
+    """
+    if isinstance(projection, BlockColumnOperator):
+        operands = projection.operands
+    else:
+        operands = [projection]
+    start = 0
+    for p in operands:
+        if isinstance(p, QubicStreamingProjectionOperator):
+            for start_, stop_ in p._get_chunks():
+                yield start + start_, start + stop_, p.get_chunk(start_, stop_)
+        else:
+            yield start, start + p.shapeout[1], p
+        start += p.shapeout[1]
+
+
+def _merge_projection_rows(data):
+    """
+    Return the data of a peak sampling matrix in which the entries of each
+    row sharing the same pixel index are summed. Since the 2x2 and 3x3
+    rotation blocks of the FSR rotation matrices are stable by linear
+    combination, the summation is valid for all scene kinds. The number of
+    columns of the output is the maximum number of distinct pixels per row.
+
+    """
+    nrows, ncol = data.shape
+    if nrows == 0 or ncol == 0:
+        return data
+    index = data['index']
+    sentinel = np.iinfo(index.dtype).max
+    index = np.where(index < 0, sentinel, index)
+    order = np.argsort(index, axis=1, kind='mergesort')
+    rows = np.arange(nrows)[:, None]
+    index = index[rows, order]
+    new = np.ones(index.shape, bool)
+    new[:, 1:] = index[:, 1:] != index[:, :-1]
+    group = np.cumsum(new, axis=1) - 1
+    ncolmax = int(group[:, -1].max()) + 1
+    out = np.zeros((nrows, ncolmax), dtype=data.dtype)
+    out['index'] = -1
+    out['index'][rows, group] = index
+    out['index'][out['index'] == sentinel] = -1
+    flat = (rows * ncolmax + group).ravel()
+    for name in data.dtype.names[1:]:
+        out[name] = np.bincount(
+            flat, weights=data[name][rows, order].ravel(),
+            minlength=nrows * ncolmax).reshape((nrows, ncolmax))
+    return out
+
+
 def _pack_vector(*args):
     shape = np.broadcast(*args).shape
     out = np.empty(shape + (len(args),))
@@ -1340,8 +2004,152 @@ class QubicMultibandInstrument:
         sb = sb.sum(axis=0)
         return sb
 
+    def get_projection_operator(self, sampling, scene, factors=None,
+                                verbose=True):
+        """
+        Return the peak sampling operator of the sum over the
+        sub-instruments, in which the peaks of all the sub-frequencies are
+        stored in a single sparse matrix (see
+        _get_fused_projection_operator).
+
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The pointing information.
+        scene : QubicScene
+            The observed scene.
+        factors : array-like of shape (#subbands,) or (#subbands, #detectors)
+            The multiplicative factors of the sub-instrument peak values.
+        verbose : bool, optional
+            If true, display information about the memory allocation.
+
+        """
+        return QubicMultibandInstrument._get_fused_projection_operator(
+            self.subinstruments, sampling, scene, factors=factors,
+            verbose=verbose)
+
+    @staticmethod
+    def _get_fused_projection_operator(instruments, sampling, scene,
+                                       factors=None, verbose=True,
+                                       nsamples_chunk=None):
+        """
+        Return the sum over the instruments of their peak sampling
+        operators, each one multiplied by the corresponding factors.
+
+        The rotations are computed once, the peaks of all the instruments
+        are projected together and, for each detector and time
+        sample, the contributions of the peaks falling in the same pixel
+        are summed. The matrix size is therefore set by the number of
+        distinct pixels seen by the sub-frequency peaks, instead of
+        scaling with the number of instruments. The time samples are
+        processed by chunks of nsamples_chunk samples, by default as many
+        as fit in 100 MB.
+
+        """
+        MAX_MEMORY_CHUNK = 1e8
+        if factors is None:
+            factors = np.ones(len(instruments))
+        q0 = instruments[0]
+        rotation = sampling.get_rotation(
+            'horizontal' if sampling.fix_az else 'galactic')
+        ndetectors = len(q0)
+        ntimes = rotation.shape[0]
+        nside = scene.nside
+        dtype = q0.synthbeam.dtype
+
+        thetaphis = []
+        vals = []
+        for q, f in zip(instruments, factors):
+            theta, phi, val = QubicInstrument._peak_angles(
+                scene, q.filter.nu, q.detector.center, q.synthbeam, q.horn,
+                getattr(q, 'primary_beam', None))
+            thetaphis.append(_pack_vector(theta, phi))
+            vals.append(val * np.asarray(f, float)[..., None])
+        thetaphi = np.concatenate(thetaphis, axis=1)
+        direction = Spherical2CartesianOperator('zenith,azimuth')(thetaphi)
+        vals = np.concatenate(vals, axis=1).astype(dtype)
+        ncolmax = vals.shape[1]
+        if nside > 8192:
+            dtype_index = np.dtype(np.int64)
+        else:
+            dtype_index = np.dtype(np.int32)
+
+        cls = {'I': FSRMatrix,
+               'QU': FSRRotation2dMatrix,
+               'IQU': FSRRotation3dMatrix}[scene.kind]
+        ndims = len(scene.kind)
+        nscene = len(scene)
+        nscenetot = product(scene.shape[:scene.ndim])
+        if nscene != nscenetot:
+            table = np.full(nscenetot, -1, dtype_index)
+            table[scene.index] = np.arange(nscene, dtype=dtype_index)
+        else:
+            table = None
+
+        # the peaks of all the instruments are projected and merged by
+        # chunks of time samples, in a reusable buffer
+        nbytes_sample = ndetectors * ncolmax * (
+            dtype_index.itemsize + ndims * dtype.itemsize)
+        if nsamples_chunk is None:
+            nsamples_chunk = int(MAX_MEMORY_CHUNK / nbytes_sample)
+        nsamples_chunk = max(min(nsamples_chunk, ntimes), 1)
+        buffer = cls((ndetectors * nsamples_chunk * ndims, nscene * ndims),
+                     ncolmax=ncolmax, dtype=dtype, dtype_index=dtype_index,
+                     verbose=False).data.ravel()
+        nthreads = getattr(q0, 'nthreads', None)
+
+        def get_chunks():
+            for start in range(0, ntimes, nsamples_chunk):
+                stop = min(start + nsamples_chunk, ntimes)
+                data = buffer[:ndetectors * (stop - start) * ncolmax].reshape(
+                    (ndetectors * (stop - start), ncolmax))
+                yield start, stop, data
+
+        # the merged chunks are written in the matrix as they are computed.
+        # Its number of columns, the maximum number of distinct pixels per
+        # row, is only known at the end: the matrix is allocated with the
+        # width of the first chunk and widened when a later chunk has more
+        # distinct pixels, which is rare since the peaks of neighbouring
+        # samples are similarly spread
+        shape = (ndetectors * ntimes * ndims, nscene * ndims)
+        s = None
+        for start, stop, data in get_chunks():
+            _fill_projection_matrix(data, rotation[start:stop], direction,
+                                    vals, nside, scene.kind, table=table,
+                                    nthreads=nthreads)
+            merged = _merge_projection_rows(data)
+            if s is None or merged.shape[1] > s.data.shape[1]:
+                s_old = s
+                s = cls(shape, ncolmax=merged.shape[1], dtype=dtype,
+                        dtype_index=dtype_index,
+                        verbose=verbose and s_old is None)
+                out = s.data.reshape((ndetectors, ntimes, merged.shape[1]))
+                out['index'] = -1
+                for name in s.data.dtype.names[1:]:
+                    out[name] = 0
+                if s_old is not None:
+                    ncol_old = s_old.data.shape[1]
+                    out[:, :start, :ncol_old] = s_old.data.reshape(
+                        (ndetectors, ntimes, ncol_old))[:, :start]
+                    del s_old
+            out[:, start:stop, :merged.shape[1]] = merged.reshape(
+                (ndetectors, stop - start, -1))
+        del buffer
+        if s is None:
+            s = cls(shape, ncolmax=0, dtype=dtype, dtype_index=dtype_index,
+                    verbose=verbose)
+        return ProjectionOperator(
+            s, shapeout=(ndetectors, ntimes) + scene.shape[1:])
+
     def detector_subset(self, dets):
-        subset_inst = copy.deepcopy(self)
-        for i in range(len(subset_inst)):
-            subset_inst[i].detector = self[i].detector[dets]
+        """
+        Return the multiband instrument restricted to the specified
+        detectors. As for QubicInstrument.detector_subset, the
+        sub-instruments share all their state but the detector layout with
+        the original ones.
+
+        """
+        subset_inst = copy.copy(self)
+        subset_inst.subinstruments = [q.detector_subset(dets)
+                                      for q in self.subinstruments]
         return subset_inst
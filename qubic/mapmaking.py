@@ -1,18 +1,29 @@
 from __future__ import absolute_import, division, print_function
 from collections import OrderedDict
 from pyoperators import (
-    asoperator, BlockColumnOperator, DiagonalOperator, PackOperator, pcg,
-    proxy_group)
-from pyoperators.memory import ones
+    asoperator, BlockColumnOperator, IdentityOperator, MPI, PackOperator,
+    pcg)
+from pyoperators.iterative.cg import PCGAlgorithm
+from pyoperators.iterative.core import (
+    AbnormalStopIteration, IterativeAlgorithm)
 from pyoperators.utils import ndarraywrap
-from pysimulators.interfaces.healpy import HealpixLaplacianOperator
+from pyoperators.utils.mpi import as_mpi
+from pysimulators import ProjectionOperator
+from pysimulators.sparse import FSRMatrix, SparseOperator
 from .utils import progress_bar
 import healpy as hp
+import multiprocessing
 import numpy as np
+import os
+import shutil
+import tempfile
+import time
 
 __all__ = ['angular_distance_from_mask',
            'apodize_mask',
            'map2tod',
+           'pcg_checkpoint',
+           'pcg_multi',
            'tod2map_all',
            'tod2map_each']
 
@@ -70,19 +81,14 @@ def apodize_mask(maskok, fwhm_deg):
     return 1 - np.exp(-0.5 * mapang**2 / sigma_deg**2)
 
 
-def _get_projection_restricted(acq, P, mask):
-    #XXX HACK
-    if len(acq.block) == 1:
-        return P.restrict(mask, inplace=True)
-
-    def callback(i):
-        f = acq.instrument.get_projection_operator
-        p = f(acq.sampling[acq.block[i]], acq.scene, verbose=False)
-        return p.restrict(mask, inplace=True)
-    shapeouts = [(len(acq.instrument), s.stop-s.start) +
-                 acq.scene.shape[1:] for s in acq.block]
-    proxies = proxy_group(len(acq.block), callback, shapeouts=shapeouts)
-    return BlockColumnOperator(proxies, axisout=1)
+def _get_projection_restricted(P, mask, inplace=False):
+    # P is either a ProjectionOperator or, when the acquisition is split into
+    # several blocks, a block column of QubicStreamingProjectionOperator
+    if isinstance(P, BlockColumnOperator):
+        return BlockColumnOperator(
+            [_get_projection_restricted(_, mask, inplace=inplace)
+             for _ in P.operands], axisout=1)
+    return P.restrict(mask, inplace=inplace)
 
 #    nbytes = acq.get_projection_nbytes()
 #    if max_nbytes is None or nbytes <= max_nbytes:
@@ -147,15 +153,15 @@ def map2tod(acq, map, convolution=False, max_nbytes=None):
 
 
 def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
-             disp_pcg, maxiter, tol, criterion, full_output, save_map, hyper):
+             disp_pcg, maxiter, tol, criterion, full_output, save_map, hyper,
+             checkpoint=None, checkpoint_interval=10, projection=None):
     # coverage normalization:
     # sum coverage = #detectors x #samplings for a uniform secondary beam
-    H = acq.get_operator()
-    coverage = H.T(ones(H.shapeout))
-    if acq.scene.kind == 'IQU':
-        coverage = coverage[..., 0]
-    elif acq.scene.kind == 'QU':
+    if acq.scene.kind == 'QU':
         raise NotImplementedError()
+    coverage = acq.instrument.get_coverage(acq.sampling, acq.scene,
+                                           projection=projection)
+    acq.comm.Allreduce(MPI.IN_PLACE, as_mpi(coverage), op=MPI.SUM)
     theta, phi = acq.instrument.detector.theta, acq.instrument.detector.phi
     ndetectors = acq.instrument.detector.comm.allreduce(
         np.sum(acq.instrument.secondary_beam(theta, phi)))
@@ -180,34 +186,59 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
     header['fracrej'] = rejected, 'Fraction of rejected observed pixels'
 
     acq_restricted = acq[..., mask]
-    H = acq_restricted.get_operator()
+    if projection is not None:
+        projection = _get_projection_restricted(projection, mask)
+    else:
+        projection = acq_restricted.get_projection_operator()
+    H = acq_restricted.get_operator(projection=projection)
     invNtt = acq_restricted.get_invntt_operator()
-    M = (H.T * H * np.ones(H.shapein))[..., 0]
-    preconditioner = DiagonalOperator(1/M, broadcast='rightward')
-#    preconditioner = DiagonalOperator(1/coverage[mask], broadcast='rightward')
     nsamplings = acq.comm.allreduce(len(acq.sampling))
+    # block-Jacobi preconditioner, accounting for the I/Q/U coupling
+    preconditioner = nsamplings * acq_restricted.get_block_preconditioner(
+        invNtt, projection)
     npixels = np.sum(mask)
 
     A = H.T * invNtt * H / nsamplings
     if hyper != 0:
-        L = HealpixLaplacianOperator(acq.scene.nside)
-        L = L.restrict(mask, inplace=True).corestrict(mask, inplace=True)
+        L = _get_laplacian_operator(acq.scene.nside, mask)
         A = A - hyper / npixels / 4e5 * L
 
+    if np.ndim(tod) > len(H.shapeout):
+        # stack of TODs sharing the pointing: the operators are built once
+        if criterion or full_output or checkpoint is not None:
+            raise ValueError(
+                'The criterion, full_output and checkpoint keywords are not '
+                'handled for a stack of TODs.')
+        HT_invNtt = H.T * invNtt
+        b = np.array([HT_invNtt(t) for t in tod]) / nsamplings
+        solution = pcg_multi(A, b, M=preconditioner, disp=disp_pcg,
+                             maxiter=maxiter, tol=tol)
+        x = np.array([acq_restricted.scene.unpack(_) for _ in solution['x']])
+        return x, coverage
+
+    invNtt_tod = invNtt(tod)
+    b = H.T(invNtt_tod) / nsamplings
+
     if criterion:
-        def f(x):
-            Hx_y = H(x)
-            Hx_y -= tod
-            out = [np.dot(Hx_y.ravel(), invNtt(Hx_y).ravel()) / nsamplings]
+        # the criterion (Hx-y)^T N^-1 (Hx-y) - x^T L x is equal to
+        # y^T N^-1 y - x^T r - b^T x, where r = b - Ax is the PCG residual
+        yT_invNtt_y = acq.comm.allreduce(
+            np.dot(tod.ravel(), invNtt_tod.ravel())) / nsamplings
+
+        def f(x, r=None):
+            if r is None:
+                r = b - A(x)
             if hyper != 0:
-                out += [-np.dot(x.ravel(),
-                                hyper / npixels / 4e5 * L(x).ravel())]
+                prior = -np.dot(x.ravel(),
+                                hyper / npixels / 4e5 * L(x).ravel())
             else:
-                out += [0.]
-            return out
+                prior = 0.
+            total = yT_invNtt_y - np.dot(x.ravel(), r.ravel()) - \
+                np.dot(b.ravel(), x.ravel())
+            return [total - prior, prior]
 
         def callback(self):
-            criteria = f(self.x)
+            criteria = f(self.x, self.r)
             if len(criteria) == 1:
                 details = ''
             else:
@@ -228,22 +259,25 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
                     self.xs = {}
                 self.xs[self.niterations] = self.x.copy()
 
-    solution = pcg(A, H.T(invNtt(tod)) / nsamplings, M=preconditioner,
-                   callback=callback, disp=disp_pcg, maxiter=maxiter, tol=tol)
+    solution = pcg_checkpoint(
+        A, b, checkpoint=checkpoint,
+        checkpoint_interval=checkpoint_interval, M=preconditioner,
+        callback=callback, disp=disp_pcg, maxiter=maxiter, tol=tol)
     output = acq_restricted.scene.unpack(solution['x']), coverage
     if full_output:
         algo = solution['algorithm']
         algo.H = H
         if criterion:
             pack = PackOperator(mask, broadcast='rightward')
-            algo.f = asoperator(f, shapeout=2)(pack)
+            algo.f = asoperator(lambda x: f(x), shapeout=2)(pack)
         output += (algo,)
     return output
 
 
 def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
                 callback=None, disp=True, maxiter=300, tol=1e-4,
-                criterion=False, full_output=False, save_map=None, hyper=0):
+                criterion=False, full_output=False, save_map=None, hyper=0,
+                checkpoint=None, checkpoint_interval=10):
     """
     Compute map using all detectors.
 
@@ -257,7 +291,10 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     acquisition : QubicAcquisition
         The QUBIC acquisition.
     tod : array-like
-        The Time-Ordered-Data of shape (ndetectors, ntimes).
+        The Time-Ordered-Data of shape (ndetectors, ntimes), or a stack of
+        TODs of shape (nrealizations, ndetectors, ntimes) sharing the same
+        pointing, such as Monte-Carlo noise realizations. The operators are
+        then built once and reused for each TOD (see pcg_multi).
     coverage_threshold : float, optional
         The low-coverage sky pixels whose cumulative coverage is below a
         fraction of the total coverage are rejected. This keyword speficies
@@ -279,6 +316,12 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     criterion : boolean, optional
         If True, also display the criterion at each iteration. It slows down
         the solving process.
+    checkpoint : str, optional
+        If specified, the solver state is saved in this npz file every
+        checkpoint_interval iterations, and an interrupted solve is resumed
+        from it when the function is called again (see pcg_checkpoint).
+    checkpoint_interval : int, optional
+        The number of iterations between two checkpoints.
 
     Returns
     -------
@@ -289,17 +332,21 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     """
     return _tod2map(acquisition, tod, coverage_threshold, max_nbytes,
                     callback, disp, maxiter, tol, criterion, full_output,
-                    save_map, hyper)
+                    save_map, hyper, checkpoint, checkpoint_interval)
 
 
 def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
                  callback=None, disp=True, maxiter=300, tol=1e-4,
-                 criterion=False, full_output=False, save_map=None, hyper=0):
+                 criterion=False, full_output=False, save_map=None, hyper=0,
+                 nprocs=1, d=None):
     """
     Compute average map from each detector.
 
     map, coverage = tod2map_each(acquisition, tod, [coverage_threshold,
-                                 max_nbytes, callback, disp, tol])
+                                 max_nbytes, callback, disp, tol, nprocs, d])
+
+    The pointing matrix of the acquisition is computed once, and the
+    per-detector problems use its rows instead of recomputing them.
 
     Parameters
     ----------
@@ -327,6 +374,18 @@ def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     criterion : boolean, optional
         If True, also display the criterion at each iteration. It slows down
         the solving process.
+    nprocs : int, optional
+        Number of processes among which the per-detector solves are
+        distributed. If None, all the cores are used. The default is to
+        solve them serially, which is also the case under Python 2.
+    d : dictionary, optional
+        The dictionary from which the acquisition has been built, required
+        if nprocs is greater than 1. The acquisition cannot be pickled, so
+        the worker processes, which are not forked, rebuild it from this
+        dictionary, the sampling and the detector indices, and they read
+        the pointing matrix from a temporary memory-mapped file. As for any
+        multiprocessing code, the calling script must be protected by an
+        if __name__ == '__main__' clause.
 
     Returns
     -------
@@ -337,21 +396,408 @@ def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     """
     if tod.shape != (len(acquisition.instrument), len(acquisition.sampling)):
         raise ValueError('The TOD has an invalid shape.')
+    projection = acquisition.get_projection_operator(verbose=False)
+    if isinstance(projection, BlockColumnOperator):
+        projection = projection.operands[0]
+    if not isinstance(projection, ProjectionOperator):
+        # the pointing matrix is not stored
+        projection = None
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = max(1, min(nprocs, tod.shape[0]))
+    if nprocs > 1 and not hasattr(multiprocessing, 'get_context'):
+        # Python 2: the processes could only be forked
+        nprocs = 1
+    if nprocs > 1 and d is None:
+        raise ValueError(
+            'The dictionary of the acquisition is required to distribute '
+            'the per-detector solves.')
+
     x = acquisition.scene.zeros()
     n = np.zeros(acquisition.scene.shape[0])
     if disp:
         bar = progress_bar(tod.shape[0], 'TOD2MAP_EACH')
-    for i, t in enumerate(tod):
-        acq = acquisition[i]
-        x_, n_ = _tod2map(acq, t[None, :], coverage_threshold, max_nbytes,
-                          callback, False, maxiter, tol, criterion,
-                          full_output, save_map, hyper)
-                          
-        x += x_
-        n += n_
-        if disp:
-            bar.update()
+    args = (coverage_threshold, max_nbytes, callback, False, maxiter, tol,
+            criterion, full_output, save_map, hyper)
+    tasks = ((i, tod[i]) for i in range(tod.shape[0]))
+    pool = None
+    tmpdir = None
+    try:
+        if nprocs == 1:
+            _set_tod2map_each_state((acquisition, projection, args))
+            results = map(_tod2map_each_detector, tasks)
+        else:
+            if projection is not None:
+                tmpdir = tempfile.mkdtemp()
+                filename = os.path.join(tmpdir, 'projection.npy')
+                np.save(filename, projection.matrix.data.view(np.ndarray))
+                projection = (filename, type(projection.matrix),
+                              projection.matrix.shape, projection.shapeout)
+            try:
+                context = multiprocessing.get_context('forkserver')
+            except ValueError:
+                # the platform has no fork server (Windows)
+                context = multiprocessing.get_context('spawn')
+            pool = context.Pool(
+                nprocs, initializer=_init_tod2map_each_worker,
+                initargs=(d, acquisition.sampling,
+                          acquisition.instrument.detector.index, projection,
+                          args))
+            results = pool.imap(_tod2map_each_detector, tasks)
+        for x_, n_ in results:
+            x += x_
+            n += n_
+            if disp:
+                bar.update()
+    finally:
+        _set_tod2map_each_state(None)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
 
     if acquisition.scene.kind == 'I':
         return np.nan_to_num(x / n), n
     return np.nan_to_num(x / n[:, None]), n
+
+
+def _tod2map_each_detector(task):
+    """
+    Solve the map-making problem of the i-th detector for tod2map_each,
+    the task being the tuple (i, tod[i]). The other inputs are read from
+    _TOD2MAP_EACH_STATE, which is set in each process by
+    _set_tod2map_each_state.
+
+    """
+    i, tod = task
+    acquisition, projection, args = _TOD2MAP_EACH_STATE
+    if projection is not None:
+        projection = _get_detector_projection(projection, i)
+    x, n = _tod2map(acquisition[i], tod[None, :], *args,
+                    projection=projection)
+    return np.asarray(x), np.asarray(n)
+
+
+def _get_detector_projection(projection, i):
+    """
+    Return the peak sampling operator of the i-th detector, whose sparse
+    matrix is a view of the rows of the projection of all the detectors.
+
+    """
+    matrix = projection.matrix
+    ntimes = projection.shapeout[1]
+    data = matrix.data[i * ntimes:(i + 1) * ntimes]
+    shape = (ntimes * matrix.block_shape[0], matrix.shape[1])
+    return ProjectionOperator(
+        type(matrix)(shape, data=data),
+        shapeout=(1, ntimes) + projection.shapeout[2:])
+
+
+def _init_tod2map_each_worker(d, sampling, index, projection, args):
+    """
+    Initializer of the worker processes of tod2map_each. The acquisition
+    is rebuilt from the dictionary, the sampling and the indices of the
+    detectors, and the sparse matrix of the projection, given as the tuple
+    (filename, matrix class, matrix shape, shapeout), is memory-mapped.
+
+    """
+    from .acquisition import QubicAcquisition
+    from .instrument import QubicInstrument
+    from .scene import QubicScene
+    instrument = QubicInstrument(d)
+    isort = np.argsort(instrument.detector.index)
+    iindex = isort[np.searchsorted(instrument.detector.index, index,
+                                   sorter=isort) % len(isort)]
+    if np.any(instrument.detector.index[iindex] != index):
+        raise ValueError(
+            'The acquisition detectors are not those of the dictionary.')
+    instrument = instrument[iindex]
+    acquisition = QubicAcquisition(instrument, sampling, QubicScene(d), d)
+    if projection is not None:
+        filename, cls, shape, shapeout = projection
+        data = np.load(filename, mmap_mode='r')
+        projection = ProjectionOperator(cls(shape, data=data),
+                                        shapeout=shapeout)
+    _set_tod2map_each_state((acquisition, projection, args))
+
+
+def _set_tod2map_each_state(state):
+    """
+    Set the acquisition, the projection and the solver arguments of the
+    per-detector solves of tod2map_each.
+
+    """
+    global _TOD2MAP_EACH_STATE
+    _TOD2MAP_EACH_STATE = state
+
+
+_TOD2MAP_EACH_STATE = None
+
+
+def _get_laplacian_operator(nside, mask):
+    """
+    Return the 9-point stencil Laplacian of the Healpix maps restricted to
+    the pixels of the mask, as given by HealpixLaplacianOperator. The
+    neighbour table is only computed for the pixels of the mask, the
+    neighbours outside the mask being discarded.
+
+    """
+    ipix = np.where(mask)[0]
+    npix = len(ipix)
+    table = np.full(mask.size, -1, np.int32)
+    table[ipix] = np.arange(npix, dtype=np.int32)
+    neighbours = hp.get_all_neighbours(nside, ipix)
+    s = FSRMatrix((npix, npix), ncolmax=9, dtype_index=np.int32)
+    s.data.index[:, 0] = np.arange(npix)
+    s.data.index[:, 1:] = np.where(neighbours >= 0, table[neighbours], -1).T
+    h2 = 4 * np.pi / mask.size
+    s.data.value[:, 0] = -20 / (6 * h2)
+    s.data.value[:, 1:] = np.array([1, 4, 1, 4, 1, 4, 1, 4]) / (6 * h2)
+    return SparseOperator(s)
+
+
+def pcg_checkpoint(A, b, checkpoint=None, checkpoint_interval=10, x0=None,
+                   tol=1e-5, maxiter=300, M=None, disp=False, callback=None):
+    """
+    Preconditioned conjugate gradient, whose state is periodically saved
+    on disk, so that the solve can be resumed after an interruption.
+
+    The solver state (the solution x, the residual r, the search direction
+    d, the preconditioned residual norm delta and the iteration count) is
+    written in the checkpoint npz file every checkpoint_interval iterations
+    and when the maximum number of iterations is reached. If the checkpoint
+    file exists when the function is called, the iterations are resumed from
+    the saved state, which gives the same result as an uninterrupted solve.
+    The maximum number of iterations includes those of the previous runs.
+
+    Parameters
+    ----------
+    A, b, x0, tol, maxiter, M, disp, callback
+        See pyoperators.pcg.
+    checkpoint : str, optional
+        The checkpoint file name. If None, no checkpoint is written and the
+        function is equivalent to pyoperators.pcg. If the problem is
+        distributed, each MPI process uses the file name suffixed by its
+        rank.
+    checkpoint_interval : int, optional
+        The number of iterations between two checkpoints.
+
+    Returns
+    -------
+    output : dict
+        The same output as pyoperators.pcg, whose 'nit' key also counts the
+        iterations of the previous runs.
+
+    """
+    if checkpoint is None:
+        return pcg(A, b, x0=x0, tol=tol, maxiter=maxiter, M=M, disp=disp,
+                   callback=callback)
+    time0 = time.time()
+    algo = _CheckpointPCGAlgorithm(
+        A, b, checkpoint, checkpoint_interval, x0=x0, tol=tol,
+        maxiter=maxiter, M=M, disp=disp, callback=callback)
+    try:
+        output = algo.run()
+        success = True
+        message = ''
+    except AbnormalStopIteration as e:
+        algo.save_checkpoint()
+        output = algo.finalize()
+        success = False
+        message = str(e)
+    return {'x': output,
+            'success': success,
+            'message': message,
+            'nit': algo.niterations,
+            'error': algo.error,
+            'time': time.time() - time0,
+            'algorithm': algo}
+
+
+class _CheckpointPCGAlgorithm(PCGAlgorithm):
+    """
+    PCG algorithm which saves its state every checkpoint_interval iterations
+    and which starts from the saved state, if any.
+
+    """
+    def __init__(self, A, b, checkpoint, checkpoint_interval, callback=None,
+                 **keywords):
+        PCGAlgorithm.__init__(self, A, b, callback=callback, **keywords)
+        if self.comm is not None and self.comm.size > 1:
+            checkpoint = '{}.{}'.format(checkpoint, self.comm.rank)
+            self.writer = True
+        else:
+            self.writer = MPI.COMM_WORLD.rank == 0
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = int(checkpoint_interval)
+        user_callback = self.callback
+
+        def callback(algo):
+            user_callback(algo)
+            if algo.niterations % algo.checkpoint_interval == 0:
+                algo.save_checkpoint()
+        self.callback = callback
+
+    def initialize(self):
+        if not os.path.exists(self.checkpoint):
+            PCGAlgorithm.initialize(self)
+            return
+        with np.load(self.checkpoint) as data:
+            state = dict(data)
+        if state['x'].shape != self.b.shape or \
+           not np.allclose(state['b_norm'], self.b_norm, rtol=1e-10):
+            raise ValueError(
+                "The checkpoint '{}' does not match the system to be solved."
+                .format(self.checkpoint))
+        IterativeAlgorithm.initialize(self)
+        self.x[...] = state['x']
+        self.r[...] = state['r']
+        self.d[...] = state['d']
+        self.delta = state['delta'][()]
+        self.error = state['error'][()]
+        self.niterations = int(state['niterations'])
+        if self.disp:
+            print('Resuming PCG from iteration {} of {}.'.format(
+                self.niterations, self.checkpoint))
+
+    def save_checkpoint(self):
+        """
+        Write the solver state in the checkpoint file. The file is first
+        written under a temporary name and then renamed, so that an
+        interruption during the writing does not corrupt the checkpoint.
+
+        """
+        if not self.writer or self.niterations <= 0:
+            return
+        tmp = self.checkpoint + '.tmp.npz'
+        np.savez(tmp, x=self.x, r=self.r, d=self.d, delta=self.delta,
+                 error=self.error, niterations=self.niterations,
+                 b_norm=self.b_norm)
+        os.rename(tmp, self.checkpoint)
+
+
+def _pcg_tod2map(H, invntt, tod, preconditioner, d):
+    """
+    Solve H^T N^-1 H x = H^T N^-1 tod for the tod2map methods of the
+    acquisitions. The TOD can be a stack of TODs sharing the same pointing,
+    whose systems are solved by pcg_multi. Otherwise, the solve is
+    checkpointed if the dictionary d has a 'checkpoint' file name.
+
+    """
+    A = H.T * invntt * H
+    HT_invntt = H.T * invntt
+    if np.ndim(tod) > len(H.shapeout):
+        b = np.array([HT_invntt(t) for t in tod])
+        return pcg_multi(A, b, M=preconditioner, disp=d['verbose'],
+                         tol=d['tol'], maxiter=d['maxiter'])
+    return pcg_checkpoint(
+        A, HT_invntt(tod), checkpoint=d.get('checkpoint'),
+        checkpoint_interval=d.get('checkpoint_interval', 10),
+        M=preconditioner, disp=d['verbose'], tol=d['tol'],
+        maxiter=d['maxiter'])
+
+
+def pcg_multi(A, b, x0=None, tol=1e-5, maxiter=300, M=None, disp=False):
+    """
+    Preconditioned conjugate gradient solving the systems A x_k = b_k for a
+    stack of right-hand sides b_k sharing the same operator, such as the
+    map-making of Monte-Carlo realizations with the same pointing.
+
+    The operator and the preconditioner are only built once and the
+    systems which have converged are no longer iterated. There is no
+    multi-vector kernel: A and M are applied to each right-hand side in
+    turn, so an iteration costs as much as one pcg iteration per system.
+    Each solution is identical to that of pyoperators.pcg.
+
+    Parameters
+    ----------
+    A, tol, maxiter, M, disp
+        See pyoperators.pcg.
+    b : array-like
+        The stack of right-hand sides, of shape (nrhs,) + A.shapein.
+    x0 : array-like, optional
+        The stack of starting guesses.
+
+    Returns
+    -------
+    output : dict whose keys are
+        'x' : the stack of solutions.
+        'success' : boolean array indicating the systems which converged.
+        'nit' : the number of iterations of each system.
+        'error' : the normalized residual ||Ax-b|| / ||b|| of each system.
+        'time' : elapsed time in solver.
+
+    """
+    time0 = time.time()
+    A = asoperator(A)
+    M = IdentityOperator() if M is None else asoperator(M)
+    b = np.asarray(b, float)
+    if A.shapein is None:
+        raise ValueError('The operator input shape is not explicit.')
+    if b.shape[1:] != A.shapein:
+        raise ValueError(
+            "The operator input shape '{}' is incompatible with that of the "
+            "RHS '{}'.".format(A.shapein, b.shape[1:]))
+    comm = A.commin
+
+    def dot(x, y):
+        out = np.array([np.dot(x_.ravel(), y_.ravel())
+                        for x_, y_ in zip(x, y)])
+        if comm is not None:
+            comm.Allreduce(MPI.IN_PLACE, out)
+        return out
+
+    def bcast(a):
+        return a.reshape(a.shape + (b.ndim - 1) * (1,))
+
+    nrhs = b.shape[0]
+    x = np.zeros_like(b) if x0 is None else np.array(x0, float)
+    r = b.copy()
+    for k in range(nrhs):
+        if x0 is not None:
+            r[k] -= A(x[k])
+    b_norm = dot(b, b)
+    error = np.zeros(nrhs)
+    active = b_norm > 0
+    x[~active] = 0
+    error[active] = np.sqrt(dot(r[active], r[active]) / b_norm[active])
+    active &= error >= tol
+    d = np.zeros_like(b)
+    q = np.empty_like(b)
+    s = np.empty_like(b)
+    delta = np.zeros(nrhs)
+    for k in np.flatnonzero(active):
+        M(r[k], d[k])
+    delta[active] = dot(r[active], d[active])
+    niterations = np.zeros(nrhs, int)
+
+    niteration = 0
+    while np.any(active) and niteration < maxiter:
+        niteration += 1
+        i = np.flatnonzero(active)
+        for k in i:
+            A(d[k], q[k])
+        alpha = bcast(delta[i] / dot(d[i], q[i]))
+        x[i] += alpha * d[i]
+        r[i] -= alpha * q[i]
+        error[i] = np.sqrt(dot(r[i], r[i]) / b_norm[i])
+        niterations[i] = niteration
+        converged = error[i] < tol
+        active[i[converged]] = False
+        i = i[~converged]
+        for k in i:
+            M(r[k], s[k])
+        delta_old = delta[i]
+        delta[i] = dot(r[i], s[i])
+        d[i] *= bcast(delta[i] / delta_old)
+        d[i] += s[i]
+        if disp:
+            print('{:4}: {} active, max error {:e}'.format(
+                niteration, len(i), np.max(error)))
+
+    return {'x': x,
+            'success': error < tol,
+            'nit': niterations,
+            'error': error,
+            'time': time.time() - time0}
@@ -13,6 +13,7 @@ from pysimulators import Acquisition, FitsArray
 from pysimulators.interfaces.healpy import (
     HealpixConvolutionGaussianOperator)
 from .data import PATH
+from .mapmaking import pcg_checkpoint
 from .instrument import QubicInstrument
 from .scene import QubicScene
 from .samplings import create_random_pointings
@@ -51,10 +52,18 @@ class QubicMultibandAcquisition(QubicPolyAcquisition):
         self.nus = np.array([q.filter.nu / 1e9 for q in multiinstrument])
 
     def get_operator(self):
-        op = np.array(self._get_array_of_operators())
         op_sum = []
         for band in self.bands:
-            op_sum.append(op[(self.nus > band[0]) * (self.nus < band[1])].sum(axis=0))
+            inband = (self.nus > band[0]) * (self.nus < band[1])
+            H = self._get_fused_operator(
+                [a for a, i in zip(self, inband) if i],
+                np.asarray(self.weights)[inband])
+            if H is None:
+                op = np.array(self._get_array_of_operators())
+                op_sum = [op[(self.nus > mi) * (self.nus < ma)].sum(axis=0)
+                          for mi, ma in self.bands]
+                break
+            op_sum.append(H)
         return BlockRowOperator(op_sum, new_axisin=0)
 
 
@@ -174,8 +183,10 @@ class QubicMultibandPlanckAcquisition(QubicPolyPlanckAcquisition):
                 b = b.reshape((sh[0], sh[1]))
 
         preconditioner = self.get_preconditioner(cov)
-        solution = pcg(A, b, M=preconditioner, disp=verbose, tol=tol, maxiter=maxiter)
-        #        solution = pcg(A, b, disp=verbose, tol=tol, maxiter=maxiter)
+        solution = pcg_checkpoint(
+            A, b, checkpoint=d.get('checkpoint'),
+            checkpoint_interval=d.get('checkpoint_interval', 10),
+            M=preconditioner, disp=verbose, tol=tol, maxiter=maxiter)
         if len(sh) == 3:
             maps_recon = solution['x'].reshape(sh[0], sh[1], sh[2])
         else:
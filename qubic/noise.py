@@ -0,0 +1,223 @@
+# coding: utf-8
+from __future__ import division
+
+import numpy as np
+from scipy.fftpack import next_fast_len
+
+__all__ = ['NoiseGenerator']
+
+
+class NoiseGenerator(object):
+    """
+    Generator of stationary gaussian noise timelines, by blocks of time
+    samples. The noise power spectrum density is
+        psd = sigma**2 * (1 + (fknee/f)**fslope) / fs + sigma_white**2 / fs
+    where fs is the sampling frequency.
+
+    The correlated component is obtained by filtering a white noise with
+    a FIR kernel of ncorr samples, whose transfer function is the square
+    root of the PSD. The filtering of all the detectors is done by one
+    batched real FFT per block, using the precomputed transfer function of
+    the kernel. The last ncorr - 1 white samples of a block are kept to
+    filter the next one, so that the 1/f correlations are continuous across
+    the block boundaries.
+
+    The memory footprint of a block of nsamples is dominated by the white
+    noise history, the extended block and its FFTs: about
+    4 * ndetectors * (ncorr + nsamples) * 8 bytes, plus another
+    ndetectors * (ncorr + nsamples) * 8 bytes for the kernel transfer
+    function if the 1/f parameters differ between the detectors. The
+    default kernel length is therefore capped to NCORR_MAX samples, and
+    the blocks should not be much smaller than ncorr.
+
+    The white noise of a detector is drawn on a fixed grid of BLOCK_SIZE
+    samples, each block having its own random stream seeded by the
+    generator seed, the detector index and the block index. For a given
+    seed, the noise of a detector therefore depends neither on the sizes
+    of the generated blocks, nor on the other detectors handled by the
+    generator, i.e. the realization does not depend on the MPI
+    distribution of the detectors. Skipping to any time offset costs at
+    most the drawing of one grid block per detector, so that the processes
+    handling the end of a distributed sampling do not have to draw all the
+    preceding samples.
+
+    Example
+    -------
+    >>> noise = NoiseGenerator(992, 0.05, 1e-17, fknee=1, seed=0)
+    >>> for start in range(0, nsamples, 100000):
+    ...     out[:, start:start+100000] = noise(100000)
+
+    """
+    BLOCK_SIZE = 2**18
+    NCORR_MAX = 2**14
+
+    def __init__(self, ndetectors, sampling_period, sigma, fknee=0,
+                 fslope=1, sigma_white=0, ncorr=None, seed=None,
+                 detectors=None):
+        """
+        Parameters
+        ----------
+        ndetectors : int
+            The number of detectors.
+        sampling_period : float
+            The sampling period [s].
+        sigma : float or array of shape (ndetectors,)
+            Standard deviation of the white noise component of the
+            correlated noise.
+        fknee : float or array of shape (ndetectors,), optional
+            The 1/f noise knee frequency [Hz].
+        fslope : float or array of shape (ndetectors,), optional
+            The 1/f noise slope.
+        sigma_white : float or array of shape (ndetectors,), optional
+            Standard deviation of an additional white noise, such as the
+            photon noise.
+        ncorr : int, optional
+            The length of the filter kernel, in samples. The 1/f component
+            is flat below the frequency 1 / (ncorr * sampling_period). By
+            default, it is the power of two above 1000 / fknee seconds,
+            capped to NCORR_MAX samples (819 s at 20 Hz), since the memory
+            footprint grows linearly with ncorr.
+        seed : int, optional
+            The seed of the random generator. If not specified, a seed is
+            drawn from the numpy global random state.
+        detectors : array of shape (ndetectors,), optional
+            The global indices of the detectors, used to seed their random
+            streams. By default, they are 0, 1, ..., ndetectors - 1.
+
+        """
+        self.ndetectors = int(ndetectors)
+        self.sampling_period = sampling_period
+        self.sigma = _as_detector_array(sigma, ndetectors)
+        self.fknee = np.asarray(fknee, float)
+        self.fslope = np.asarray(fslope, float)
+        self.sigma_white = _as_detector_array(sigma_white, ndetectors)
+        if np.all(self.fknee == 0):
+            ncorr = 1
+        elif ncorr is None:
+            fmin = np.min(self.fknee[self.fknee > 0]) / 1000
+            ncorr = 2**int(np.ceil(np.log2(1 / (fmin * sampling_period))))
+            ncorr = min(ncorr, self.NCORR_MAX)
+        self.ncorr = int(ncorr)
+        self.kernel = self._get_kernel()
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed = int(seed)
+        if detectors is None:
+            detectors = np.arange(ndetectors)
+        self.detectors = np.asarray(detectors, int)
+        if self.detectors.shape != (self.ndetectors,):
+            raise ValueError(
+                'The number of detector indices is not {0}.'.format(
+                    self.ndetectors))
+        self._transfers = {}
+        self._randoms = {}
+        self.reset()
+
+    def __call__(self, nsamples):
+        """
+        Return the next block of noise, of shape (ndetectors, nsamples).
+
+        """
+        # the output sample t is obtained by filtering the white samples t
+        # to t + ncorr - 1 of the stream 0
+        if self.kernel is None:
+            out = self._draw(0, self._position, nsamples)
+        else:
+            if self._history is None:
+                self._history = self._draw(0, self._position, self.ncorr - 1)
+            extended = np.concatenate([self._history, self._draw(
+                0, self._position + self.ncorr - 1, nsamples)], axis=1)
+            out = self._filter(extended)
+            # copy, so that the extended block is not kept alive
+            self._history = extended[:, nsamples:].copy()
+        out *= self.sigma[:, None]
+        if np.any(self.sigma_white != 0):
+            out += self.sigma_white[:, None] * self._draw(
+                1, self._position, nsamples)
+        self._position += nsamples
+        return out
+
+    def reset(self):
+        """
+        Restart the noise realization from the beginning.
+
+        """
+        self._position = 0
+        self._history = None
+
+    def skip(self, nsamples):
+        """
+        Advance the noise realization by a number of samples, without
+        generating them. It is used to start the noise of a sampling
+        distributed over several processes at its global time offset.
+
+        """
+        self._position += int(nsamples)
+        self._history = None
+
+    def _draw(self, stream, start, nsamples):
+        """
+        Return the white noise samples start to start + nsamples of a random
+        stream, as an array of shape (ndetectors, nsamples). The random
+        states of the current grid block are kept, so that the samples
+        drawn in order are generated only once.
+
+        """
+        size = self.BLOCK_SIZE
+        position, randoms = self._randoms.get(stream, (None, None))
+        out = np.empty((self.ndetectors, nsamples))
+        i = 0
+        while i < nsamples:
+            t = start + i
+            if t != position or t % size == 0:
+                # seed the random states of the grid block of the sample t
+                randoms = [np.random.RandomState([self.seed, d, stream,
+                                                  t // size])
+                           for d in self.detectors]
+                for random in randoms:
+                    random.standard_normal(t % size)
+            n = min(nsamples - i, size - t % size)
+            for random, out_ in zip(randoms, out):
+                out_[i:i+n] = random.standard_normal(n)
+            i += n
+            position = t + n
+        self._randoms[stream] = position, randoms
+        return out
+
+    def _filter(self, extended):
+        """
+        Return the valid part of the convolution of the white noise by the
+        kernel, using the cached kernel transfer function.
+
+        """
+        nextended = extended.shape[1]
+        nfft = next_fast_len(nextended)
+        try:
+            transfer = self._transfers[nfft]
+        except KeyError:
+            transfer = np.fft.rfft(self.kernel, nfft)
+            self._transfers = {nfft: transfer}
+        spectrum = np.fft.rfft(extended, nfft)
+        spectrum *= transfer
+        return np.fft.irfft(spectrum, nfft)[:, self.ncorr-1:nextended]
+
+    def _get_kernel(self):
+        """
+        Return the zero-phase FIR kernel of the 1/f filter, of shape
+        (1, ncorr) or (ndetectors, ncorr) if the 1/f parameters are not the
+        same for all detectors.
+
+        """
+        if self.ncorr == 1:
+            return None
+        fknee = np.atleast_1d(self.fknee)[:, None]
+        fslope = np.atleast_1d(self.fslope)[:, None]
+        f = np.fft.rfftfreq(self.ncorr, d=self.sampling_period)
+        f[0] = f[1]
+        transfer = np.sqrt(1 + (fknee / f)**fslope)
+        kernel = np.fft.irfft(transfer, self.ncorr)
+        return np.roll(kernel, self.ncorr // 2, axis=-1)
+
+
+def _as_detector_array(x, ndetectors):
+    return np.array(np.broadcast_to(np.asarray(x, float), (ndetectors,)))
@@ -15,14 +15,16 @@ from pysimulators.interfaces.healpy import (
     HealpixConvolutionGaussianOperator)
 import qubic
 from .data import PATH
+from .mapmaking import _pcg_tod2map
 from .acquisition import (QubicAcquisition,
                           PlanckAcquisition,
                           QubicPlanckAcquisition)
 from .scene import QubicScene
-from .samplings import create_random_pointings, get_pointing
+from .samplings import create_random_pointings
 
 __all__ = ['compute_freq',
            'QubicPolyAcquisition',
+           'QubicPolyNoiseModel',
            'QubicPolyPlanckAcquisition']
 
 
@@ -98,6 +100,7 @@ class QubicPolyAcquisition(object):
             self.weights = np.ones(len(self))  # / len(self)
         else:
             self.weights = weights
+        self._noise_model = None
 
     def __getitem__(self, i):
         return self.subacqs[i]
@@ -148,52 +151,71 @@ class QubicPolyAcquisition(object):
 
     def _get_average_instrument_acq(self):
         """
-        Create and return a QubicAcquisition instance of a monochromatic
-            instrument with frequency correspondent to the mean of the
-            frequency range.
+        Return the QubicAcquisition instance of a monochromatic instrument
+            with frequency correspondent to the mean of the frequency range,
+            see get_noise_model.
         """
-        if len(self) == 1:
-            return self[0]
-        q0 = self[0].instrument
-        nu_min = q0.filter.nu
-        nu_max = self[-1].instrument.filter.nu
-        nep = q0.detector.nep
-        fknee = q0.detector.fknee
-        fslope = q0.detector.fslope
+        return self.get_noise_model().acquisition
 
-        d1 = self.d.copy()
-        d1['filter_nu'] = (nu_max + nu_min) / 2.
-        d1['filter_relative_bandwidth'] = (nu_max - nu_min) / ((nu_max + nu_min) / 2.)
-        d1['detector_nep'] = nep
-        d1['detector_fknee'] = fknee
-        d1['detector_fslope'] = fslope
-
-        q = qubic.QubicInstrument(d1, FRBW=self[0].instrument.FRBW)
-        q.detector = self[0].instrument.detector
-        s_ = self[0].sampling
-        nsamplings = self[0].comm.allreduce(len(s_))
-
-        d1['random_pointing'] = True
-        d1['sweeping_pointing'] = False
-        d1['repeat_pointing'] = False
-        d1['RA_center'] = 0.
-        d1['DEC_center'] = 0.
-        d1['npointings'] = nsamplings
-        d1['dtheta'] = 10.
-        d1['period'] = s_.period
-
-        s = get_pointing(d1)
-        # s = create_random_pointings([0., 0.], nsamplings, 10., period=s_.period)
-        a = QubicAcquisition(q, s, self[0].scene, d1)
-        return a
-
-    def get_noise(self):
-        a = self._get_average_instrument_acq()
-        return a.get_noise()
+    def get_noise_model(self):
+        """
+        Return the noise model of the polychromatic acquisition, which is
+        computed once and stored.
+        """
+        if self._noise_model is None:
+            self._noise_model = QubicPolyNoiseModel(self)
+        return self._noise_model
+
+    def get_noise(self, out=None, seed=None):
+        return self.get_noise_model().get_noise(out=out, seed=seed)
 
     def _get_array_of_operators(self):
         return [a.get_operator() * w for a, w in zip(self, self.weights)]
 
+    def _get_fused_operator(self, acqs, weights):
+        """
+        Return the weighted sum of the operators of the specified
+        subacquisitions, in which the peak sampling matrices of the
+        sub-frequencies are fused into a single one: the frequency-dependent
+        scalar and per-detector factors are folded into the peak values. It
+        returns None when the operators cannot be fused, i.e. when the scene
+        temperature is absolute or when the projection is computed on the
+        fly because of max_nbytes.
+
+        """
+        if len(acqs) == 0:
+            return None
+        a0 = acqs[0]
+        if a0.scene.absolute or len(a0.block) > 1:
+            return None
+        factors = []
+        for a, w in zip(acqs, weights):
+            ops = [a.get_filter_operator(),
+                   a.get_aperture_integration_operator(),
+                   a.get_unit_conversion_operator(),
+                   a.instrument.get_transmission_operator(),
+                   a.get_detector_integration_operator()]
+            if not all(isinstance(op, DiagonalOperator) for op in ops):
+                return None
+            factor = w
+            for op in ops:
+                factor = factor * np.asarray(op.data, float)
+            factors.append(np.broadcast_to(factor, (len(a.instrument),)))
+        projection = \
+            qubic.QubicMultibandInstrument._get_fused_projection_operator(
+                [a.instrument for a in acqs], a0.sampling, a0.scene,
+                factors=factors)
+        distribution = a0.get_distribution_operator()
+        trans_atm = a0.scene.atmosphere.transmission
+        response = a0.get_detector_response_operator()
+        polarizer = a0.get_polarizer_operator()
+        hwp = a0.get_hwp_operator()
+        with rule_manager(inplace=True):
+            H = CompositionOperator([
+                response, polarizer, hwp * projection, trans_atm,
+                distribution])
+        return H
+
     def get_operator_to_make_TOD(self):
         """
         Return a BlockRowOperator of subacquisition operators
@@ -211,6 +233,9 @@ class QubicPolyAcquisition(object):
         """
         if len(self) == 1:
             return self[0].get_operator()
+        H = self._get_fused_operator(self.subacqs, self.weights)
+        if H is not None:
+            return H
         op = np.array(self._get_array_of_operators())
         return np.sum(op, axis=0)
 
@@ -282,23 +307,101 @@ class QubicPolyAcquisition(object):
 
     def tod2map(self, tod, d, cov=None):
         """
-        Reconstruct map from tod
+        Reconstruct map from tod. As in QubicAcquisition.tod2map, the solve
+        is checkpointed and a stack of TODs sharing the pointing can be
+        given.
         """
-        tol = d['tol']
-        maxiter = d['maxiter']
-        verbose = d['verbose']
         H = self.get_operator()
         invntt = self.get_invntt_operator()
 
-        A = H.T * invntt * H
-        b = H.T * invntt * tod
-
         preconditioner = self.get_preconditioner(cov)
-        solution = pcg(A, b, M=preconditioner,
-                       disp=verbose, tol=tol, maxiter=maxiter)
+        solution = _pcg_tod2map(H, invntt, tod, preconditioner, d)
         return solution['x'], solution['nit'], solution['error']
 
 
+class QubicPolyNoiseModel(object):
+    """
+    The noise model of a polychromatic acquisition: the noise of the
+    monochromatic instrument whose frequency is the mean of the frequency
+    range, with the detector properties of the first subacquisition. The
+    average instrument is created once, and its acquisition shares the
+    sampling of the subacquisitions.
+
+    Attributes
+    ----------
+    acquisition : QubicAcquisition
+        The acquisition of the average instrument.
+    nep : float or array of shape (ndetectors,)
+        The detector NEP [W/sqrt(Hz)].
+    nep_photon : array of shape (ndetectors,)
+        The photon NEP [W/sqrt(Hz)], zero if the photon noise is not
+        included.
+    sigma : array of shape (ndetectors,)
+        Standard deviation of the white noise per sample [W].
+
+    """
+    def __init__(self, acq):
+        """
+        noise_model = QubicPolyNoiseModel(acq)
+
+        Parameter
+        ---------
+        acq : QubicPolyAcquisition
+            The polychromatic acquisition.
+
+        """
+        if len(acq) == 1:
+            a = acq[0]
+        else:
+            a = self._get_average_instrument_acq(acq)
+        period = a.sampling.period
+        self.acquisition = a
+        self.nep = a.instrument.detector.nep
+        if a.photon_noise:
+            self.nep_photon = a.instrument._get_noise_photon_nep(a.scene)
+        else:
+            self.nep_photon = np.zeros(len(a.instrument))
+        self.sigma = np.sqrt(self.nep**2 + self.nep_photon**2) / \
+            np.sqrt(2 * period)
+
+    @staticmethod
+    def _get_average_instrument_acq(acq):
+        q0 = acq[0].instrument
+        nu_min = q0.filter.nu
+        nu_max = acq[-1].instrument.filter.nu
+
+        d1 = acq.d.copy()
+        d1['filter_nu'] = (nu_max + nu_min) / 2.
+        d1['filter_relative_bandwidth'] = (nu_max - nu_min) / ((nu_max + nu_min) / 2.)
+        d1['detector_nep'] = q0.detector.nep
+        d1['detector_fknee'] = q0.detector.fknee
+        d1['detector_fslope'] = q0.detector.fslope
+
+        q = qubic.QubicInstrument(d1, FRBW=q0.FRBW)
+        q.detector = q0.detector
+        # the noise does not depend on the pointing directions
+        return QubicAcquisition(q, acq[0].sampling, acq[0].scene, d1)
+
+    def get_noise(self, out=None, seed=None):
+        """
+        Return a noise realization (#det, #sampling).
+        """
+        return self.acquisition.get_noise(out=out, seed=seed)
+
+    def get_noise_generator(self, seed=None):
+        """
+        Return the NoiseGenerator of the noise, to draw it by blocks of time
+        samples.
+        """
+        return self.acquisition.get_noise_generator(seed=seed)
+
+    def get_invntt_operator(self):
+        """
+        Return the inverse time-time noise correlation matrix as an Operator.
+        """
+        return self.acquisition.get_invntt_operator()
+
+
 class QubicPolyPlanckAcquisition(QubicPlanckAcquisition):
     """
     The QubicPolyAcquisition class, which combines the QubicPoly and Planck
@@ -374,14 +477,9 @@ class QubicPolyPlanckAcquisition(QubicPlanckAcquisition):
         return preconditioner
 
     def tod2map(self, tod, d):
-        tol = d['tol']
-        maxiter = d['maxiter']
-        verbose = d['verbose']
         H = self.get_operator()
         invntt = self.get_invntt_operator()
-        A = H.T * invntt * H
-        b = H.T * invntt * tod
 
         preconditioner = self.get_preconditioner(H)
-        solution = pcg(A, b, M=preconditioner, disp=verbose, tol=tol, maxiter=maxiter)
+        solution = _pcg_tod2map(H, invntt, tod, preconditioner, d)
         return solution['x']
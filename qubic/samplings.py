@@ -2,12 +2,18 @@
 from __future__ import division, print_function
 
 import numpy as np
+import os
+import struct
+import threading
+import zipfile
+import zlib
 from astropy.time import Time, TimeDelta
+from collections import OrderedDict
 from numpy.random import random_sample as randomu
 from pyoperators import (
-    Cartesian2SphericalOperator, Rotation3dOperator,
+    Cartesian2SphericalOperator, MPI, Rotation3dOperator,
     Spherical2CartesianOperator, rule_manager)
-from pyoperators.utils import deprecated, isscalarlike
+from pyoperators.utils import deprecated, isscalarlike, split
 from pysimulators import (
     CartesianEquatorial2GalacticOperator,
     CartesianEquatorial2HorizontalOperator,
@@ -21,6 +27,7 @@ from pysimulators import (
 from pysimulators.interfaces.healpy import Cartesian2HealpixOperator
 
 __all__ = ['QubicSampling',
+           'QubicRotation',
            'get_pointing',
            'create_random_pointings',
            'create_repeat_pointings',
@@ -90,20 +97,29 @@ class QubicSampling(SamplingHorizontal):
         rotation = c2h(e2g(h2e))
         return rotation(self.cartesian)
 
+    def scatter(self, comm=None):
+        """
+        MPI-scatter of the sampling. A sampling already distributed over the
+        same communicator, such as the output of get_pointing with a
+        communicator, is returned as is.
+
+        """
+        if self.comm.size > 1:
+            if comm is not None and \
+               self.comm.Compare(comm) in (MPI.IDENT, MPI.CONGRUENT):
+                return self
+            raise ValueError(
+                'The sampling is already distributed over another communica'
+                'tor.')
+        return SamplingHorizontal.scatter(self, comm)
+
     @property
     def cartesian_galactic2instrument(self):
         """
         Return the galactic-to-instrument transform.
 
         """
-        time = self.date_obs + TimeDelta(self.time, format='sec')
-        with rule_manager(none=False):
-            r = Rotation3dOperator("ZY'Z''", self.azimuth, 90 - self.elevation,
-                                   self.pitch, degrees=True).T * \
-                CartesianEquatorial2HorizontalOperator(
-                    'NE', time, self.latitude, self.longitude) * \
-                CartesianGalactic2EquatorialOperator()
-        return r
+        return self._get_rotation_operator('galactic')
 
     @property
     def cartesian_instrument2galactic(self):
@@ -112,25 +128,315 @@ class QubicSampling(SamplingHorizontal):
     @property
     def cartesian_horizontal2instrument(self):
         """
-        Return the galactic-to-instrument transform.
+        Return the horizontal-to-instrument transform.
         """
-        time = self.date_obs + TimeDelta(self.time, format='sec')
-        with rule_manager(none=False):
-            r = Rotation3dOperator("ZY'Z''", self.azimuth, 90 - self.elevation,
-                                   self.pitch, degrees=True).T
-        return r
+        return self._get_rotation_operator('horizontal')
 
     @property
     def cartesian_instrument2horizontal(self):
         return self.cartesian_horizontal2instrument.I
 
+    def get_rotation(self, kind='galactic'):
+        """
+        Return the galactic-to-instrument or horizontal-to-instrument
+        rotation matrices as a QubicRotation, which computes them lazily by
+        blocks of time samples. The rotations are stored with the sampling,
+        so that the acquisitions sharing it, such as the subacquisitions of
+        a polychromatic acquisition, also share the computed blocks.
+
+        Parameter
+        ---------
+        kind : 'galactic' or 'horizontal'
+            The reference frame of the sky.
+
+        """
+        if kind not in ('galactic', 'horizontal'):
+            raise ValueError("Invalid rotation kind '{}'.".format(kind))
+        try:
+            rotations = object.__getattribute__(self, '_rotations')
+        except AttributeError:
+            rotations = OrderedDict()
+            object.__setattr__(self, '_rotations', rotations)
+        # the key identifies the pointings, since the sampling attributes
+        # can be modified and the slices of the sampling share the storage
+        key = (kind, len(self), str(self.date_obs), float(self.latitude),
+               float(self.longitude)) + tuple(
+            zlib.crc32(np.atleast_1d(np.ascontiguousarray(
+                getattr(self, _))).view(np.uint8))
+            for _ in ('time', 'azimuth', 'elevation', 'pitch'))
+        try:
+            rotation = rotations.pop(key)
+        except KeyError:
+            rotation = QubicRotation(self, kind)
+            if len(rotations) >= 4:
+                rotations.popitem(last=False)
+        rotations[key] = rotation
+        return rotation
+
+    def _get_rotation_operator(self, kind, start=None, stop=None):
+        """
+        Return the galactic-to-instrument or horizontal-to-instrument
+        transform of the time samples start:stop.
+
+        """
+        def get(x):
+            x = np.asarray(x)
+            return x if x.ndim == 0 else x[start:stop]
+        with rule_manager(none=False):
+            r = Rotation3dOperator(
+                "ZY'Z''", get(self.azimuth), 90 - get(self.elevation),
+                get(self.pitch), degrees=True).T
+            if kind == 'galactic':
+                time = self.date_obs + TimeDelta(get(self.time), format='sec')
+                r = r * CartesianEquatorial2HorizontalOperator(
+                        'NE', time, self.latitude, self.longitude) * \
+                    CartesianGalactic2EquatorialOperator()
+        return r
+
+    def save(self, filename, rotation=True):
+        """
+        Save the sampling in an uncompressed .npz file, which can be
+        memory-mapped by QubicSampling.load. The file stores the azimuth,
+        elevation, pitch, HWP angle and time of the samples, the
+        observation parameters and, optionally, the rotations as unit
+        quaternions, so that they are not computed again after loading.
+
+        Parameters
+        ----------
+        filename : str
+            The file name. The .npz extension is appended if missing.
+        rotation : boolean, optional
+            If true, the galactic-to-instrument rotations, or the
+            horizontal-to-instrument ones if the azimuth is fixed, are
+            stored.
+
+        """
+        fix_az = bool(getattr(self, 'fix_az', False))
+        kind = 'horizontal' if fix_az else 'galactic'
+        n = len(self)
+        arrays = dict(
+            (_, np.array(np.broadcast_to(getattr(self, _), (n,)), float))
+            for _ in ('azimuth', 'elevation', 'pitch', 'angle_hwp', 'time'))
+        if rotation:
+            r = self.get_rotation(kind)
+            # the galactic rotations include a reflection, which cannot be
+            # represented by a quaternion: the opposite rotations are stored
+            determinant = np.sign(np.linalg.det(r[:1])).item() if n > 0 \
+                else 1.
+            quaternion = np.empty((n, 4))
+            for start in range(0, n, r.nsamples_chunk):
+                stop = min(start + r.nsamples_chunk, n)
+                quaternion[start:stop] = _rotation2quaternion(
+                    determinant * r[start:stop])
+            arrays['quaternion_' + kind] = quaternion
+            arrays['determinant_' + kind] = determinant
+        date_obs = self.date_obs.iso
+        if not isinstance(date_obs, str):
+            date_obs = date_obs[0]
+        np.savez(filename, date_obs=date_obs, period=self.period,
+                 latitude=self.latitude, longitude=self.longitude,
+                 fix_az=fix_az, **arrays)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        """
+        Load a sampling saved by QubicSampling.save. By default, the arrays
+        are memory-mapped read-only, so that the processes of a run share
+        the same pages. In that case, the sampling attributes cannot be
+        modified in place.
+
+        Parameters
+        ----------
+        filename : str
+            The .npz file name.
+        mmap : boolean, optional
+            If false, the arrays are read in memory.
+
+        """
+        if mmap:
+            data = _load_npz_mmap(filename)
+        else:
+            with np.load(filename) as f:
+                data = dict(f)
+        keywords = dict((k, v) for k, v in data.items()
+                        if k.startswith('quaternion_'))
+        out = cls(len(data['time']), azimuth=data['azimuth'],
+                  elevation=data['elevation'], pitch=data['pitch'],
+                  angle_hwp=data['angle_hwp'], time=data['time'],
+                  date_obs=str(data['date_obs'][()]),
+                  period=float(data['period']),
+                  latitude=float(data['latitude']),
+                  longitude=float(data['longitude']), **keywords)
+        out.fix_az = bool(data['fix_az'])
+        for k in data:
+            if k.startswith('determinant_'):
+                setattr(out, k, float(data[k]))
+        return out
+
+
+class QubicRotation(object):
+    """
+    The rotation matrices of shape (ntimes, 3, 3) of a sampling, from the
+    galactic or horizontal frame to the instrument frame. They are computed
+    lazily by blocks of time samples, and the most recently used blocks are
+    kept in memory up to a maximum number of bytes. The rotation matrices
+    are accessed by slicing, such as rotation[start:stop], or as a whole
+    through the data attribute. The returned arrays must not be modified.
+    If the sampling has been loaded with its rotations (see
+    QubicSampling.load), they are obtained from the stored quaternions.
+
+    Example
+    -------
+    >>> rotation = sampling.get_rotation('galactic')
+    >>> for start in range(0, len(rotation), 1000):
+    ...     r = rotation[start:start+1000]
+
+    """
+    def __init__(self, sampling, kind='galactic', nsamples_chunk=2**16,
+                 max_nbytes=2**28):
+        """
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The sampling.
+        kind : 'galactic' or 'horizontal'
+            The reference frame of the sky.
+        nsamples_chunk : int, optional
+            The number of time samples of the blocks.
+        max_nbytes : int, optional
+            The maximum number of bytes of the stored blocks.
+
+        """
+        self.sampling = sampling
+        self.kind = kind
+        self.nsamples_chunk = int(nsamples_chunk)
+        self.max_nbytes = max_nbytes
+        self.shape = (len(sampling), 3, 3)
+        self.ndim = 3
+        self.dtype = np.dtype(float)
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the stored blocks and the lock are not pickled
+        state = self.__dict__.copy()
+        del state['_chunks'], state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            start, stop, step = x.indices(len(self))
+            if step == 1:
+                return self._get(start, max(start, stop))
+        elif isinstance(x, (int, np.integer)):
+            if x < 0:
+                x += len(self)
+            return self._get(x, x + 1)[0]
+        return self.data[x]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.data, dtype=dtype)
+
+    @property
+    def data(self):
+        """
+        The rotation matrices of all the time samples. Unless they fit in
+        one block, they are computed block by block into a new array,
+        without storing the blocks, so that only the stored blocks are
+        reused and the whole rotations are not held twice.
+
+        """
+        n = self.nsamples_chunk
+        if len(self) <= n:
+            return self._get(0, len(self))
+        out = np.empty(self.shape)
+        for i in range((len(self) - 1) // n + 1):
+            with self._lock:
+                chunk = self._chunks.get(i)
+            if chunk is None:
+                chunk = self._compute_chunk(i)
+            out[i * n:(i + 1) * n] = chunk
+        return out
+
+    def clear(self):
+        """
+        Discard the stored blocks.
+
+        """
+        with self._lock:
+            self._chunks.clear()
+
+    def _get(self, start, stop):
+        n = self.nsamples_chunk
+        out = [self._get_chunk(i)[max(start - i * n, 0):stop - i * n]
+               for i in range(start // n, (stop - 1) // n + 1)]
+        if len(out) == 1:
+            return out[0]
+        if len(out) == 0:
+            return np.empty((0, 3, 3))
+        return np.concatenate(out)
+
+    def _get_chunk(self, i):
+        with self._lock:
+            try:
+                chunk = self._chunks.pop(i)
+                self._chunks[i] = chunk
+                return chunk
+            except KeyError:
+                pass
+        chunk = self._compute_chunk(i)
+        with self._lock:
+            self._chunks[i] = chunk
+            nbytes = sum(_.nbytes for _ in self._chunks.values())
+            while nbytes > self.max_nbytes and len(self._chunks) > 1:
+                nbytes -= self._chunks.popitem(last=False)[1].nbytes
+        return chunk
+
+    def _compute_chunk(self, i):
+        start = i * self.nsamples_chunk
+        stop = min(start + self.nsamples_chunk, len(self))
+        quaternion = getattr(self.sampling, 'quaternion_' + self.kind, None)
+        if quaternion is not None:
+            data = _quaternion2rotation(quaternion[start:stop])
+            data *= getattr(self.sampling, 'determinant_' + self.kind, 1)
+        else:
+            data = self.sampling._get_rotation_operator(
+                self.kind, start, stop).data
+        chunk = np.array(np.broadcast_to(data, (stop - start, 3, 3)))
+        chunk.flags.writeable = False
+        return chunk
+
 
 @deprecated
 class QubicPointing(QubicSampling):
     pass
 
 
-def get_pointing(d):
+def get_pointing(d, comm=None):
+    """
+    Return the pointing strategy specified in the dictionary.
+
+    Parameters
+    ----------
+    d : qubicDict
+        The dictionary specifying the pointing strategy.
+    comm : mpi4py.MPI.Comm, optional
+        If specified, only the time samples handled by the local process
+        are computed, the sampling being distributed over the communicator
+        as QubicAcquisition does (it must be the acquisition's sampling
+        communicator, i.e. the acquisition's communicator when
+        nprocs_instrument is 1). The random draws do not depend on the
+        number of processes.
+
+    """
     if [d['random_pointing'], d['sweeping_pointing'], d['repeat_pointing']].count(True) != 1:
         raise ValueError("Error: you should choose one pointing")
 
@@ -140,13 +446,15 @@ def get_pointing(d):
         return create_random_pointings(center, d['npointings'], d['dtheta'], d['hwp_stepsize'],
                                        date_obs=d['date_obs'], period=d['period'],
                                        latitude=d['latitude'],
-                                       longitude=d['longitude'], seed=d['seed'])
+                                       longitude=d['longitude'], seed=d['seed'],
+                                       comm=comm)
 
     elif d['repeat_pointing'] is True:
         return create_repeat_pointings(center, d['npointings'], d['dtheta'], d['nhwp_angles'],
                                        date_obs=d['date_obs'], period=d['period'],
                                        latitude=d['latitude'],
-                                       longitude=d['longitude'], seed=d['seed'])
+                                       longitude=d['longitude'], seed=d['seed'],
+                                       comm=comm)
 
     elif d['sweeping_pointing'] is True:
         return create_sweeping_pointings(center, d['duration'], d['period'],
@@ -156,11 +464,13 @@ def get_pointing(d):
                                          date_obs=d['date_obs'],
                                          latitude=d['latitude'],
                                          longitude=d['longitude'],
-                                         fix_azimuth=d['fix_azimuth'], random_hwp=d['random_hwp'])
+                                         fix_azimuth=d['fix_azimuth'], random_hwp=d['random_hwp'],
+                                         seed=d.get('seed'), comm=comm)
 
 
 def create_random_pointings(center, npointings, dtheta, hwp_stepsize, date_obs=None,
-                            period=None, latitude=None, longitude=None, seed=None):
+                            period=None, latitude=None, longitude=None, seed=None,
+                            comm=None):
     """
     Return pointings randomly and uniformly distributed in a spherical cap.
 
@@ -192,17 +502,23 @@ def create_random_pointings(center, npointings, dtheta, hwp_stepsize, date_obs=N
         The observer's longitude [degrees]. Default is DOMEC's.
     seed : int
         Random seed.
+    comm : mpi4py.MPI.Comm, optional
+        If specified, only the local part of the sampling distributed over
+        the communicator is returned, see get_pointing.
 
     """
 
-    r = np.random.RandomState(seed)
+    r = np.random.RandomState(_get_seed(seed, comm))
 
+    # all the random numbers are drawn, so that they do not depend on the
+    # number of processes
     cosdtheta = np.cos(np.radians(dtheta))
     theta = np.degrees(np.arccos(cosdtheta + (1 - cosdtheta) * r.rand(npointings)))
     phi = r.rand(npointings) * 360
     pitch = r.rand(npointings) * 360
-    p = QubicSampling(
-        npointings, date_obs=date_obs, period=period, latitude=latitude,
+    angle_hwp = r.randint(0, int(90 / hwp_stepsize + 1), npointings) * hwp_stepsize
+    p, local = _create_sampling(
+        npointings, comm, date_obs=date_obs, period=period, latitude=latitude,
         longitude=longitude)
     time = p.date_obs + TimeDelta(p.time, format='sec')
     c2s = Cartesian2SphericalOperator('azimuth,elevation', degrees=True)
@@ -211,17 +527,18 @@ def create_random_pointings(center, npointings, dtheta, hwp_stepsize, date_obs=N
     rot = Rotation3dOperator("ZY'", center[0], 90 - center[1], degrees=True)
     s2c = Spherical2CartesianOperator('zenith,azimuth', degrees=True)
     rotation = c2s(e2h(rot(s2c)))
-    coords = rotation(np.asarray([theta.T, phi.T]).T)
+    coords = rotation(np.asarray([theta[local].T, phi[local].T]).T)
     p.azimuth = coords[..., 0]
     p.elevation = coords[..., 1]
-    p.pitch = pitch
+    p.pitch = pitch[local]
     p.fix_az = False
-    p.angle_hwp = r.randint(0, int(90 / hwp_stepsize + 1), npointings) * hwp_stepsize
+    p.angle_hwp = angle_hwp[local]
     return p
 
 
 def create_repeat_pointings(center, npointings, dtheta, nhwp_angles, date_obs=None,
-                            period=None, latitude=None, longitude=None, seed=None):
+                            period=None, latitude=None, longitude=None, seed=None,
+                            comm=None):
     """
     Return pointings randomly and uniformly distributed in a spherical cap. 
     The same pointing is repeated nhwp_angles times with a different
@@ -247,12 +564,16 @@ def create_repeat_pointings(center, npointings, dtheta, nhwp_angles, date_obs=No
         The observer's longitude [degrees]. Default is DOMEC's.
     seed : int
         Random seed.
+    comm : mpi4py.MPI.Comm, optional
+        If specified, only the local part of the sampling distributed over
+        the communicator is returned, see get_pointing.
     """
 
-    r = np.random.RandomState(seed)
-    nrandom = np.int(npointings / nhwp_angles)  # number of real random pointings
-    print('You asked {0} pointings with repeat strategy so I will provide {1} pointings '
-          'repeated {2} times.'.format(npointings, nrandom, nhwp_angles))
+    r = np.random.RandomState(_get_seed(seed, comm))
+    nrandom = int(npointings / nhwp_angles)  # number of real random pointings
+    if comm is None or comm.rank == 0:
+        print('You asked {0} pointings with repeat strategy so I will provide {1} pointings '
+              'repeated {2} times.'.format(npointings, nrandom, nhwp_angles))
 
     # Creation of nrandom pointing 
     cosdtheta = np.cos(np.radians(dtheta))
@@ -260,45 +581,40 @@ def create_repeat_pointings(center, npointings, dtheta, nhwp_angles, date_obs=No
     phi = r.rand(nrandom) * 360
     pitch = r.rand(nrandom) * 360
 
-    p = QubicSampling(
-        nrandom, date_obs=date_obs, period=period, latitude=latitude,
-        longitude=longitude)
+    # Replication of the same pointing with others fix hwp angles
+    pp, local = _create_sampling(
+        nrandom * nhwp_angles, comm, date_obs=date_obs, period=period,
+        latitude=latitude, longitude=longitude)
+    index = np.arange(local.start, local.stop)
+    ihwp, irandom = divmod(index, nrandom)
 
-    time = p.date_obs + TimeDelta(p.time, format='sec')
+    # only the random pointings handled by the local process are converted
+    irandom_local, inverse = np.unique(irandom, return_inverse=True)
+    time = pp.date_obs + TimeDelta(irandom_local * pp.period, format='sec')
 
     c2s = Cartesian2SphericalOperator('azimuth,elevation', degrees=True)
     e2h = CartesianEquatorial2HorizontalOperator(
-        'NE', time, p.latitude, p.longitude)
+        'NE', time, pp.latitude, pp.longitude)
     rot = Rotation3dOperator("ZY'", center[0], 90 - center[1], degrees=True)
     s2c = Spherical2CartesianOperator('zenith,azimuth', degrees=True)
     rotation = c2s(e2h(rot(s2c)))
-    coords = rotation(np.asarray([theta.T, phi.T]).T)
-
-    p.azimuth = coords[..., 0]
-    p.elevation = coords[..., 1]
-    p.pitch = pitch
-    p.fix_az = False
-
-    # Replication of the same pointing with others fix hwp angles
-    pp = QubicSampling(
-        nrandom * nhwp_angles, date_obs=date_obs, period=period, latitude=latitude,
-        longitude=longitude)
-
-    pp.azimuth = np.tile(p.azimuth, nhwp_angles)
-    pp.elevation = np.tile(p.elevation, nhwp_angles)
-    pp.pitch = np.tile(p.pitch, nhwp_angles)
-    pp.time = np.tile(p.time, nhwp_angles)
-    pp.angle_hwp = np.zeros(nrandom * nhwp_angles)
+    coords = rotation(np.asarray([theta[irandom_local].T,
+                                  phi[irandom_local].T]).T)
+
+    pp.azimuth = coords[inverse, 0]
+    pp.elevation = coords[inverse, 1]
+    pp.pitch = pitch[irandom]
+    pp.time = irandom * pp.period
+    pp.angle_hwp = np.rad2deg(ihwp * np.pi / (nhwp_angles * 2))
     pp.fix_az = False
-    for hwp in range(nhwp_angles):
-        pp.angle_hwp[hwp * nrandom: (hwp + 1) * nrandom] = np.array(np.rad2deg(hwp * np.pi / (nhwp_angles * 2)))
 
     return pp
 
 
 def create_sweeping_pointings(
         center, duration, period, angspeed, delta_az, nsweeps_per_elevation,
-        angspeed_psi, maxpsi, hwp_stepsize, date_obs=None, latitude=None, longitude=None, fix_azimuth=None, random_hwp=True):
+        angspeed_psi, maxpsi, hwp_stepsize, date_obs=None, latitude=None, longitude=None, fix_azimuth=None, random_hwp=True,
+        seed=None, comm=None):
     """
     Return pointings according to the sweeping strategy:
     Sweep around the tracked FOV center azimuth at a fixed elevation, and
@@ -332,6 +648,16 @@ def create_sweeping_pointings(
     date_obs : str or astropy.time.Time, optional
         The starting date of the observation (UTC).
     random_hwp : bool
+    seed : int, optional
+        Random seed of the HWP angles, if random_hwp is set. get_pointing
+        passes the 'seed' of the dictionary, so that the HWP angles of the
+        sweeping strategy are reproducible, as the pointings of the random
+        and repeat strategies. If not specified, the angles are drawn from
+        the numpy global random state, as in the former implementation
+        (on the first process, if the sampling is distributed).
+    comm : mpi4py.MPI.Comm, optional
+        If specified, only the local part of the sampling distributed over
+        the communicator is returned, see get_pointing.
 
     Returns
     -------
@@ -341,8 +667,8 @@ def create_sweeping_pointings(
 
     """
     nsamples = int(np.ceil(duration * 3600 / period))
-    out = QubicSampling(
-        nsamples, date_obs=date_obs, period=period, latitude=latitude,
+    out, local = _create_sampling(
+        nsamples, comm, date_obs=date_obs, period=period, latitude=latitude,
         longitude=longitude)
     racenter = center[0]
     deccenter = center[1]
@@ -351,15 +677,6 @@ def create_sweeping_pointings(
     # compute the sweep number
     isweeps = np.floor(out.time / backforthdt).astype(int)
 
-    # azimuth/elevation of the center of the field as a function of time
-
-    if fix_azimuth['apply']:
-        azcenter = out.time * 0 + fix_azimuth['az']
-        elcenter = out.time * 0 + fix_azimuth['el']
-    else:
-        azcenter, elcenter = equ2hor(racenter, deccenter, out.time, date_obs=out.date_obs, latitude=out.latitude,
-                                     longitude=out.longitude)
-
     # compute azimuth offset for all time samples
     daz = out.time * angspeed
     daz = daz % (delta_az * 2)
@@ -368,16 +685,37 @@ def create_sweeping_pointings(
     daz -= delta_az / 2
 
     # elevation is kept constant during nsweeps_per_elevation
-    elcst = np.zeros(nsamples)
     ielevations = isweeps // nsweeps_per_elevation
-    nelevations = ielevations[-1] + 1
-    for i in range(nelevations):
-        mask = ielevations == i
-        elcst[mask] = np.mean(elcenter[mask])
-        if fix_azimuth is not None:
-            if fix_azimuth['apply']:
-                el_step = fix_azimuth['el_step']
-                elcst[mask] = elcenter[mask] - nelevations / 2 * el_step + i * el_step
+    nelevations = int(np.floor((nsamples - 1) * out.period / backforthdt)) \
+        // nsweeps_per_elevation + 1
+
+    # azimuth/elevation of the center of the field as a function of time
+    if fix_azimuth['apply']:
+        azcenter = out.time * 0 + fix_azimuth['az']
+        elcenter = out.time * 0 + fix_azimuth['el']
+        el_step = fix_azimuth['el_step']
+        elcst = elcenter - nelevations / 2 * el_step + ielevations * el_step
+    elif len(out) == 0:
+        azcenter = elcst = np.zeros(0)
+    else:
+        # the elevation phases of the local samples are computed entirely,
+        # they may extend over the samples of the other processes
+        e0, e1 = ielevations[0], ielevations[-1]
+        nsamples_elevation = nsweeps_per_elevation * backforthdt / out.period
+        i0 = max(int(np.floor(e0 * nsamples_elevation)) - 1, 0)
+        i1 = min(int(np.ceil((e1 + 1) * nsamples_elevation)) + 1, nsamples)
+        time = np.arange(i0, i1) * out.period
+        ielevations_ = np.floor(time / backforthdt).astype(int) // \
+            nsweeps_per_elevation
+        azcenter, elcenter = _equ2hor_interp(
+            racenter, deccenter, time, date_obs=out.date_obs,
+            latitude=out.latitude, longitude=out.longitude)
+        azcenter = azcenter[local.start-i0:local.stop-i0]
+        keep = (ielevations_ >= e0) & (ielevations_ <= e1)
+        elmean = np.bincount(ielevations_[keep] - e0,
+                             weights=elcenter[keep]) / \
+            np.maximum(np.bincount(ielevations_[keep] - e0), 1)
+        elcst = elmean[ielevations - e0]
 
     # azimuth and elevations to use for pointing
     azptg = azcenter + daz
@@ -394,13 +732,20 @@ def create_sweeping_pointings(
     out.elevation = elptg
     out.pitch = pitch
     if random_hwp:
-        out.angle_hwp = np.random.randint(0, int(90 / hwp_stepsize + 1), nsamples) * hwp_stepsize
+        # all the random numbers are drawn, so that they do not depend on
+        # the number of processes
+        if seed is None and (comm is None or comm.size == 1):
+            r = np.random
+        else:
+            r = np.random.RandomState(_get_seed(seed, comm))
+        out.angle_hwp = r.randint(0, int(90 / hwp_stepsize + 1), nsamples)[local] * hwp_stepsize
     else:
-        out.angle_hwp = np.zeros(nsamples)
-        max_sweeps = np.max(isweeps)
+        max_sweeps = int(np.floor((nsamples - 1) * out.period / backforthdt))
         delta = int(nsamples / max_sweeps)
-        for i in range(max_sweeps):
-            out.angle_hwp[i * delta:(i + 1) * delta] = hwp_stepsize * np.mod(i, int(90 / hwp_stepsize + 1))
+        isteps = np.arange(local.start, local.stop) // delta
+        out.angle_hwp = np.where(
+            isteps < max_sweeps,
+            hwp_stepsize * np.mod(isteps, int(90 / hwp_stepsize + 1)), 0)
 
     if fix_azimuth['apply']:
         out.fix_az = True
@@ -414,6 +759,160 @@ def create_sweeping_pointings(
     return out
 
 
+def _create_sampling(n, comm=None, **keywords):
+    """
+    Return the QubicSampling of n samples without pointings, or, if a
+    communicator is specified, its local part as distributed by
+    QubicSampling.scatter, and the slice of the local samples.
+
+    """
+    if comm is None or comm.size == 1:
+        return QubicSampling(n, **keywords), slice(0, n)
+    # only the local samples are selected, their global indices setting
+    # the time offset, as in QubicSampling.scatter
+    local = split(n, comm.size, comm.rank)
+    out = QubicSampling(n, selection=local, **keywords)
+    object.__setattr__(out, 'comm', comm)
+    return out, local
+
+
+def _get_seed(seed, comm=None):
+    """
+    Return the random seed, drawn by the first process and broadcast if it
+    is not specified.
+
+    """
+    if seed is not None or comm is None or comm.size == 1:
+        return seed
+    if comm.rank == 0:
+        seed = np.random.randint(2**31)
+    return comm.bcast(seed)
+
+
+def _equ2hor_interp(ra, dec, time, date_obs=QubicSampling.DEFAULT_DATE_OBS,
+                    latitude=DOMECLAT, longitude=DOMECLON, step=60.):
+    """
+    Equatorial to horizontal spherical conversion of a fixed sky position,
+    as given by equ2hor, for a large number of time samples. The conversion
+    is done on a time grid of given step [s] and linearly interpolated: for
+    the sidereal motion, the interpolation error is below one arcsecond
+    with the default step of one minute. The time samples must be sorted.
+
+    """
+    time = np.asarray(time)
+    if time.size == 0:
+        return equ2hor(ra, dec, time, date_obs=date_obs, latitude=latitude,
+                       longitude=longitude)
+    # the grid is aligned on multiples of the step, so that the result for
+    # a time sample does not depend on the other samples
+    igrid = np.arange(np.floor(time[0] / step), np.ceil(time[-1] / step) + 1)
+    tgrid = igrid * step
+    # the position is broadcast to the time grid, since the operators of
+    # recent pyoperators versions do not broadcast a single input vector
+    azgrid, elgrid = equ2hor(
+        np.full_like(tgrid, ra), np.full_like(tgrid, dec), tgrid,
+        date_obs=date_obs, latitude=latitude, longitude=longitude)
+    az = np.interp(time, tgrid, np.degrees(np.unwrap(np.radians(azgrid))))
+    # keep the azimuth range of equ2hor
+    if np.any(azgrid < 0):
+        az = (az + 180) % 360 - 180
+    else:
+        az %= 360
+    el = np.interp(time, tgrid, elgrid)
+    return az, el
+
+
+def _rotation2quaternion(r):
+    """
+    Convert rotation matrices of shape (..., 3, 3) into unit quaternions
+    (w, x, y, z) of shape (..., 4).
+
+    """
+    r = np.asarray(r)
+    q = np.empty(r.shape[:-2] + (4,))
+    trace = r[..., 0, 0] + r[..., 1, 1] + r[..., 2, 2]
+    # the largest of the four components is computed first, for accuracy
+    q[..., 0] = 1 + trace
+    q[..., 1] = 1 + 2 * r[..., 0, 0] - trace
+    q[..., 2] = 1 + 2 * r[..., 1, 1] - trace
+    q[..., 3] = 1 + 2 * r[..., 2, 2] - trace
+    imax = np.argmax(q, axis=-1)
+    qmax = np.sqrt(np.maximum(np.max(q, axis=-1), 0)) / 2
+    d = np.zeros(r.shape[:-2] + (4, 4))
+    d[..., 0, 1] = r[..., 2, 1] - r[..., 1, 2]
+    d[..., 0, 2] = r[..., 0, 2] - r[..., 2, 0]
+    d[..., 0, 3] = r[..., 1, 0] - r[..., 0, 1]
+    d[..., 1, 2] = r[..., 0, 1] + r[..., 1, 0]
+    d[..., 1, 3] = r[..., 0, 2] + r[..., 2, 0]
+    d[..., 2, 3] = r[..., 1, 2] + r[..., 2, 1]
+    d += np.swapaxes(d, -1, -2)
+    row = np.take_along_axis(d, imax[..., None, None], axis=-2)[..., 0, :]
+    q = row / (4 * qmax[..., None])
+    np.put_along_axis(q, imax[..., None], qmax[..., None], axis=-1)
+    q *= np.where(q[..., :1] < 0, -1, 1)
+    return q
+
+
+def _quaternion2rotation(q):
+    """
+    Convert unit quaternions (w, x, y, z) of shape (..., 4) into rotation
+    matrices of shape (..., 3, 3).
+
+    """
+    w, x, y, z = np.moveaxis(np.asarray(q, float), -1, 0)
+    r = np.empty(w.shape + (3, 3))
+    r[..., 0, 0] = 1 - 2 * (y**2 + z**2)
+    r[..., 0, 1] = 2 * (x * y - w * z)
+    r[..., 0, 2] = 2 * (x * z + w * y)
+    r[..., 1, 0] = 2 * (x * y + w * z)
+    r[..., 1, 1] = 1 - 2 * (x**2 + z**2)
+    r[..., 1, 2] = 2 * (y * z - w * x)
+    r[..., 2, 0] = 2 * (x * z - w * y)
+    r[..., 2, 1] = 2 * (y * z + w * x)
+    r[..., 2, 2] = 1 - 2 * (x**2 + y**2)
+    return r
+
+
+def _load_npz_mmap(filename):
+    """
+    Return the arrays of an uncompressed .npz file as read-only memory
+    maps, as np.load does for .npy files with mmap_mode='r'.
+
+    """
+    out = {}
+    with zipfile.ZipFile(filename) as z:
+        infos = z.infolist()
+    with open(filename, 'rb') as f:
+        for info in infos:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    "The file '{}' is compressed.".format(filename))
+            # skip the local file header
+            f.seek(info.header_offset + 26)
+            nname, nextra = struct.unpack('<HH', f.read(4))
+            f.seek(nname + nextra, os.SEEK_CUR)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            name = info.filename[:-4] if info.filename.endswith('.npy') \
+                else info.filename
+            if dtype.hasobject:
+                raise ValueError(
+                    "The file '{}' contains Python objects.".format(filename))
+            count = int(np.prod(shape))
+            if count <= 1:
+                out[name] = np.frombuffer(
+                    f.read(count * dtype.itemsize), dtype).reshape(shape)
+                continue
+            out[name] = np.memmap(
+                filename, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                order='F' if fortran_order else 'C')
+    return out
+
+
 def _format_sphconv(a, b, date_obs=None, time=None):
     incoords = np.empty(np.broadcast(a, b).shape + (2,))
     incoords[..., 0] = a
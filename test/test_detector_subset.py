@@ -0,0 +1,43 @@
+from __future__ import division
+import numpy as np
+from numpy.testing import assert_equal
+from qubic import QubicInstrument, QubicMultibandInstrument
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nf_sub'] = 3
+instrument = QubicInstrument(d)
+selections = (slice(3, 10), np.array([5, 1, 7]),
+              np.arange(len(instrument)) % 5 == 0)
+
+
+def _assert_shared(subset, parent, dets):
+    # only the detector layout is specific to the subset
+    assert subset is not parent
+    for key, value in vars(parent).items():
+        if key == 'detector':
+            continue
+        assert getattr(subset, key) is value, key
+    assert np.shares_memory(subset.horn.center, parent.horn.center)
+    ref = parent.detector[dets]
+    assert len(subset) == len(ref)
+    for attr in 'index', 'center', 'vertex', 'area', 'nep', 'quadrant':
+        assert_equal(getattr(subset.detector, attr), getattr(ref, attr), attr)
+
+
+def test_detector_subset():
+    for dets in selections:
+        _assert_shared(instrument.detector_subset(dets), instrument, dets)
+
+
+def test_detector_subset_multiband():
+    multiinstrument = QubicMultibandInstrument(d)
+    for dets in selections:
+        subset = multiinstrument.detector_subset(dets)
+        assert len(subset) == len(multiinstrument)
+        for q_subset, q in zip(subset, multiinstrument):
+            _assert_shared(q_subset, q, dets)
+        # the sub-instruments of the original are untouched
+        assert all(len(q) == len(instrument) for q in multiinstrument)
@@ -0,0 +1,9 @@
+from __future__ import division
+
+
+def test_import():
+    import qubic
+    from qubic import acquisition, mapmaking, noise, polyacquisition
+    for module in acquisition, mapmaking, noise, polyacquisition:
+        for name in module.__all__:
+            assert getattr(qubic, name) is getattr(module, name)
@@ -0,0 +1,69 @@
+from __future__ import division
+import copy
+import numpy as np
+import os
+import tempfile
+from numpy.testing import assert_allclose, assert_equal
+from pyoperators import DenseOperator, DiagonalOperator, pcg
+from qubic.mapmaking import pcg_checkpoint, pcg_multi, tod2map_each
+from qubic.qubicdict import qubicDict
+import qubic
+
+np.random.seed(0)
+n = 100
+m = np.random.standard_normal((n, n))
+A = DenseOperator(np.dot(m.T, m) + n * np.eye(n), shapein=n)
+M = DiagonalOperator(1 / np.diag(A.data))
+b = np.random.standard_normal(n)
+
+
+def test_checkpoint_resume():
+    ref = pcg(A, b, M=M, tol=1e-12)
+    tmpdir = tempfile.mkdtemp()
+    checkpoint = os.path.join(tmpdir, 'pcg.npz')
+    try:
+        # interrupted run, followed by a resumed one
+        output1 = pcg_checkpoint(A, b, checkpoint=checkpoint,
+                                 checkpoint_interval=3, M=M, tol=1e-12,
+                                 maxiter=5)
+        assert not output1['success']
+        assert os.path.exists(checkpoint)
+        output2 = pcg_checkpoint(A, b, checkpoint=checkpoint,
+                                 checkpoint_interval=3, M=M, tol=1e-12)
+    finally:
+        for f in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, f))
+        os.rmdir(tmpdir)
+    assert output2['success']
+    assert_equal(output2['nit'], ref['nit'])
+    assert_allclose(output2['x'], ref['x'], rtol=1e-12, atol=1e-14)
+
+
+def test_pcg_multi():
+    bs = np.random.standard_normal((4, n))
+    bs[2] = 0
+    output = pcg_multi(A, bs, M=M, tol=1e-10)
+    for k, b_ in enumerate(bs):
+        ref = pcg(A, b_, M=M, tol=1e-10)
+        assert_allclose(output['x'][k], ref['x'], rtol=1e-10, atol=1e-14)
+        if k != 2:
+            assert_equal(output['nit'][k], ref['nit'])
+    assert np.all(output['success'])
+
+
+def test_tod2map_each_nprocs():
+    d = qubicDict()
+    d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+    d['nside'] = 8
+    d['npointings'] = 20
+    d['seed'] = 1
+    instrument = qubic.QubicInstrument(copy.copy(d))[[5, 2, 30]]
+    sampling = qubic.get_pointing(copy.copy(d))
+    scene = qubic.QubicScene(copy.copy(d))
+    acq = qubic.QubicAcquisition(instrument, sampling, scene, copy.copy(d))
+    tod = acq.get_operator()(np.random.standard_normal(scene.shape))
+    ref = tod2map_each(acq, tod, disp=False, tol=1e-8)
+    actual = tod2map_each(acq, tod, disp=False, tol=1e-8, nprocs=2,
+                          d=copy.copy(d))
+    assert_allclose(actual[0], ref[0], rtol=1e-10, atol=1e-12)
+    assert_equal(actual[1], ref[1])
@@ -0,0 +1,108 @@
+from __future__ import division
+import copy
+import numpy as np
+from numpy.testing import assert_allclose
+from qubic import QubicInstrument, QubicScene, get_pointing
+from qubic.noise import NoiseGenerator
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nside'] = 16
+d['npointings'] = 20
+d['detector_fknee'] = 0.5
+np.random.seed(0)
+sampling = get_pointing(d)
+instrument = QubicInstrument(d)[:8]
+
+
+def test_mpi_layouts():
+    # the grid blocks are made small so that the slices overlap several of them
+    kwargs = dict(fknee=1, ncorr=256, sigma_white=0.5, seed=0)
+    noise = NoiseGenerator(8, 0.05, 1, **kwargs)
+    noise.BLOCK_SIZE = 1000
+    ref = noise(5000)
+    for detectors in (np.arange(8), np.arange(4, 8), np.array([1, 5])):
+        for start, stop in (0, 5000), (0, 2500), (2345, 5000), (999, 1001):
+            noise = NoiseGenerator(len(detectors), 0.05, 1,
+                                   detectors=detectors, **kwargs)
+            noise.BLOCK_SIZE = 1000
+            noise.skip(start)
+            assert_allclose(noise(stop - start), ref[detectors, start:stop],
+                            rtol=1e-10, atol=1e-12)
+
+
+def test_mpi_layouts_instrument():
+    ref = instrument.get_noise_detector(sampling, seed=1)
+    nsamples = len(sampling)
+    for idetector, isampling in ((slice(None), slice(None, nsamples // 3)),
+                                 (slice(2, 6), slice(nsamples // 3, None)),
+                                 (slice(7, 8), slice(1000, 1001))):
+        noise = instrument[idetector].get_noise_detector(
+            sampling[isampling], seed=1)
+        assert_allclose(noise, ref[idetector, isampling], rtol=1e-10,
+                        atol=1e-12 * np.max(np.abs(ref)))
+
+
+def test_chunks():
+    noise = NoiseGenerator(4, 0.05, 1, fknee=[0.5, 1, 1, 2], ncorr=256,
+                           sigma_white=0.5, seed=0)
+    ref = noise(3000)
+    for nsamples_chunk in 1, 255, 256, 1000:
+        noise.reset()
+        actual = np.concatenate(
+            [noise(min(nsamples_chunk, 3000 - start))
+             for start in range(0, 3000, nsamples_chunk)], axis=1)
+        assert_allclose(actual, ref, rtol=1e-10, atol=1e-12)
+
+
+def test_ncorr_max():
+    # the 1/f kernel covers 1000 / fknee = 1e5 s, unless it is capped
+    noise = NoiseGenerator(1, 0.05, 1, fknee=0.01, seed=0)
+    assert noise.ncorr == NoiseGenerator.NCORR_MAX == 2**14
+    ncorr_max = NoiseGenerator.NCORR_MAX
+    NoiseGenerator.NCORR_MAX = 2**22
+    try:
+        noise = NoiseGenerator(1, 0.05, 1, fknee=0.01, seed=0)
+    finally:
+        NoiseGenerator.NCORR_MAX = ncorr_max
+    assert noise.ncorr == 2**21
+
+
+def test_chunks_instrument():
+    ref = instrument.get_noise_detector(sampling, seed=1)
+    noise = instrument.get_noise_generator(sampling, None, photon_noise=False,
+                                           seed=1)
+    for nsamples_chunk in 100, 1000:
+        noise.reset()
+        actual = qubic.instrument._fill_noise(
+            noise, len(sampling), None, None, nsamples_chunk=nsamples_chunk)
+        assert_allclose(actual, ref, rtol=1e-10,
+                        atol=1e-12 * np.max(np.abs(ref)))
+
+
+def test_photon_nep():
+    # values of the loop over the detectors and optical components, before
+    # it was vectorized, for the detectors 0, 7, 100 and 231 and the mean.
+    # TD is not defined at 220 GHz.
+    expecteds = {
+        ('TD', 150e9): ([1.42386411707562e-17, 1.343067286792419e-17,
+                         1.858023176483993e-17, 2.258566542600455e-17],
+                        1.707075807404905e-17),
+        ('FI', 150e9): ([2.301651242745347e-17, 2.001187465061627e-17,
+                         3.679350081262991e-17, 4.803449450097694e-17],
+                        3.192248627088509e-17),
+        ('FI', 220e9): ([8.09835134821984e-17, 6.272378586539367e-17,
+                         1.494925944933802e-16, 1.722454526227679e-16],
+                        1.229056816030952e-16)}
+    for (config, nu), (expected, expected_mean) in sorted(expecteds.items()):
+        d_ = copy.copy(d)
+        d_['config'] = config
+        d_['filter_nu'] = nu
+        d_['photon_noise'] = True
+        q = QubicInstrument(d_)
+        for i in range(2):  # the second time, the integrals are cached
+            nep = q._get_noise_photon_nep(QubicScene(d_))
+            assert_allclose(nep[[0, 7, 100, 231]], expected, rtol=1e-12)
+            assert_allclose(np.mean(nep), expected_mean, rtol=1e-12)
@@ -0,0 +1,174 @@
+from __future__ import division
+import numpy as np
+import os
+import tempfile
+from numpy.testing import assert_allclose, assert_equal
+from qubic import QubicSampling, get_pointing
+from qubic.samplings import (
+    QubicRotation, create_sweeping_pointings, equ2hor)
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['npointings'] = 100
+d['duration'] = 0.1
+d['seed'] = 1
+strategies = ('random_pointing', 'repeat_pointing', 'sweeping_pointing')
+attrs = ('index', 'time', 'azimuth', 'elevation', 'pitch', 'angle_hwp')
+
+
+def _get_dict(strategy):
+    out = d.copy()
+    for key in strategies:
+        out[key] = key == strategy
+    return out
+
+
+class _Comm(object):
+    """ Communicator of one of the processes of a group, without MPI. """
+    def __init__(self, size, rank):
+        self.size = size
+        self.rank = rank
+
+    def bcast(self, obj, root=0):
+        return obj
+
+
+def test_distributed():
+    for strategy in strategies:
+        d_ = _get_dict(strategy)
+        ref = get_pointing(d_)
+        for size in 2, 3:
+            samplings = [get_pointing(d_, comm=_Comm(size, rank))
+                         for rank in range(size)]
+            assert_equal(sum(len(_) for _ in samplings), len(ref))
+            for attr in attrs:
+                actual = np.concatenate(
+                    [np.broadcast_to(getattr(_, attr), len(_))
+                     for _ in samplings])
+                assert_equal(actual, np.broadcast_to(getattr(ref, attr),
+                                                     len(ref)), attr)
+
+
+def test_save_load():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, 'sampling.npz')
+    try:
+        for strategy in strategies:
+            ref = get_pointing(_get_dict(strategy))
+            kind = 'horizontal' if ref.fix_az else 'galactic'
+            for rotation in False, True:
+                ref.save(filename, rotation=rotation)
+                for mmap in False, True:
+                    actual = QubicSampling.load(filename, mmap=mmap)
+                    assert_equal(isinstance(actual.azimuth, np.memmap), mmap)
+                    assert_equal(hasattr(actual, 'quaternion_' + kind),
+                                 rotation)
+                    for attr in attrs:
+                        assert_equal(getattr(actual, attr),
+                                     np.broadcast_to(getattr(ref, attr),
+                                                     len(ref)), attr)
+                    assert_equal(actual.date_obs.iso, ref.date_obs.iso)
+                    for attr in 'period', 'latitude', 'longitude', 'fix_az':
+                        assert_equal(getattr(actual, attr),
+                                     getattr(ref, attr), attr)
+                    assert_allclose(actual.get_rotation(kind).data,
+                                    ref.get_rotation(kind).data, atol=1e-12)
+                    del actual
+    finally:
+        for f in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, f))
+        os.rmdir(tmpdir)
+
+
+def test_rotation_chunks():
+    for strategy in strategies:
+        sampling = get_pointing(_get_dict(strategy))
+        kind = 'horizontal' if sampling.fix_az else 'galactic'
+        n = len(sampling)
+        ref = np.broadcast_to(sampling._get_rotation_operator(kind).data,
+                              (n, 3, 3))
+        # at most 3 blocks of 7 samples are stored
+        rotation = QubicRotation(sampling, kind, nsamples_chunk=7,
+                                 max_nbytes=3 * 7 * 9 * 8)
+        for start, stop in (0, n), (3, 20), (6, 8), (13, 14), (n - 1, n):
+            assert_allclose(rotation[start:stop], ref[start:stop], rtol=0,
+                            atol=1e-12)
+        chunks = list(rotation._chunks)
+        assert_allclose(rotation.data, ref, rtol=0, atol=1e-12)
+        assert_equal(list(rotation._chunks), chunks)
+
+
+def _create_sweeping_pointings_ref(center, duration, period, angspeed,
+                                   delta_az, nsweeps_per_elevation,
+                                   angspeed_psi, maxpsi, hwp_stepsize,
+                                   fix_azimuth, random_hwp):
+    # former implementation, with one horizontal conversion per sample and
+    # one loop iteration per elevation phase and per HWP step
+    out = QubicSampling(int(np.ceil(duration * 3600 / period)),
+                        period=period)
+    backforthdt = delta_az / angspeed * 2
+    isweeps = np.floor(out.time / backforthdt).astype(int)
+    if fix_azimuth['apply']:
+        azcenter = out.time * 0 + fix_azimuth['az']
+        elcenter = out.time * 0 + fix_azimuth['el']
+    else:
+        azcenter, elcenter = equ2hor(
+            np.full(len(out), center[0]), np.full(len(out), center[1]),
+            out.time, date_obs=out.date_obs)
+    daz = out.time * angspeed % (delta_az * 2)
+    daz[daz > delta_az] = 2 * delta_az - daz[daz > delta_az]
+    daz -= delta_az / 2
+    elcst = np.zeros(len(out))
+    ielevations = isweeps // nsweeps_per_elevation
+    nelevations = ielevations[-1] + 1
+    for i in range(nelevations):
+        mask = ielevations == i
+        elcst[mask] = np.mean(elcenter[mask])
+        if fix_azimuth['apply']:
+            elcst[mask] = elcenter[mask] - nelevations / 2 * \
+                fix_azimuth['el_step'] + i * fix_azimuth['el_step']
+    pitch = out.time * angspeed_psi % (4 * maxpsi)
+    pitch[pitch > 2 * maxpsi] = 4 * maxpsi - pitch[pitch > 2 * maxpsi]
+    pitch -= maxpsi
+    out.azimuth = azcenter + daz
+    out.elevation = elcst
+    out.pitch = pitch
+    if random_hwp:
+        out.angle_hwp = np.random.randint(
+            0, int(90 / hwp_stepsize + 1), len(out)) * hwp_stepsize
+    else:
+        out.angle_hwp = np.zeros(len(out))
+        max_sweeps = np.max(isweeps)
+        delta = int(len(out) / max_sweeps)
+        for i in range(max_sweeps):
+            out.angle_hwp[i * delta:(i + 1) * delta] = \
+                hwp_stepsize * np.mod(i, int(90 / hwp_stepsize + 1))
+    if fix_azimuth['apply'] and fix_azimuth['fix_pitch']:
+        out.pitch = 0
+    return out
+
+
+def test_sweeping_former():
+    # the tracked field center is interpolated from horizontal coordinates
+    # computed every minute, to better than one arcsecond
+    for apply in False, True:
+        for random_hwp in False, True:
+            fix_azimuth = dict(d['fix_azimuth'], apply=apply)
+            args = ((d['RA_center'], d['DEC_center']), 1, d['period'],
+                    d['angspeed'], d['delta_az'], d['nsweeps_per_elevation'],
+                    d['angspeed_psi'], d['maxpsi'], d['hwp_stepsize'])
+            np.random.seed(0)
+            ref = _create_sweeping_pointings_ref(
+                *args, fix_azimuth=fix_azimuth, random_hwp=random_hwp)
+            np.random.seed(0)
+            actual = create_sweeping_pointings(
+                *args, fix_azimuth=fix_azimuth, random_hwp=random_hwp)
+            assert_allclose(actual.azimuth, ref.azimuth, rtol=0,
+                            atol=1 / 3600)
+            assert_allclose(actual.elevation, ref.elevation, rtol=0,
+                            atol=1 / 3600)
+            assert_equal(np.broadcast_to(actual.pitch, len(actual)),
+                         np.broadcast_to(ref.pitch, len(ref)))
+            assert_equal(actual.angle_hwp, ref.angle_hwp)
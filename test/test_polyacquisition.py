@@ -0,0 +1,140 @@
+from __future__ import division
+import copy
+import numpy as np
+from numpy.testing import assert_allclose
+from qubic import (QubicAcquisition, QubicInstrument,
+                   QubicMultibandAcquisition, QubicMultibandInstrument,
+                   QubicPolyAcquisition, QubicScene, get_pointing)
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nside'] = 16
+d['npointings'] = 20
+d['nf_sub'] = 4
+np.random.seed(0)
+sampling = get_pointing(d)
+instrument = QubicMultibandInstrument(d).detector_subset(slice(0, 10))
+nus = np.array([q.filter.nu for q in instrument]) / 1e9
+nus_edge = [nus[0] - 1, (nus[1] + nus[2]) / 2, nus[-1] + 1]
+
+
+def _get_acquisition(kind, cls, *args):
+    d_ = copy.copy(d)
+    d_['kind'] = kind
+    return cls(instrument, sampling, QubicScene(d_), d_, *args)
+
+
+def test_fused_poly():
+    for kind in 'I', 'IQU':
+        acq = _get_acquisition(kind, QubicPolyAcquisition)
+        assert acq._get_fused_operator(acq.subacqs, acq.weights) is not None
+        H = acq.get_operator()
+        ops = acq._get_array_of_operators()
+        x = np.random.standard_normal(H.shapein)
+        y = np.random.standard_normal(H.shapeout)
+        rtol = 1e-5  # float32 peak values, summed in another order
+        ref = sum(op(x) for op in ops)
+        assert_allclose(H(x), ref, rtol=rtol, atol=rtol * np.max(abs(ref)))
+        ref = sum(op.T(y) for op in ops)
+        assert_allclose(H.T(y), ref, rtol=rtol, atol=rtol * np.max(abs(ref)))
+
+
+def test_fused_multiband():
+    for kind in 'I', 'IQU':
+        acq = _get_acquisition(kind, QubicMultibandAcquisition, nus_edge)
+        H = acq.get_operator()
+        ops = acq._get_array_of_operators()
+        bands = [np.where((acq.nus > nu_min) & (acq.nus < nu_max))[0]
+                 for nu_min, nu_max in acq.bands]
+        assert [len(_) for _ in bands] == [2, 2]
+        x = np.random.standard_normal(H.shapein)
+        y = np.random.standard_normal(H.shapeout)
+        rtol = 1e-5
+        ref = sum(ops[i](x[iband]) for iband, band in enumerate(bands)
+                  for i in band)
+        assert_allclose(H(x), ref, rtol=rtol, atol=rtol * np.max(abs(ref)))
+        ref = np.array([sum(ops[i].T(y) for i in band) for band in bands])
+        assert_allclose(H.T(y), ref, rtol=rtol, atol=rtol * np.max(abs(ref)))
+
+
+def test_fused_chunks():
+    # the chunks have different numbers of distinct pixels per row, so that
+    # the matrix is widened while it is filled
+    scene = QubicScene(d)
+    ref = QubicMultibandInstrument._get_fused_projection_operator(
+        instrument, sampling, scene, verbose=False)
+    for nsamples_chunk in 1, 3:
+        P = QubicMultibandInstrument._get_fused_projection_operator(
+            instrument, sampling, scene, verbose=False,
+            nsamples_chunk=nsamples_chunk)
+        x = np.random.standard_normal(P.shapein)
+        assert_allclose(P(x), ref(x), rtol=1e-12)
+
+
+def _get_average_instrument_acq(acq):
+    # the average instrument acquisition, as it was built for each noise
+    # realization before the noise model was stored
+    q0 = acq[0].instrument
+    nu_min = q0.filter.nu
+    nu_max = acq[-1].instrument.filter.nu
+    d1 = copy.copy(acq.d)
+    d1['filter_nu'] = (nu_max + nu_min) / 2
+    d1['filter_relative_bandwidth'] = (nu_max - nu_min) / \
+        ((nu_max + nu_min) / 2)
+    d1['detector_nep'] = q0.detector.nep
+    d1['detector_fknee'] = q0.detector.fknee
+    d1['detector_fslope'] = q0.detector.fslope
+    q = QubicInstrument(d1, FRBW=q0.FRBW)
+    q.detector = q0.detector
+    s_ = acq[0].sampling
+    d1['random_pointing'] = True
+    d1['sweeping_pointing'] = False
+    d1['repeat_pointing'] = False
+    d1['RA_center'] = 0.
+    d1['DEC_center'] = 0.
+    d1['npointings'] = len(s_)
+    d1['dtheta'] = 10.
+    d1['period'] = s_.period
+    return QubicAcquisition(q, get_pointing(d1), acq[0].scene, d1)
+
+
+def test_noise_model():
+    for photon_noise in False, True:
+        d_ = copy.copy(d)
+        d_['photon_noise'] = photon_noise
+        acq = QubicPolyAcquisition(instrument, sampling, QubicScene(d_), d_)
+        model = acq.get_noise_model()
+        assert acq.get_noise_model() is model
+        ref = _get_average_instrument_acq(acq)
+        assert_allclose(model.nep, ref.instrument.detector.nep)
+        if photon_noise:
+            assert_allclose(model.nep_photon,
+                            ref.instrument._get_noise_photon_nep(ref.scene),
+                            rtol=1e-12)
+        assert_allclose(acq.get_noise(seed=1), ref.get_noise(seed=1),
+                        rtol=1e-12)
+        y = np.random.standard_normal((len(instrument[0]), len(sampling)))
+        assert_allclose(model.get_invntt_operator()(y),
+                        ref.get_invntt_operator()(y), rtol=1e-12)
+
+
+def test_invntt_shared():
+    d_ = copy.copy(d)
+    d_['detector_fknee'] = 0.5
+    instrument_ = QubicMultibandInstrument(d_).detector_subset(slice(0, 10))
+    QubicAcquisition.clear_invntt_cache()
+    for photon_noise in False, True:
+        d_['photon_noise'] = photon_noise
+        acq = QubicPolyAcquisition(instrument_, sampling, QubicScene(d_), d_)
+        invntts = [a.get_invntt_operator() for a in acq]
+        if photon_noise:
+            # the photon noise, hence the noise model, depends on the band
+            assert len(set(id(_) for _ in invntts)) == len(acq)
+        else:
+            assert all(_ is invntts[0] for _ in invntts)
+        assert all(a.get_invntt_operator() is _
+                   for a, _ in zip(acq, invntts))
+    QubicAcquisition.clear_invntt_cache()
+    assert acq[0].get_invntt_operator() is not invntts[0]
@@ -0,0 +1,63 @@
+from __future__ import division
+import copy
+import numpy as np
+from numpy.testing import assert_allclose
+from qubic import QubicAcquisition, QubicInstrument, QubicScene, get_pointing
+from qubic.acquisition import _get_invntt_diagonal, _invert_blocks
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nside'] = 8
+d['npointings'] = 20
+np.random.seed(0)
+sampling = get_pointing(d)
+instrument = QubicInstrument(d)[:2]
+
+
+def _get_acquisition(kind, fknee):
+    d_ = copy.copy(d)
+    d_['kind'] = kind
+    d_['detector_fknee'] = fknee
+    return QubicAcquisition(instrument, sampling, QubicScene(d_), d_)
+
+
+def test_invntt_diagonal():
+    for fknee in 0, 0.5:
+        acq = _get_acquisition('IQU', fknee)
+        invntt = acq.get_invntt_operator()
+        impulse = np.zeros((len(instrument), len(sampling)))
+        impulse[:, 100] = 1
+        assert_allclose(_get_invntt_diagonal(invntt, len(instrument)),
+                        invntt(impulse)[:, 100], rtol=1e-10)
+
+
+def test_blocks():
+    # the blocks are the diagonal blocks of H^T D H, where D is the diagonal
+    # of the inverse noise covariance (equal to it for white noise)
+    for kind in 'I', 'IQU':
+        for fknee in 0, 0.5:
+            acq = _get_acquisition(kind, fknee)
+            invntt = acq.get_invntt_operator()
+            blocks = acq.get_preconditioner_blocks(invntt)
+            ncomps = len(kind)
+            H = acq.get_operator().todense().reshape(
+                (len(instrument) * len(sampling), -1, ncomps))
+            weights = np.repeat(
+                _get_invntt_diagonal(invntt, len(instrument)), len(sampling))
+            expected = np.einsum('r,rpa,rpb->pab', weights, H, H)
+            assert blocks.shape == expected.shape
+            assert_allclose(blocks, expected, rtol=1e-6,
+                            atol=1e-6 * np.max(np.abs(expected)))
+
+
+def test_invert_blocks():
+    a = np.random.standard_normal((5, 3, 3))
+    blocks = np.einsum('pab,pcb->pac', a, a) + np.eye(3)
+    blocks[3] = np.diag([2., 0, 0]) + 1e-12  # ill-conditioned
+    blocks[4] = 0  # unobserved pixel
+    actual = _invert_blocks(blocks)
+    assert_allclose(actual[:3], np.linalg.inv(blocks[:3]), rtol=1e-12)
+    assert_allclose(actual[3], np.diag([1 / (2 + 1e-12), 1e12, 1e12]))
+    assert_allclose(actual[4], 0)
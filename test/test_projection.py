@@ -0,0 +1,157 @@
+from __future__ import division
+import numpy as np
+import os
+import shutil
+import tempfile
+from numpy.testing import assert_allclose
+from pyoperators.utils.testing import assert_same
+from qubic import QubicAcquisition, QubicInstrument, QubicScene, get_pointing
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nside'] = 16
+d['npointings'] = 50
+d['MultiBand'] = False
+np.random.seed(0)
+sampling = get_pointing(d)
+instrument = QubicInstrument(d)[:20]
+scene = QubicScene(d)
+acq = QubicAcquisition(instrument, sampling, scene, d)
+d_streaming = d.copy()
+d_streaming['max_nbytes'] = acq.get_operator_nbytes() // 3
+acq_streaming = QubicAcquisition(instrument, sampling, scene, d_streaming)
+coverage = instrument.get_coverage(sampling, scene)
+mask = coverage > 0.1 * np.max(coverage)
+
+
+def test_streaming():
+    assert len(acq_streaming.block) > 1
+    H = acq.get_operator()
+    H_streaming = acq_streaming.get_operator()
+    x = np.random.random_sample(H.shapein)
+    y = H(x)
+    assert_same(H_streaming(x), y)
+    assert_allclose(H_streaming.T(y), H.T(y), rtol=1e-10)
+
+
+def test_streaming_restricted():
+    P = acq.get_projection_operator().restrict(mask)
+    P_streaming = acq_streaming.get_projection_operator()
+    P_streaming = qubic.mapmaking._get_projection_restricted(
+        P_streaming, mask)
+    assert P_streaming.shapein == P.shapein == (np.sum(mask), 3)
+    x = np.random.random_sample(P.shapein)
+    y = P(x)
+    assert_same(P_streaming(x), y)
+    assert_allclose(P_streaming.T(y), P.T(y), rtol=1e-10)
+
+    H = acq[..., mask].get_operator()
+    H_streaming = acq_streaming[..., mask].get_operator()
+    assert H_streaming.shapein == H.shapein == (np.sum(mask), 3)
+    assert_same(H_streaming(x), H(x))
+
+
+def test_coverage():
+    P_streaming = acq_streaming.get_projection_operator()
+    assert_allclose(instrument.get_coverage(sampling, scene,
+                                            projection=P_streaming),
+                    coverage, rtol=1e-6)
+
+
+def test_nthreads():
+    # the matrix kernels must be compiled with OpenMP
+    from qubic._flib import polarization
+    assert polarization.get_num_threads(2) == 2
+    assert polarization.get_num_threads(1) == 1
+    P = instrument.get_projection_operator(sampling, scene, verbose=False)
+    instrument.nthreads = 2
+    try:
+        P_threads = instrument.get_projection_operator(sampling, scene,
+                                                       verbose=False)
+    finally:
+        instrument.nthreads = None
+    for field in P.matrix.data.dtype.names:
+        assert_same(P_threads.matrix.data[field], P.matrix.data[field])
+
+
+def test_projection_cache():
+    def get_files():
+        return sorted(os.listdir(cache))
+
+    def is_mapped(data):
+        while data is not None:
+            if isinstance(data, np.memmap):
+                return True
+            data = getattr(data, 'base', None)
+        return False
+
+    def get_data(instrument, sampling, scene):
+        instrument.projection_cache = cache
+        try:
+            return instrument.get_projection_operator(
+                sampling, scene, verbose=False).matrix.data
+        finally:
+            instrument.projection_cache = None
+
+    ref = instrument.get_projection_operator(
+        sampling, scene, verbose=False).matrix.data
+    cache = tempfile.mkdtemp()
+    try:
+        # a miss computes the matrix and writes it in the cache
+        data = get_data(instrument, sampling, scene)
+        assert not is_mapped(data)
+        assert len(get_files()) == 1
+        files = get_files()
+        # a hit memory-maps the stored matrix
+        data = get_data(instrument, sampling, scene)
+        assert is_mapped(data)
+        assert get_files() == files
+        for field in ref.dtype.names:
+            assert_same(data[field], ref[field])
+        del data
+
+        # a change of pointing, resolution or detectors is a miss
+        d_ = d.copy()
+        d_['nside'] = 8
+        for args in ((instrument, sampling[:-1], scene),
+                     (instrument, sampling, QubicScene(d_)),
+                     (instrument[1:], sampling, scene)):
+            get_data(*args)
+            assert len(get_files()) == len(files) + 1
+            files = get_files()
+    finally:
+        shutil.rmtree(cache)
+
+
+def test_coverage_transpose():
+    # the coverage is the I component of P.T applied to the detector
+    # weights, including the pixels hit by several peaks of one detector
+    for kind in 'I', 'IQU':
+        d_ = d.copy()
+        d_['kind'] = kind
+        d_['nside'] = 4
+        instrument_ = QubicInstrument(d_)[:20]
+        scene_ = QubicScene(d_)
+        acq_ = QubicAcquisition(instrument_, sampling, scene_, d_)
+        P = acq_.get_projection_operator()
+        index = P.matrix.data['index'].reshape(-1, P.matrix.data.shape[-1])
+        assert any(len(np.unique(_[_ >= 0])) < np.sum(_ >= 0)
+                   for _ in index)
+        weights = instrument_.get_transmission_operator().data * \
+            instrument_.get_detector_integration_operator().data
+        if kind == 'I' and not instrument_.optics.polarizer:
+            weights *= 1 - (instrument_.detector.quadrant - 1) // 4
+        tod = np.zeros(P.shapeout)
+        if kind == 'I':
+            tod[...] = weights[:, None]
+            expected = P.T(tod)
+        else:
+            tod[..., 0] = weights[:, None]
+            expected = P.T(tod)[:, 0]
+        assert_allclose(instrument_.get_coverage(sampling, scene_), expected,
+                        rtol=1e-6, atol=1e-6 * np.max(expected))
+        assert_allclose(instrument_.get_coverage(sampling, scene_,
+                                                 projection=P),
+                        expected, rtol=1e-6, atol=1e-6 * np.max(expected))
@@ -0,0 +1,81 @@
+from __future__ import division
+import copy
+import numpy as np
+import os
+import shutil
+import tempfile
+from numpy.testing import assert_allclose
+from unittest import SkipTest
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nside'] = 8
+d['nf_sub'] = 3
+d['nf_recon'] = 2
+skyconfig = {'dust': 'd1', 'synchrotron': 's1'}
+
+
+def _get_sky_map_ref(sky):
+    # former integration, with one bandpass integration per sub-band and per
+    # component, converted to uK_CMB by PySM
+    import pysm3.units as u
+    from pysm3 import utils
+    _, nus_edge, _, _, _, _ = qubic.compute_freq(
+        sky.filter_nu, sky.Nfin, sky.filter_relative_bandwidth)
+    out = np.zeros((sky.Nfin, sky.npix, 3))
+    for i in range(sky.Nfin):
+        freqs = np.linspace(nus_edge[i], nus_edge[i + 1], 5)
+        weights = np.ones(len(freqs))
+        conversion = utils.bandpass_unit_conversion(
+            freqs * u.GHz, weights, u.uK_CMB)
+        for component in sky.sky.components:
+            out[i] += (component.get_emission(freqs * u.GHz, weights) *
+                       conversion).value.T
+    return out
+
+
+def _import_skysim():
+    try:
+        from qubic import QubicSkySim
+    except ImportError:
+        raise SkipTest('The QubicSkySim dependencies are not installed.')
+    return QubicSkySim
+
+
+def test_bandpass_conversion():
+    QubicSkySim = _import_skysim()
+    import pysm3.units as u
+    from pysm3 import utils
+    freqs = np.linspace(131., 146., 5)
+    expected = utils.bandpass_unit_conversion(
+        freqs * u.GHz, np.ones(len(freqs)), u.uK_CMB).value
+    for _ in range(2):
+        # the second call hits the cache
+        assert_allclose(QubicSkySim._get_bandpass_conversion(freqs), expected,
+                        rtol=1e-12)
+
+
+def test_foreground_maps():
+    QubicSkySim = _import_skysim()
+    sky = QubicSkySim.Qubic_sky(skyconfig, copy.copy(d))
+    expected = _get_sky_map_ref(sky)
+    atol = 1e-10 * np.max(np.abs(expected))
+    assert_allclose(sky.get_simple_sky_map(), expected, rtol=1e-8,
+                    atol=atol)
+    # the band-integrated foregrounds are kept in memory
+    assert_allclose(sky.get_simple_sky_map(), expected, rtol=1e-8,
+                    atol=atol)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for _ in range(2):
+            # the maps are computed, then read from the on-disk cache
+            sky = QubicSkySim.Qubic_sky(skyconfig, copy.copy(d),
+                                        cache_dir=cache_dir)
+            assert_allclose(sky.get_simple_sky_map(), expected, rtol=1e-8,
+                            atol=atol)
+            assert len(os.listdir(cache_dir)) == 1
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,116 @@
+from __future__ import division
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from pyoperators.utils.testing import assert_same
+from qubic import QubicInstrument, QubicScene
+from qubic.qubicdict import qubicDict
+import qubic
+
+d = qubicDict()
+d.read_from_file(qubic.__path__[0] + '/dicts/global_source_oneDet.dict')
+d['nside'] = 16
+scene = QubicScene(d)
+instrument = QubicInstrument(d)[:3]
+
+
+def _get_synthbeam_loop(q, detector_integrate):
+    # per-detector loop over the integration grid, as it was done before
+    # the positions were vectorized
+    out = []
+    for idet in range(len(q)):
+        q_ = q[idet]
+        allx = np.linspace(np.min(q_.detector.vertex[..., 0]),
+                           np.max(q_.detector.vertex[..., 0]),
+                           detector_integrate)
+        ally = np.linspace(np.min(q_.detector.vertex[..., 1]),
+                           np.max(q_.detector.vertex[..., 1]),
+                           detector_integrate)
+        sb = 0
+        for x in allx:
+            for y in ally:
+                pos = q_.detector.center.copy()
+                pos[0, 0] = x
+                pos[0, 1] = y
+                sb += QubicInstrument._get_synthbeam(
+                    scene, pos, q_.detector.area, q_.filter.nu,
+                    q_.filter.bandwidth, q_.horn, q_.primary_beam,
+                    q_.secondary_beam, q_.synthbeam.dtype) / \
+                    detector_integrate ** 2
+        out.append(sb[0])
+    return np.array(out)
+
+
+def test_detector_integrate():
+    ref = _get_synthbeam_loop(instrument, 3)
+    actual = instrument.get_synthbeam(scene, detector_integrate=3)
+    assert actual.shape == ref.shape == (len(instrument), len(scene))
+    assert_allclose(actual, ref, rtol=1e-5, atol=1e-6 * np.max(ref))
+    assert_allclose(instrument.get_synthbeam(scene, idet=1,
+                                             detector_integrate=3),
+                    ref[1], rtol=1e-5, atol=1e-6 * np.max(ref))
+
+
+def test_nthreads():
+    ref = instrument.get_synthbeam(scene, nthreads=1)
+    for nthreads in 2, 3:
+        assert_same(instrument.get_synthbeam(scene, nthreads=nthreads), ref)
+
+
+def test_chunks():
+    ref = instrument.get_synthbeam(scene)
+    nbytes = [1e4, 1e5]
+    for max_nbytes in nbytes:
+        assert_equal(instrument.get_synthbeam(scene, max_nbytes=max_nbytes),
+                     ref)
+    ref = instrument.get_synthbeam(scene, detector_integrate=2)
+    for max_nbytes in nbytes:
+        assert_equal(instrument.get_synthbeam(scene, detector_integrate=2,
+                                              max_nbytes=max_nbytes), ref)
+
+
+def test_complex64():
+    # with single precision fields, the beams are accurate to ~1e-6 of
+    # their maximum
+    for detector_integrate in None, 2:
+        ref = instrument.get_synthbeam(scene,
+                                       detector_integrate=detector_integrate)
+        actual = instrument.get_synthbeam(
+            scene, detector_integrate=detector_integrate,
+            complex_dtype=np.complex64)
+        assert_allclose(actual, ref, atol=1e-5 * np.max(ref))
+
+
+def test_peak_angles_cache():
+    import copy
+    from qubic.instrument import _PEAK_ANGLES_CACHE
+
+    def peak_angles(q, nu=None):
+        return QubicInstrument._peak_angles(
+            scene, nu or q.filter.nu, q.detector.center, q.synthbeam, q.horn,
+            q.primary_beam)
+
+    d_ = d.copy()
+    d_['beam_shape'] = 'multi_freq'
+    q = QubicInstrument(d_)[:3]
+    QubicInstrument.clear_peak_angles_cache()
+    ref = peak_angles(q)
+    assert len(_PEAK_ANGLES_CACHE) == 1
+    for actual, expected in zip(peak_angles(q), ref):
+        assert_equal(actual, expected)
+    assert len(_PEAK_ANGLES_CACHE) == 1
+
+    # another frequency
+    peak_angles(q, nu=0.9 * q.filter.nu)
+    assert len(_PEAK_ANGLES_CACHE) == 2
+
+    # a beam differing only by the spline nested in the MultiFreqBeam
+    q_ = q[:]
+    q_.primary_beam = copy.deepcopy(q.primary_beam)
+    tx, ty, c = q_.primary_beam.sp.tck
+    q_.primary_beam.sp.tck = tx, ty, c ** 2
+    actual = peak_angles(q_)
+    assert len(_PEAK_ANGLES_CACHE) == 3
+    assert not np.array_equal(actual[2], ref[2])
+    QubicInstrument.clear_peak_angles_cache()
+    for actual_, expected in zip(actual, peak_angles(q_)):
+        assert_equal(actual_, expected)